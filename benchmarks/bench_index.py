@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark index rendering
+
+Compares the streaming renderer against the original string concatenation renderer, and
+the size and transfer time of plain and gzip precompressed index pages.
+
+    python benchmarks/bench_index.py --entries 1000 100000 1000000
+"""
+
+import argparse
+import gzip
+import io
+import os
+import time
+import tracemalloc
+
+from pips3 import PipS3
+
+ENDPOINT = "https://some-bucket.s3-website-ap-southeast-2.amazonaws.com"
+
+INDEX_TEMPLATE_INTO = "<!DOCTYPE html>\n<html>\n  <body>"
+INDEX_TEMPLATE_OUTTRO = "\n  </body>\n</html>"
+
+
+def legacy_generate_index(keys):
+    """The original renderer, building the page by repeated concatenation"""
+    template = INDEX_TEMPLATE_INTO
+
+    for key in keys:
+        basename = os.path.basename(key)
+        template += f"\n    <a href=\"{ENDPOINT}/{key}\">{basename}</a>"
+
+    template += INDEX_TEMPLATE_OUTTRO
+    return template
+
+
+def legacy_render(keys):
+    """Render and encode the page, as upload_index did"""
+    return len(legacy_generate_index(keys).encode('utf-8'))
+
+
+def streaming_render(keys):
+    """Render the page straight into a bytes buffer"""
+    return PipS3(ENDPOINT, 'bucket',
+                 s3_client=object()).write_index(io.BytesIO(), keys=keys)
+
+
+def transfer_savings(keys, bandwidth_mbps):
+    """Compare the plain and gzip precompressed page as stored by upload_index"""
+    page = io.BytesIO()
+    PipS3(ENDPOINT, 'bucket', s3_client=object()).write_index(page, keys=keys)
+
+    compressed = io.BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', fileobj=compressed,
+                       mtime=0) as sink:
+        sink.write(page.getvalue())
+
+    plain_size = len(page.getvalue())
+    gzip_size = len(compressed.getvalue())
+    bytes_per_second = bandwidth_mbps * 1e6 / 8
+
+    return (plain_size, gzip_size, plain_size / bytes_per_second,
+            gzip_size / bytes_per_second)
+
+
+def measure(render, keys):
+    """Time a renderer and measure its peak traced memory"""
+    start = time.perf_counter()
+    size = render(keys)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    render(keys)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return size, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--entries',
+                        type=int,
+                        nargs='+',
+                        default=[1000, 100000, 1000000])
+    parser.add_argument('--bandwidth-mbps',
+                        type=float,
+                        default=100.0,
+                        help='Bandwidth used to estimate transfer times')
+    args = parser.parse_args()
+
+    print(f"{'entries':>10} {'renderer':>10} {'bytes':>12} {'seconds':>9} "
+          f"{'peak MiB':>9}")
+
+    pages = []
+    for entries in args.entries:
+        keys = [
+            f'simple/pips3/pips3-0.1.0.dev{i}-py3-none-any.whl'
+            for i in range(entries)
+        ]
+
+        for name, render in [('legacy', legacy_render),
+                             ('streaming', streaming_render)]:
+            size, elapsed, peak = measure(render, keys)
+            print(f"{entries:>10} {name:>10} {size:>12} {elapsed:>9.3f} "
+                  f"{peak / 2**20:>9.1f}")
+
+        pages.append((entries, ) + transfer_savings(keys, args.bandwidth_mbps))
+
+    print(f"\n{'entries':>10} {'plain':>12} {'gzip':>12} {'saved':>7} "
+          f"{'plain s':>9} {'gzip s':>9}  (at {args.bandwidth_mbps:g} Mbit/s)")
+
+    for entries, plain_size, gzip_size, plain_time, gzip_time in pages:
+        print(f"{entries:>10} {plain_size:>12} {gzip_size:>12} "
+              f"{1 - gzip_size / plain_size:>7.1%} {plain_time:>9.3f} "
+              f"{gzip_time:>9.3f}")
+
+
+if __name__ == '__main__':
+    main()
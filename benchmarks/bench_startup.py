@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark CLI startup
+
+Measures the import time of the CLI with python -X importtime and the wall time of
+pips3 --help, and fails if either exceeds a budget or boto3 is imported at startup.
+
+    python benchmarks/bench_startup.py --repeat 5 --max-import-ms 150
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(args):
+    """Run python with the repository on the path, returning the stderr"""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.run([sys.executable] + args,
+                          env=env,
+                          check=True,
+                          stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE,
+                          universal_newlines=True).stderr
+
+
+def import_times(module):
+    """Import a module with -X importtime
+
+    Returns:
+        dict: The cumulative import time of each module in microseconds
+    """
+    times = {}
+    for line in run(['-X', 'importtime', '-c', f'import {module}'
+                     ]).splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+
+    return times
+
+
+def help_time():
+    """Time pips3 --help in a new interpreter, in seconds"""
+    start = time.perf_counter()
+    run(['-m', 'pips3.cli', '--help'])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top',
+                        type=int,
+                        default=10,
+                        help='Number of slowest imports to show')
+    parser.add_argument('--max-import-ms',
+                        type=float,
+                        default=None,
+                        help='Fail if importing pips3.cli takes longer')
+    args = parser.parse_args()
+
+    runs = [import_times('pips3.cli') for _ in range(args.repeat)]
+    total_ms = min(times['pips3.cli'] for times in runs) / 1000
+    help_ms = min(help_time() for _ in range(args.repeat)) * 1000
+
+    print(f"import pips3.cli: {total_ms:.1f} ms (best of {args.repeat})")
+    print(f"pips3 --help:     {help_ms:.1f} ms (best of {args.repeat})")
+
+    print(f"\n{'cumulative ms':>13}  module")
+    slowest = sorted(runs[0].items(), key=lambda item: -item[1])
+    for name, cumulative in slowest[:args.top]:
+        print(f"{cumulative / 1000:>13.1f}  {name}")
+
+    failures = []
+    if 'boto3' in runs[0]:
+        failures.append("boto3 is imported at startup")
+
+    if args.max_import_ms is not None and total_ms > args.max_import_ms:
+        failures.append(
+            f"import took {total_ms:.1f} ms, over the {args.max_import_ms:g} ms budget"
+        )
+
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
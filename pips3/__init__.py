@@ -4,9 +4,36 @@
 __author__ = """Ben Johnston"""
 __email__ = 'ben.johnston@annalise.ai'
 
-from ._version import get_versions
+import sys
 
-__version__ = get_versions()['version']
-del get_versions
 
-from pips3.base import PipS3, publish_packages
+def _get_version() -> str:
+    """Resolve the version from the installed distribution
+
+    Versioneer runs git in a source checkout, so it is only used on Python < 3.8, where the
+    static _version.py of a built package is read instead.
+    """
+    try:
+        from importlib.metadata import PackageNotFoundError, version
+    except ImportError:  # pragma: no cover, Python < 3.8
+        from ._version import get_versions
+        return get_versions()['version']
+
+    try:
+        return version(__name__)
+    except PackageNotFoundError:
+        return "0+unknown"
+
+
+def __getattr__(name: str):
+    # The version is resolved on first use, keeping it out of the CLI startup time
+    if name == '__version__':
+        return _get_version()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+if sys.version_info < (3, 7):  # pragma: no cover, no module __getattr__
+    __version__ = _get_version()
+
+from pips3.base import (PipS3, complete_reindex, publish_packages,
+                        reindex_packages)
@@ -2,21 +2,72 @@
 # -*- coding: utf-8 -*-
 """Base Class"""
 
-import functools
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
 import logging
 import os
+import re
 import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
-from typing import Iterable, List, Union
+from typing import (TYPE_CHECKING, BinaryIO, Callable, Container, Dict,
+                    Iterable, Iterator, List, Tuple, TypeVar, Union)
 
-import boto3
+from pips3.checkpoint import ListingCheckpoint
+from pips3.clients import (get_bucket_region, get_s3_client,
+                           register_conditional_headers)
+from pips3.exceptions import (PackageExistsException,
+                              ReindexIncompleteException)
+from pips3.manifest import (INDEX_NAME, JSON_INDEX_NAME, MANIFEST_NAME,
+                            METADATA_SUFFIX, PROJECTS_NAME, Manifest,
+                            format_time, is_artifact)
+from pips3.metadata import extract_metadata, parse_requires_python
+from pips3.render import (JSON_CONTENT_TYPE, iter_html_index, iter_json_index,
+                          write_chunks)
+from pips3.report import PublishReport
 
-from pips3.exceptions import PackageExistsException
+# boto3 takes a few hundred milliseconds to import, so it is only imported once a client or
+# transfer is needed, keeping e.g. pips3 --help fast
+if TYPE_CHECKING:  # pragma: no cover
+    import boto3
+    from boto3.s3.transfer import TransferConfig
 
-s3 = boto3.client("s3")
+# Rendered indexes larger than this are uploaded in parts
+INDEX_MULTIPART_THRESHOLD = 8 * 1024 * 1024
 
-INDEX_TEMPLATE_INTO = "<!DOCTYPE html>\n<html>\n  <body>"
-INDEX_TEMPLATE_OUTTRO = "\n  </body>\n</html>"
+# Limits on the parts of package uploads. S3 allows at most 10,000 parts of up to 5 GiB, and
+# parts of at least 5 MiB; parts are kept above boto3's default of 8 MiB
+MIN_PART_SIZE = 8 * 1024 * 1024
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+MAX_PARTS = 10000
+
+# The user metadata key recording the part size of a multipart package upload, so that its
+# ETag can be recomputed from the local file
+PART_SIZE_METADATA = 'part-size'
+
+# Sharded reindex completion reports are stored under this key prefix, outside the repository
+REINDEX_REPORTS_PREFIX = '.pips3/reindex'
+
+# Coalesced index writes are coordinated through a generation object per project under this key
+# prefix.  The writer holding the lease renews it every LEASE_RENEW_SECONDS while it renders, and
+# a writer that stops renewing its lease is taken over after LEASE_SECONDS
+GENERATIONS_PREFIX = '.pips3/generations'
+LEASE_SECONDS = 60.0
+LEASE_RENEW_SECONDS = LEASE_SECONDS / 4
+
+# Adaptive transfer settings: without a throughput measurement a package is split into about
+# TARGET_PARTS parts, otherwise parts are sized to take about TARGET_PART_SECONDS each
+TARGET_PARTS = 64
+TARGET_PART_SECONDS = 2.0
+MAX_CONCURRENCY = 16
 
 logging.basicConfig(
     format="%(name)s - %(levelname)s - %(message)s",
@@ -24,6 +75,147 @@ logging.basicConfig(
     level=logging.INFO)
 logger = logging.getLogger("pips3")
 
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def _successor(stem: str) -> str:
+    """The smallest string greater than every key that starts with a stem"""
+    return stem[:-1] + chr(ord(stem[-1]) + 1)
+
+
+def _key_bands(probe: Callable[[str], Union[str, None]], stem: str,
+               after: str) -> List[str]:
+    """Find the bands of the keys following a key that start with a stem
+
+    The remaining keys are first narrowed to their longest common prefix by a binary search,
+    then a band is found for each character that follows that prefix, stepping from the first
+    key of each band to the next with one probe.
+
+    Args:
+        probe (Callable[[str], Union[str, None]]): Returns the first key after a StartAfter
+            value, or None if there is none
+        stem (str): The prefix shared by the keys to divide
+        after (str): Only keys after this key are divided
+
+    Returns:
+        List[str]: The prefix of each band in ascending order, empty if the keys cannot be
+            divided any further
+    """
+    first = probe(max(after, stem))
+    if first is None or not first.startswith(stem):
+        return []
+
+    def diverge(length: int) -> bool:
+        beyond = probe(_successor(first[:length]))
+        return beyond is not None and beyond.startswith(stem)
+
+    # The keys usually diverge straight after the stem, e.g. at the next version digit
+    low, high = len(stem), len(first)
+    if diverge(low + 1):
+        high = low
+
+    while low < high:
+        middle = (low + high + 1) // 2
+        if diverge(middle):
+            high = middle - 1
+        else:
+            low = middle
+
+    if low == len(first):
+        return []
+
+    common = first[:low]
+    bands = []
+    key = first
+    while key is not None and key.startswith(common):
+        bands.append(common + key[len(common)])
+        key = probe(_successor(bands[-1]))
+
+    return bands
+
+
+def _split_points(probe: Callable[[str], Union[str, None]], prefix: str,
+                  after: str, count: int) -> List[str]:
+    """Choose lexicographic split points spread across the keys following a key
+
+    The keys are divided into bands at the first position where they vary, e.g. the next
+    version digit, with StartAfter probes of a single key.  Bands are divided further until
+    there are more bands than split points, and the split points are taken at evenly spaced
+    band boundaries.
+
+    Args:
+        probe (Callable[[str], Union[str, None]]): Returns the first key after a StartAfter
+            value, or None if there is none
+        prefix (str): The listing prefix, which is never split
+        after (str): Only keys after this key are divided
+        count (int): The maximum number of split points
+
+    Returns:
+        List[str]: The split points in ascending order, all greater than after
+    """
+    stems = [prefix]
+    while len(stems) <= count:
+        bands = []
+        for stem in stems:
+            bands.extend(_key_bands(probe, stem, after) or [stem])
+
+        if bands == stems:
+            break
+        stems = bands
+
+    if len(stems) <= count + 1:
+        return stems[1:]
+
+    return sorted({
+        stems[round(i * len(stems) / (count + 1))]
+        for i in range(1, count + 1)
+    })
+
+
+class _KeyRange:
+    """A range of keys (lower, upper] listed by a single worker
+
+    Args:
+        lower (str): The key the range starts after
+        upper (Union[str, None]): The last key of the range, or None for no limit
+    """
+    def __init__(self, lower: str, upper: Union[str, None]):
+        self.lower = lower
+        self.upper = upper
+        self.position = lower
+        self.objects = []
+        self.started = None
+        self.done = False
+        self.splittable = True
+
+
+def _ordered_map(func: Callable[[T], R], items: Iterable[T],
+                 max_workers: int) -> Iterator[R]:
+    """Apply a function to items on a thread pool, yielding results in input order
+
+    At most 2 * max_workers results are in flight at once, so memory stays bounded
+    when the consumer is slower than the workers.
+
+    Args:
+        func (Callable[[T], R]): The function to apply
+        items (Iterable[T]): The items to apply the function to
+        max_workers (int): The number of worker threads
+
+    Yields:
+        Iterator[R]: The results, in the same order as the items
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
 
 class PipS3:
     """PipS3
@@ -34,24 +226,97 @@ class PipS3:
         endpoint (str): The storage endpoint e.g. https://some-bucket.s3-website-ap-southeast-2.amazonaws.com
         bucket (str): The name of the bucket storing the build artifacts
         prefix (str, optional): The prefix to apply to all s3 keys. Defaults to 'simple'
-        s3_client (boto3.Session.client, optional): A boto3 S3 session client. Defaults to None, whereby a new
-            sesion client will be created using the standard AWS
+        s3_client (boto3.Session.client, optional): A boto3 S3 session client. Defaults to None, whereby a
+            client shared across the process is created on first use with the standard AWS
             [credentials configuration](https://boto3.amazonaws.com/v1/documentation/api/latest/guide/configuration.html)
+        max_workers (int, optional): The number of concurrent requests used by parallel operations such as
+            listing the whole repository. Defaults to 1, for sequential operation.
+        gzip_index (bool, optional): Set to True to store index pages gzip compressed with
+            Content-Encoding: gzip. Defaults to False.
+        index_cache_control (str, optional): The Cache-Control header of index pages e.g. 'max-age=300'.
+            Defaults to None, for no header.
+        artifact_cache_control (str, optional): The Cache-Control header of package and metadata files,
+            which never change once published e.g. 'public, max-age=31536000, immutable'.
+            Defaults to None, for no header.
+        conditional_writes (bool, optional): Set to True to upload packages with If-None-Match: *,
+            so that checking for and creating a package is a single, race free request. Requires a
+            store that supports conditional writes. Defaults to False, to check with HEAD requests.
+        part_size (int, optional): The multipart part size of package uploads, in bytes. Defaults
+            to None, where it is chosen from the size of each package and the measured throughput.
+        max_concurrency (int, optional): The number of concurrent part uploads of each package.
+            Defaults to None, where it is chosen from the number of parts.
+        max_pool_connections (int, optional): The connection pool size of the shared client, when
+            no s3_client is given. Defaults to None, sized to max_workers and max_concurrency.
+        region_name (str, optional): The region of the bucket, when no s3_client is given.
+            Defaults to None, where the region is discovered from the bucket and cached on disk.
+        coalesce_window (float, optional): Coordinate concurrent publishers of the same project
+            through a generation object, so one writer renders the index after waiting this many
+            seconds and the others skip their write. Requires a store that supports conditional
+            writes. Defaults to None, where every publisher writes the index.
     """
     def __init__(
         self,
         endpoint: str,
         bucket: str,
         prefix: str = 'simple',  # The pypi default https://pypi.org/simple
-        s3_client: Union[boto3.Session.client, None] = None,
+        s3_client: Union['boto3.Session.client', None] = None,
+        max_workers: int = 1,
+        gzip_index: bool = False,
+        index_cache_control: Union[str, None] = None,
+        artifact_cache_control: Union[str, None] = None,
+        conditional_writes: bool = False,
+        part_size: Union[int, None] = None,
+        max_concurrency: Union[int, None] = None,
+        max_pool_connections: Union[int, None] = None,
+        region_name: Union[str, None] = None,
+        coalesce_window: Union[float, None] = None,
     ):
         self.endpoint = endpoint
         self.bucket = bucket
         self.prefix = prefix
+        self.max_workers = max_workers
+        self.gzip_index = gzip_index
+        self.index_cache_control = index_cache_control
+        self.artifact_cache_control = artifact_cache_control
+        self.conditional_writes = conditional_writes
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self.max_pool_connections = max_pool_connections
+        self.region_name = region_name
+        self.coalesce_window = coalesce_window
+        self._writer_id = uuid.uuid4().hex
+        self._throughput = None
+        self._throughput_lock = threading.Lock()
+        self._manifests = {}
+        self._projects = None
+        self._projects_stored = False
+        self.report = PublishReport()
+        self._s3_client = s3_client
+        if s3_client is not None:
+            register_conditional_headers(s3_client)
+
+    @property
+    def s3_client(self) -> 'boto3.Session.client':
+        """The S3 client, shared through get_s3_client on first use if none was given
+
+        The client is built for the region of the bucket, avoiding a redirect and retry of
+        every request when the default region differs.
+        """
+        if self._s3_client is None:
+            region_name = self.region_name
+            if region_name is None:
+                region_name = get_bucket_region(self.bucket, get_s3_client())
+
+            max_pool_connections = self.max_pool_connections
+            if max_pool_connections is None:
+                max_pool_connections = max(
+                    self.max_workers, self.max_concurrency or MAX_CONCURRENCY)
 
-        if s3_client is None:
-            s3_client = boto3.client('s3')
-        self.s3_client = s3_client
+            self._s3_client = get_s3_client(
+                region_name=region_name,
+                max_pool_connections=max_pool_connections)
+            register_conditional_headers(self._s3_client)
+        return self._s3_client
 
     @staticmethod
     def find_package_files(
@@ -80,47 +345,374 @@ class PipS3:
         for pref in glob(search_str):
             yield pref
 
-    def list_keys(
+    def _listing_prefix(self, package_name: Union[str, None] = None) -> str:
+        """The S3 prefix containing the files of a project, or of all projects"""
+        if package_name is None:
+            return f"{self.prefix}/"
+        return f"{self.prefix}/{package_name}/"
+
+    def _paginate(self, **kwargs) -> Iterator[dict]:
+        """Iterate over the responses of list_objects_v2 without recursion
+
+        Args:
+            **kwargs: The arguments to pass to list_objects_v2, excluding the bucket
+
+        Yields:
+            Iterator[dict]: The list_objects_v2 responses
+        """
+        while True:
+            response = self.s3_client.list_objects_v2(Bucket=self.bucket,
+                                                      **kwargs)
+            yield response
+
+            if 'NextContinuationToken' not in response:
+                return
+
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+    def list_pages(
             self,
             max_keys: int = 1000,
             package_name: Union[str, None] = None,
-            continuation_token: Union[str, None] = None) -> Iterable[str]:
+            continuation_token: Union[str, None] = None,
+            checkpoint: Union[str, None] = None) -> Iterator[List[dict]]:
+        """List pages of objects in S3
+
+        Only a single page is held in memory at a time.  If a checkpoint is given, the continuation
+        token of the next page is saved once a page has been consumed, so an interrupted listing
+        restarts from the first page that was not fully processed.  The checkpoint is removed when
+        the listing completes.
+
+        Args:
+            max_keys (int, optional): The number of keys to retrieve per page. Defaults to 1000.
+            package_name (str, optional): List the keys for the specified project only. Defaults to None,
+            continuation_token (str, optional): The boto3 continuation token to start listing from.
+                Defaults to None, to start from the checkpoint if any, otherwise the first key.
+            checkpoint (str, optional): The path of a checkpoint file used to resume the listing.
+                Defaults to None.
+
+        Yields:
+            Iterator[List[dict]]: The object summaries returned by list_objects_v2 for each page
+        """
+
+        prefix = self._listing_prefix(package_name)
+        listing_checkpoint = None if checkpoint is None else ListingCheckpoint(
+            checkpoint)
+
+        if continuation_token is None and listing_checkpoint is not None:
+            continuation_token = listing_checkpoint.load(self.bucket, prefix)
+
+        kwargs = {"Prefix": prefix, "MaxKeys": max_keys}
+        if continuation_token is not None:
+            kwargs['ContinuationToken'] = continuation_token
+
+        logger.info("Listing objects in s3://%s/%s", self.bucket, prefix)
+        for response in self._paginate(**kwargs):
+            yield response.get('Contents', [])
+
+            if listing_checkpoint is not None and 'NextContinuationToken' in response:
+                listing_checkpoint.save(self.bucket, prefix,
+                                        response['NextContinuationToken'])
+
+        if listing_checkpoint is not None:
+            listing_checkpoint.clear()
+
+    def list_projects(self, max_keys: int = 1000) -> Iterator[str]:
+        """List the projects in the repository
+
+        Projects are discovered from the common prefixes of a delimited listing, so the artifact
+        keys of each project are never enumerated.
+
+        Args:
+            max_keys (int, optional): The number of prefixes to retrieve per page. Defaults to 1000.
+
+        Yields:
+            Iterator[str]: The project names, in S3 key order
+        """
+        prefix = self._listing_prefix()
+        logger.info("Listing projects in s3://%s/%s", self.bucket, prefix)
+
+        for response in self._paginate(Prefix=prefix,
+                                       Delimiter='/',
+                                       MaxKeys=max_keys):
+            for common_prefix in response.get('CommonPrefixes', []):
+                yield common_prefix['Prefix'][len(prefix):].rstrip('/')
+
+    def _list_objects_parallel(self, max_keys: int,
+                               max_workers: int) -> Iterator[dict]:
+        """List every project concurrently, merging the results in S3 key order"""
+        prefix = self._listing_prefix()
+        top_level = []
+        projects = []
+
+        for response in self._paginate(Prefix=prefix,
+                                       Delimiter='/',
+                                       MaxKeys=max_keys):
+            top_level.extend(response.get('Contents', []))
+            projects.extend(common_prefix['Prefix'][len(prefix):].rstrip('/')
+                            for common_prefix in response.get(
+                                'CommonPrefixes', []))
+
+        def list_project(project: str) -> List[dict]:
+            return list(
+                self.list_objects(max_keys=max_keys,
+                                  package_name=project,
+                                  max_workers=1))
+
+        project_objects = (obj for objects in _ordered_map(
+            list_project, projects, max_workers) for obj in objects)
+
+        yield from heapq.merge(top_level,
+                               project_objects,
+                               key=lambda obj: obj['Key'])
+
+    def _first_key_after(self,
+                         prefix: str,
+                         start_after: str,
+                         upper: Union[str, None] = None) -> Union[str, None]:
+        """Probe for the first key after a StartAfter value with a single key listing"""
+        response = self.s3_client.list_objects_v2(Bucket=self.bucket,
+                                                  Prefix=prefix,
+                                                  MaxKeys=1,
+                                                  StartAfter=start_after)
+        contents = response.get('Contents', [])
+        if not contents or (upper is not None and contents[0]['Key'] > upper):
+            return None
+        return contents[0]['Key']
+
+    def _list_objects_sharded(self, package_name: str, max_keys: int,
+                              max_workers: int) -> Iterator[dict]:
+        """List a single project by splitting its keyspace into concurrently listed ranges
+
+        The first page is listed normally, then the keys after it are split into ranges at
+        points spread across the whole keyspace with _split_points.  Each range (lower, upper]
+        is listed from StartAfter=lower until a key passes upper.  A worker that runs out of
+        ranges splits the range that has been listing the longest at its current position, so
+        the listing stays balanced however the keys are distributed.
+        """
+        prefix = self._listing_prefix(package_name)
+        logger.info("Listing objects in s3://%s/%s", self.bucket, prefix)
+
+        first_page = self.s3_client.list_objects_v2(Bucket=self.bucket,
+                                                    Prefix=prefix,
+                                                    MaxKeys=max_keys)
+        sample = first_page.get('Contents', [])
+        yield from sample
+
+        if 'NextContinuationToken' not in first_page:
+            return
+
+        last_key = sample[-1]['Key']
+        split_points = _split_points(
+            lambda start_after: self._first_key_after(prefix, start_after),
+            prefix, last_key, max_workers - 1)
+        ranges = [
+            _KeyRange(lower, upper)
+            for lower, upper in zip([last_key] + split_points, split_points +
+                                    [None])
+        ]
+        queue = deque(ranges)
+        condition = threading.Condition()
+        started = itertools.count()
+        errors = []
+
+        def list_range(key_range: _KeyRange):
+            for response in self._paginate(Prefix=prefix,
+                                           MaxKeys=max_keys,
+                                           StartAfter=key_range.lower):
+                with condition:
+                    for obj in response.get('Contents', []):
+                        if (key_range.upper is not None
+                                and obj['Key'] > key_range.upper):
+                            return
+                        key_range.objects.append(obj)
+                        key_range.position = obj['Key']
+
+        def split() -> Union[_KeyRange, None]:
+            while True:
+                with condition:
+                    running = [
+                        key_range for key_range in ranges
+                        if key_range.started is not None and not key_range.done
+                        and key_range.splittable
+                    ]
+                    if not running:
+                        return None
+
+                    victim = min(running, key=lambda key_range: key_range.started)
+                    position, upper = victim.position, victim.upper
+
+                points = _split_points(
+                    lambda start_after: self._first_key_after(
+                        prefix, start_after, upper), prefix, position, 1)
+
+                with condition:
+                    if not points:
+                        victim.splittable = False
+                    elif (not victim.done and victim.upper == upper
+                          and victim.position < points[0]):
+                        key_range = _KeyRange(points[0], upper)
+                        key_range.started = next(started)
+                        victim.upper = points[0]
+                        ranges.insert(ranges.index(victim) + 1, key_range)
+                        return key_range
+
+        def work():
+            try:
+                while True:
+                    with condition:
+                        key_range = queue.popleft() if queue else None
+                        if key_range is not None:
+                            key_range.started = next(started)
+
+                    if key_range is None:
+                        key_range = split()
+                        if key_range is None:
+                            return
+
+                    list_range(key_range)
+                    with condition:
+                        key_range.done = True
+                        condition.notify_all()
+
+            except Exception as error:
+                with condition:
+                    errors.append(error)
+                    condition.notify_all()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for _ in range(max_workers):
+                executor.submit(work)
+
+            index = 0
+            while True:
+                with condition:
+                    condition.wait_for(lambda: errors or index >= len(ranges)
+                                       or ranges[index].done)
+                    if errors:
+                        raise errors[0]
+                    if index >= len(ranges):
+                        break
+                    objects = ranges[index].objects
+                    ranges[index].objects = []
+
+                for obj in objects:
+                    # Ranges are disjoint, but never yield a key twice or out of order
+                    if obj['Key'] > last_key:
+                        last_key = obj['Key']
+                        yield obj
+                index += 1
+
+    def list_objects(self,
+                     max_keys: int = 1000,
+                     package_name: Union[str, None] = None,
+                     continuation_token: Union[str, None] = None,
+                     checkpoint: Union[str, None] = None,
+                     max_workers: Union[int, None] = None) -> Iterator[dict]:
+        """List object summaries in S3
+
+        When listing the whole repository with more than one worker, the projects are discovered
+        with a delimited listing and each project is listed concurrently.  When listing a single
+        project, its keyspace is split into lexicographic ranges that are listed concurrently.
+        Either way the results are merged back into S3 key order.  Resumed and checkpointed
+        listings are always sequential.
+
+        Args:
+            max_keys (int, optional): The number of keys to retrieve per page. Defaults to 1000.
+            package_name (str, optional): List the keys for the specified project only. Defaults to None,
+            continuation_token (str, optional): The boto3 continuation token to start listing from. Defaults to None.
+            checkpoint (str, optional): The path of a checkpoint file used to resume the listing. Defaults to None.
+            max_workers (int, optional): The number of concurrent listings. Defaults to None, to use the
+                max_workers of this instance.
+
+        Yields:
+            Iterator[dict]: The object summaries, including Key, Size, ETag and LastModified
+        """
+        max_workers = self.max_workers if max_workers is None else max_workers
+
+        if max_workers > 1 and continuation_token is None and checkpoint is None:
+            if package_name is None:
+                yield from self._list_objects_parallel(max_keys, max_workers)
+            else:
+                yield from self._list_objects_sharded(package_name, max_keys,
+                                                      max_workers)
+            return
+
+        for page in self.list_pages(max_keys=max_keys,
+                                    package_name=package_name,
+                                    continuation_token=continuation_token,
+                                    checkpoint=checkpoint):
+            yield from page
+
+    def list_keys(self,
+                  max_keys: int = 1000,
+                  package_name: Union[str, None] = None,
+                  continuation_token: Union[str, None] = None,
+                  checkpoint: Union[str, None] = None,
+                  max_workers: Union[int, None] = None) -> Iterable[str]:
         """List keys in S3
 
         Args:
             max_keys (int, optional): The number of keys to retrieve per attempt. Defaults to 1000.
             package_name (str, optional): List the keys for the specified project only. Defaults to None,
-            continuation_token (str, optional): The boto3 continuation token for the next series of responses. Defaults to 1000.
+            continuation_token (str, optional): The boto3 continuation token for the next series of responses. Defaults to None.
+            checkpoint (str, optional): The path of a checkpoint file used to resume the listing. Defaults to None.
+            max_workers (int, optional): The number of concurrent listings. Defaults to None, to use the
+                max_workers of this instance.
 
         Yields:
             Iterable[str]: The paths to the keys in the bucket
         """
+        for obj in self.list_objects(max_keys=max_keys,
+                                     package_name=package_name,
+                                     continuation_token=continuation_token,
+                                     checkpoint=checkpoint,
+                                     max_workers=max_workers):
+            yield obj["Key"]
 
-        kwargs = {
-            "Bucket": self.bucket,
-            "Prefix": self.prefix
-            if package_name is None else f"{self.prefix}/{package_name}",
-            "MaxKeys": max_keys,
-        }
-        if continuation_token is not None:
-            kwargs['ContinuationToken'] = continuation_token
+    def _index_links(
+        self,
+        keys: Union[Iterable[str], None] = None,
+        package_name: Union[str, None] = None,
+        manifest: Union[Manifest, None] = None,
+    ) -> Iterator[Tuple[str, str, Dict[str, str]]]:
+        """The url, text and attributes of each link in the index of a project
+
+        Links generated from a manifest carry the #sha256= fragment of each file with a
+        known hash, and the PEP 658 / PEP 714 core metadata and Requires-Python attributes.
+        """
+        if manifest is not None:
+            prefix = self._listing_prefix(manifest.project)
+            for record in manifest:
+                url = f"{self.endpoint}/{prefix}{record['filename']}"
+                if record.get('sha256') is not None:
+                    url += f"#sha256={record['sha256']}"
+
+                attributes = {}
+                if record.get('metadata_sha256') is not None:
+                    metadata_hash = f"sha256={record['metadata_sha256']}"
+                    attributes['data-core-metadata'] = metadata_hash
+                    attributes['data-dist-info-metadata'] = metadata_hash
+                if record.get('requires_python') is not None:
+                    attributes['data-requires-python'] = record[
+                        'requires_python']
 
-        logger.info("Listing objects in s3://%s/%s", self.bucket, self.prefix)
-        response = self.s3_client.list_objects_v2(**kwargs)
+                yield url, record['filename'], attributes
+            return
 
-        for key in response['Contents']:
-            yield key["Key"]
+        raw_keys = self.list_keys(
+            package_name=package_name) if keys is None else keys
 
-        if 'NextContinuationToken' in response:
-            for key in self.list_keys(
-                    max_keys=max_keys,
-                    continuation_token=response['NextContinuationToken']):
-                yield key
+        for key in raw_keys:
+            basename = os.path.basename(key)
+            if is_artifact(basename):
+                yield f"{self.endpoint}/{key}", basename, {}
 
     def generate_index(
         self,
         keys: Union[Iterable[str], None] = None,
         package_name: Union[str, None] = None,
+        manifest: Union[Manifest, None] = None,
     ) -> str:
         """Generate a pypi index file
 
@@ -129,28 +721,285 @@ class PipS3:
                 Defaults to None.  If set to None, a list of S3 keys will be generated.
             package_name (Union[str, None], optional): The package name.  If set to None,
                 an index of all packages is generated
+            manifest (Union[Manifest, None], optional): The manifest of the project.  If set,
+                the index is generated from the manifest without listing the bucket.
 
         Returns:
             str: The rendered template
         """
+        return ''.join(
+            iter_html_index(self._index_links(keys, package_name, manifest)))
 
-        raw_keys = self.list_keys(
-            package_name=package_name) if keys is None else keys
+    def write_index(
+        self,
+        sink: BinaryIO,
+        keys: Union[Iterable[str], None] = None,
+        package_name: Union[str, None] = None,
+        manifest: Union[Manifest, None] = None,
+    ) -> int:
+        """Render a pypi index file straight into a binary file-like object
+
+        Args:
+            sink (BinaryIO): The file-like object to write the UTF-8 encoded index to
+            keys (Union[Iterable[str], None], optional): The keys of the s3 bucket.
+                Defaults to None.  If set to None, a list of S3 keys will be generated.
+            package_name (Union[str, None], optional): The package name.  If set to None,
+                an index of all packages is generated
+            manifest (Union[Manifest, None], optional): The manifest of the project.  If set,
+                the index is generated from the manifest without listing the bucket.
+
+        Returns:
+            int: The number of bytes written
+        """
+        return write_chunks(
+            iter_html_index(self._index_links(keys, package_name, manifest)),
+            sink)
 
-        template = INDEX_TEMPLATE_INTO
+    def _json_index_chunks(self,
+                           package_name: Union[str, None] = None,
+                           manifest: Union[Manifest, None] = None
+                           ) -> Iterator[str]:
+        """The chunks of the PEP 691 JSON index of a project"""
+        if manifest is None:
+            manifest = Manifest.from_objects(
+                package_name, self.list_objects(package_name=package_name))
 
-        for key in raw_keys:
-            basename = os.path.basename(key)
-            template += f"\n    <a href=\"{self.endpoint}/{key}\">{basename}</a>"
+        prefix = self._listing_prefix(manifest.project)
+        versions = set()
+
+        def files() -> Iterator[dict]:
+            for record in manifest:
+                hashes = {} if record.get('sha256') is None else {
+                    'sha256': record['sha256']
+                }
+                versions.add(get_package_version(record['filename']))
+                entry = {
+                    'filename': record['filename'],
+                    'url': f"{self.endpoint}/{prefix}{record['filename']}",
+                    'hashes': hashes,
+                    'size': record['size'],
+                    'upload-time': record['upload_time'],
+                }
+
+                if record.get('metadata_sha256') is not None:
+                    metadata_hashes = {'sha256': record['metadata_sha256']}
+                    entry['core-metadata'] = metadata_hashes
+                    entry['dist-info-metadata'] = metadata_hashes
+                if record.get('requires_python') is not None:
+                    entry['requires-python'] = record['requires_python']
+
+                yield entry
+
+        return iter_json_index(manifest.project, files(), versions)
+
+    def generate_json_index(
+        self,
+        package_name: Union[str, None] = None,
+        manifest: Union[Manifest, None] = None,
+    ) -> str:
+        """Generate a PEP 691 JSON index file for a project
+
+        Args:
+            package_name (Union[str, None], optional): The package name.  Required unless a
+                manifest is given.
+            manifest (Union[Manifest, None], optional): The manifest of the project.  Defaults to
+                None, where the sizes and upload times are taken from a listing of the project.
+
+        Returns:
+            str: The rendered JSON
+        """
+        return ''.join(self._json_index_chunks(package_name, manifest))
+
+    def write_json_index(
+        self,
+        sink: BinaryIO,
+        package_name: Union[str, None] = None,
+        manifest: Union[Manifest, None] = None,
+    ) -> int:
+        """Render a PEP 691 JSON index file straight into a binary file-like object
+
+        Args:
+            sink (BinaryIO): The file-like object to write the UTF-8 encoded index to
+            package_name (Union[str, None], optional): The package name.  Required unless a
+                manifest is given.
+            manifest (Union[Manifest, None], optional): The manifest of the project.  Defaults to
+                None, where the sizes and upload times are taken from a listing of the project.
+
+        Returns:
+            int: The number of bytes written
+        """
+        return write_chunks(self._json_index_chunks(package_name, manifest),
+                            sink)
+
+    def generate_root_index(self, projects: Iterable[str]) -> str:
+        """Generate the root pypi index file, linking to each project
+
+        Args:
+            projects (Iterable[str]): The names of the projects
+
+        Returns:
+            str: The rendered template
+        """
+        return ''.join(iter_html_index(self._root_index_links(projects)))
+
+    def _root_index_links(
+            self,
+            projects: Iterable[str]) -> Iterator[Tuple[str, str, Dict[str, str]]]:
+        """The url, text and attributes of each link in the root index"""
+        for project in sorted(projects):
+            yield f"{self.endpoint}/{self.prefix}/{project}/", project, {}
+
+    def inventory(self,
+                  package_name: str,
+                  legacy_names: Iterable[str] = ()) -> Dict[str, dict]:
+        """List the files of a project with a single prefix listing
+
+        Publishing relies on listings, so the credentials need s3:ListBucket.  Without it S3
+        answers a HEAD request for a missing key with 403 rather than 404, so a missing file
+        cannot be told apart from one that is not accessible.
+
+        Earlier versions published sdists under their unnormalized name e.g. simple/my_pkg/.
+        The files under each legacy prefix are included, with a warning, so that a file is
+        never published again under the normalized prefix.
+
+        Args:
+            package_name (str): The name of the package
+            legacy_names (Iterable[str], optional): Unnormalized names the project may have
+                been published under, e.g. from legacy_names. Defaults to ().
+
+        Returns:
+            Dict[str, dict]: The object summaries keyed by filename
+        """
+        objects = {
+            os.path.basename(obj['Key']): obj
+            for obj in self.list_objects(package_name=package_name)
+        }
+
+        for legacy_name in legacy_names:
+            if legacy_name == package_name:
+                continue
 
-        template += INDEX_TEMPLATE_OUTTRO
-        return template
+            legacy = list(self.list_objects(package_name=legacy_name))
+            if legacy:
+                logger.warning(
+                    "Project %s also has files under the legacy prefix %s, which are "
+                    "checked but not indexed", package_name,
+                    self._listing_prefix(legacy_name))
+
+            for obj in legacy:
+                objects.setdefault(os.path.basename(obj['Key']), obj)
+
+        return objects
+
+    def _head_exists(self, key: str) -> bool:
+        """Check if an object exists with a HEAD request
+
+        Only a 404 is taken to mean the object does not exist; any other error, such as
+        access denied or throttling, is raised.  A missing object is only reported as a 404
+        if the credentials have s3:ListBucket.
+        """
+        try:
+            self.s3_client.head_object(Bucket=self.bucket, Key=key)
+        except self.s3_client.exceptions.ClientError as error:
+            if _is_not_found(error):
+                return False
+            raise
+
+        return True
+
+    def _part_sizes(self,
+                    size: int,
+                    parts: int,
+                    stored: Union[int, None] = None) -> List[int]:
+        """The part sizes a file of a given size may have been uploaded in
+
+        Args:
+            size (int): The size of the file
+            parts (int): The number of parts, from the ETag of the object
+            stored (Union[int, None], optional): The part size recorded in the metadata of the
+                object by upload_package. Defaults to None.
+
+        Returns:
+            List[int]: The part sizes giving that number of parts, most likely first: the
+                recorded part size, the part size this instance would choose, the smallest
+                whole MiB part size, then the transfer manager's 8 MiB default and S3's 5 MiB
+                minimum
+        """
+        candidates = [
+            stored or 0,
+            self.transfer_config(size).multipart_chunksize,
+            -(-size // parts // 2**20) * 2**20,
+            MIN_PART_SIZE,
+            5 * 1024 * 1024,
+        ]
+
+        part_sizes = []
+        for part_size in candidates:
+            if (part_size > 0 and -(-size // part_size) == parts
+                    and part_size not in part_sizes):
+                part_sizes.append(part_size)
+
+        return part_sizes
+
+    def _stored_part_size(self, key: str) -> Union[int, None]:
+        """The part size recorded in the metadata of a package file, if any"""
+        response = self.s3_client.head_object(Bucket=self.bucket, Key=key)
+        try:
+            return int(response.get('Metadata', {})[PART_SIZE_METADATA])
+        except (KeyError, ValueError):
+            return None
+
+    def is_identical(self,
+                     pkg_path: str,
+                     obj: dict,
+                     record: Union[dict, None] = None) -> bool:
+        """Check if a local file has the same content as a stored object
+
+        If the manifest record of the object has a sha256, the sha256 of the file is compared
+        to it, which works whatever the encryption and part size of the object.  Otherwise the
+        ETag is compared.  The ETag of an object uploaded in a single request is the MD5 of its
+        content.  The ETag of a multipart upload is the MD5 of the MD5s of its parts, followed
+        by the number of parts, so the file is hashed with the part size recorded by
+        upload_package, or failing that with each standard part size that gives that number of
+        parts.  Objects encrypted with SSE-KMS or SSE-C do not have MD5 ETags, so only match by
+        sha256.
+
+        Args:
+            pkg_path (str): The path to the local file
+            obj (dict): The object summary, with Key, Size and ETag, from a listing
+            record (Union[dict, None], optional): The manifest record of the object. Defaults
+                to None.
+
+        Returns:
+            bool: True if the file and the object have the same size and content
+        """
+        size = os.path.getsize(pkg_path)
+        if size != obj['Size']:
+            return False
+
+        if record is not None and record.get('sha256') is not None:
+            return file_sha256(pkg_path) == record['sha256']
+
+        etag = obj['ETag'].strip('"')
+        if '-' not in etag:
+            return file_etag(pkg_path) == etag
+
+        try:
+            parts = int(etag.rsplit('-', 1)[1])
+        except ValueError:
+            return False
+
+        stored = self._stored_part_size(obj['Key'])
+        return any(
+            file_etag(pkg_path, part_size) == etag
+            for part_size in self._part_sizes(size, parts, stored))
 
     def upload_package(self,
                        pkg_path: str,
                        package_name: str,
                        public: bool = False,
-                       owner_full_control: bool = False):
+                       owner_full_control: bool = False,
+                       existing: Union[Container[str], None] = None) -> dict:
         """Upload the package to S3
 
         Args:
@@ -158,80 +1007,1333 @@ class PipS3:
             package_name (str): The name of the package
             public (bool): Set to True to enable Public Read ACL in S3
             owner_full_control (bool, optional): Set to True to provide bucket owner full control.  Defaults to False.
+            existing (Union[Container[str], None], optional): The filenames already published for
+                the project, e.g. from inventory.  Defaults to None, where a HEAD request checks
+                if the file exists.  Ignored when conditional_writes is set.
+
+        Returns:
+            dict: The manifest record of the uploaded file
+
         Raises:
             PackageExistsException: If a package file with the same name
                 already exists for this project
         """
 
-        key = os.path.join(self.prefix, package_name,
-                           os.path.basename(pkg_path))
-        logger.info("Uploading %s to s3://%s/%s", pkg_path, self.bucket, key)
+        filename = os.path.basename(pkg_path)
+        key = f"{self._listing_prefix(package_name)}{filename}"
 
         # If the file already exists, do not override
-        try:
-            self.s3_client.head_object(Bucket=self.bucket, Key=key)
+        if self.conditional_writes:
+            exists = False
+        elif existing is None:
+            exists = self._head_exists(key)
+        else:
+            exists = filename in existing
 
-        # The files does not exist we can upload
-        except self.s3_client.exceptions.ClientError:
+        if exists:
+            raise PackageExistsException(
+                "Package %s already exists in the S3 Bucket for the project %s",
+                filename, package_name)
 
-            extra_args = {}
-            if public:
-                extra_args["ACL"] = "public-read"
+        logger.info("Uploading %s to s3://%s/%s", pkg_path, self.bucket, key)
 
-            if owner_full_control:
-                extra_args["ACL"] = "bucket-owner-full-control"
+        extra_args = {}
+        if public:
+            extra_args["ACL"] = "public-read"
 
-            self.s3_client.upload_file(pkg_path,
-                                       self.bucket,
-                                       key,
-                                       ExtraArgs=extra_args)
-            return
+        if owner_full_control:
+            extra_args["ACL"] = "bucket-owner-full-control"
 
-        raise PackageExistsException(
-            "Package %s already exists in the S3 Bucket for the project %s",
-            os.path.basename(pkg_path), package_name)
+        if self.artifact_cache_control is not None:
+            extra_args["CacheControl"] = self.artifact_cache_control
 
-    def upload_index(self,
-                     package_name: Union[str, None] = None,
-                     index: Union[str, None] = None,
-                     public: bool = False,
-                     owner_full_control: bool = False):
-        """Upload the index file
+        size = os.path.getsize(pkg_path)
+        config = self.transfer_config(size)
+        if size >= config.multipart_threshold:
+            extra_args["Metadata"] = {
+                PART_SIZE_METADATA: str(config.multipart_chunksize)
+            }
 
-        Args:
-            package_name (Union[str, None], optional): The name of the package. Defaults to None
-            index (Union[str, None], optional): The contents of the index file. Defaults
-                to None, where an index file will be automatically generated.
-            public (bool, optional): Set to True to enable Public Read ACL in S3.  Defaults to False
-            owner_full_control (bool, optional): Set to True to provide bucket owner full control.  Defaults to False.
-        """
-        generated_index = self.generate_index(
-            package_name=package_name) if index is None else index
-        key = f'{self.prefix}/{package_name}/index.html'
-        logger.info("Uploading index to s3://%s/%s", self.bucket, key)
+        self.report.transfer(filename,
+                             size=size,
+                             part_size=config.multipart_chunksize,
+                             concurrency=config.max_concurrency)
+        start = time.perf_counter()
 
-        acl = 'bucket-owner-full-control' if owner_full_control else ''
-        if public:
-            acl = 'public-read'
+        # Hash the file in the same pass that uploads it
+        with open(pkg_path, 'rb') as pkg_file:
+            reader = _HashingReader(pkg_file)
 
-        self.s3_client.put_object(Bucket=self.bucket,
-                                  Key=key,
-                                  Body=generated_index.encode('utf-8'),
-                                  ACL=acl,
-                                  ContentType="text/html")
+            if not self.conditional_writes:
+                self.s3_client.upload_fileobj(reader,
+                                              self.bucket,
+                                              key,
+                                              ExtraArgs=extra_args,
+                                              Config=config)
 
+            else:
+                try:
+                    self._upload_if_absent(reader, key, size, extra_args,
+                                           config)
+                except self.s3_client.exceptions.ClientError as error:
+                    if error.response.get('Error',
+                                          {}).get('Code') not in (
+                                              '412', 'PreconditionFailed'):
+                        raise
 
-def get_package_name(upload_file: str) -> str:
-    """determine the package name from the artifacts to be uploaded. According to pypi,
-    if upload_file is a tar.gz, then the package name is already canonical.
-    if upload_file is a whl, then we need to replace _ with -.
-    See tests for examples.
+                    raise PackageExistsException(
+                        "Package %s already exists in the S3 Bucket for the project %s",
+                        filename, package_name) from error
 
-    Args:
-        upload_file (str): path to the artifacts, tar.gz or whl
+        self._measure(size, time.perf_counter() - start, config)
+        self.report.count('uploads')
 
-    Returns:
-        str: package name
+        return {
+            'filename': filename,
+            'size': reader.size,
+            'sha256': reader.sha256.hexdigest(),
+            'upload_time': format_time(),
+        }
+
+    def transfer_config(self, size: int) -> 'TransferConfig':
+        """Choose the multipart transfer settings of a package upload
+
+        The part size is chosen so that each part of a package takes about TARGET_PART_SECONDS
+        to upload at the throughput measured from earlier uploads, or before any upload has
+        been measured, so that the package is split into about TARGET_PARTS parts.  Parts are
+        never smaller than MIN_PART_SIZE and never so small that the package needs more than
+        MAX_PARTS parts.  The concurrency is the number of parts, up to MAX_CONCURRENCY.  The
+        part_size and max_concurrency options override the adaptive choices.  At most
+        max_concurrency parts of a file are held in memory.
+
+        Args:
+            size (int): The size of the package file in bytes
+
+        Returns:
+            TransferConfig: The transfer settings of the upload
+        """
+        part_size = self.part_size
+        if part_size is None:
+            with self._throughput_lock:
+                throughput = self._throughput
+
+            if throughput is None:
+                part_size = size // TARGET_PARTS
+            else:
+                part_size = int(throughput * TARGET_PART_SECONDS)
+
+            part_size = max(part_size, MIN_PART_SIZE, -(-size // MAX_PARTS))
+
+            # Round up to a whole MiB, which keeps part sizes readable in the report
+            part_size = min(-(-part_size // 2**20) * 2**20, MAX_PART_SIZE)
+
+        max_concurrency = self.max_concurrency
+        if max_concurrency is None:
+            max_concurrency = max(1, min(-(-size // part_size),
+                                         MAX_CONCURRENCY))
+
+        from boto3.s3.transfer import TransferConfig
+
+        config = TransferConfig(multipart_threshold=part_size,
+                                multipart_chunksize=part_size,
+                                max_concurrency=max_concurrency)
+
+        # Package files are read through the non-seekable _HashingReader, for which the
+        # transfer manager buffers parts in memory, so buffer no more parts than are in flight.
+        # boto3 does not take this setting as an argument, but passes it to s3transfer
+        config.max_in_memory_upload_chunks = max_concurrency
+        return config
+
+    def _measure(self, size: int, seconds: float, config: 'TransferConfig'):
+        """Record the throughput of a package upload, per connection
+
+        Only uploads of at least MIN_PART_SIZE are measured, since request latency dominates
+        smaller uploads.  Measurements are smoothed with an exponentially weighted average.
+
+        Args:
+            size (int): The number of bytes uploaded
+            seconds (float): The duration of the upload
+            config (TransferConfig): The transfer settings of the upload
+        """
+        if size < MIN_PART_SIZE or seconds <= 0:
+            return
+
+        parts = 1
+        if size >= config.multipart_threshold:
+            parts = -(-size // config.multipart_chunksize)
+
+        throughput = size / seconds / min(config.max_concurrency, parts)
+        with self._throughput_lock:
+            if self._throughput is None:
+                self._throughput = throughput
+            else:
+                self._throughput = 0.5 * self._throughput + 0.5 * throughput
+
+    def _upload_if_absent(self, reader: BinaryIO, key: str, size: int,
+                          extra_args: dict, config: 'TransferConfig'):
+        """Upload an object only if the key does not exist, using If-None-Match: *
+
+        Small objects are sent with a single conditional put_object.  Larger objects are
+        uploaded in parts on max_concurrency threads, holding at most max_concurrency parts in
+        memory, and the condition is applied when the multipart upload completes, in which case
+        the upload is aborted if the condition fails.
+
+        Args:
+            reader (BinaryIO): The file to read the body from
+            key (str): The key of the object
+            size (int): The size of the file
+            extra_args (dict): Additional put_object arguments e.g. ACL
+            config (TransferConfig): The multipart threshold, part size and concurrency
+
+        Raises:
+            botocore.exceptions.ClientError: With a 412 PreconditionFailed error code if the
+                key already exists
+        """
+        if size < config.multipart_threshold:
+            self.s3_client.put_object(Bucket=self.bucket,
+                                      Key=key,
+                                      Body=reader.read(),
+                                      IfNoneMatch='*',
+                                      **extra_args)
+            return
+
+        upload_id = self.s3_client.create_multipart_upload(
+            Bucket=self.bucket, Key=key, **extra_args)['UploadId']
+
+        # The reader is not seekable, so parts are read in order on this thread.  A part is
+        # only read once an earlier part has been uploaded, so at most max_concurrency parts
+        # are held in memory
+        buffered = threading.BoundedSemaphore(config.max_concurrency)
+
+        def read_parts() -> Iterator[Tuple[int, bytes]]:
+            for part_number in itertools.count(1):
+                buffered.acquire()
+                data = reader.read(config.multipart_chunksize)
+                if not data:
+                    buffered.release()
+                    return
+                yield part_number, data
+
+        def upload_part(part: Tuple[int, bytes]) -> dict:
+            part_number, data = part
+            try:
+                response = self.s3_client.upload_part(Bucket=self.bucket,
+                                                      Key=key,
+                                                      UploadId=upload_id,
+                                                      PartNumber=part_number,
+                                                      Body=data)
+            finally:
+                buffered.release()
+            return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+        try:
+            parts = list(
+                _ordered_map(upload_part, read_parts(),
+                             config.max_concurrency))
+
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts},
+                IfNoneMatch='*')
+
+        except Exception:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket,
+                                                  Key=key,
+                                                  UploadId=upload_id)
+            raise
+
+    def upload_metadata(self,
+                        pkg_path: str,
+                        package_name: str,
+                        public: bool = False,
+                        owner_full_control: bool = False,
+                        metadata: Union[bytes, None] = None) -> dict:
+        """Upload the PEP 658 core metadata of a package as <file>.metadata
+
+        Args:
+            pkg_path (str): The path to the package file
+            package_name (str): The name of the package
+            public (bool): Set to True to enable Public Read ACL in S3
+            owner_full_control (bool, optional): Set to True to provide bucket owner full control.  Defaults to False.
+            metadata (Union[bytes, None], optional): The metadata, if already extracted.
+                Defaults to None, where it is extracted from the package.
+
+        Returns:
+            dict: The metadata_sha256 and requires_python fields of the manifest record of the
+                package, or an empty dict if the package metadata could not be read
+        """
+        if metadata is None:
+            metadata = extract_metadata(pkg_path)
+
+        if metadata is None:
+            return {}
+
+        filename = os.path.basename(pkg_path)
+        key = f"{self._listing_prefix(package_name)}{filename}{METADATA_SUFFIX}"
+        logger.info("Uploading metadata to s3://%s/%s", self.bucket, key)
+
+        extra_args = {}
+        if self.artifact_cache_control is not None:
+            extra_args["CacheControl"] = self.artifact_cache_control
+
+        self.s3_client.put_object(Bucket=self.bucket,
+                                  Key=key,
+                                  Body=metadata,
+                                  ACL=_object_acl(public, owner_full_control),
+                                  ContentType="text/plain",
+                                  **extra_args)
+
+        return {
+            'metadata_sha256': hashlib.sha256(metadata).hexdigest(),
+            'requires_python': parse_requires_python(metadata),
+        }
+
+    def upload_index(self,
+                     package_name: Union[str, None] = None,
+                     index: Union[str, None] = None,
+                     public: bool = False,
+                     owner_full_control: bool = False,
+                     manifest: Union[Manifest, None] = None):
+        """Upload the index file
+
+        When the index is generated, a PEP 691 JSON index is generated from the same listing or
+        manifest and uploaded alongside it as index.json.
+
+        Args:
+            package_name (Union[str, None], optional): The name of the package. Defaults to None
+            index (Union[str, None], optional): The contents of the index file. Defaults
+                to None, where an index file will be automatically generated.
+            public (bool, optional): Set to True to enable Public Read ACL in S3.  Defaults to False
+            owner_full_control (bool, optional): Set to True to provide bucket owner full control.  Defaults to False.
+            manifest (Union[Manifest, None], optional): The manifest to generate the index from.
+                Defaults to None, where the project is listed.
+        """
+        acl = _object_acl(public, owner_full_control)
+
+        key = f'{self.prefix}/{package_name}/{INDEX_NAME}'
+        logger.info("Uploading index to s3://%s/%s", self.bucket, key)
+
+        if index is not None:
+            self._upload_rendered(key,
+                                  lambda sink: sink.write(index.encode('utf-8')),
+                                  "text/html",
+                                  acl,
+                                  index_page=True)
+            return
+
+        if manifest is None:
+            manifest = Manifest.from_objects(
+                package_name, self.list_objects(package_name=package_name))
+
+        self._upload_rendered(
+            key,
+            lambda sink: self.write_index(sink, manifest=manifest),
+            "text/html",
+            acl,
+            index_page=True)
+
+        key = f'{self.prefix}/{package_name}/{JSON_INDEX_NAME}'
+        logger.info("Uploading JSON index to s3://%s/%s", self.bucket, key)
+
+        self._upload_rendered(
+            key,
+            lambda sink: self.write_json_index(sink, manifest=manifest),
+            JSON_CONTENT_TYPE,
+            acl,
+            index_page=True)
+
+    def _upload_rendered(self,
+                         key: str,
+                         render: Callable[[BinaryIO], int],
+                         content_type: str,
+                         acl: str,
+                         index_page: bool = False) -> bool:
+        """Upload a rendered object, unless the stored object is already identical
+
+        The object is rendered into a spooled temporary file and hashed as it is written.  The
+        digest of the body and headers is stored in the object metadata, and the write is
+        skipped if the stored object carries the same digest.  Objects stored without a digest
+        are compared by ETag.
+
+        Index pages are gzip compressed if gzip_index is set, with a fixed timestamp so that
+        identical pages compress to identical bodies, and carry the index_cache_control header.
+
+        Small objects are uploaded with a single put_object, while objects above
+        INDEX_MULTIPART_THRESHOLD spill to disk and are uploaded in parts without being held
+        in memory.
+
+        Args:
+            key (str): The key of the object
+            render (Callable[[BinaryIO], int]): Writes the body into a sink, returning its size
+            content_type (str): The content type of the object
+            acl (str): The canned ACL of the object
+            index_page (bool, optional): Set to True for pages served to pip. Defaults to False.
+
+        Returns:
+            bool: True if the object was written, False if the write was skipped
+        """
+        headers = {"ContentType": content_type}
+        if index_page and self.gzip_index:
+            headers["ContentEncoding"] = "gzip"
+        if index_page and self.index_cache_control is not None:
+            headers["CacheControl"] = self.index_cache_control
+
+        with tempfile.SpooledTemporaryFile(
+                max_size=INDEX_MULTIPART_THRESHOLD) as body:
+            sink = _HashingWriter(body)
+
+            if "ContentEncoding" in headers:
+                with gzip.GzipFile(filename='', mode='wb', fileobj=sink,
+                                   mtime=0) as compressed:
+                    render(compressed)
+            else:
+                render(sink)
+
+            size = body.tell()
+            body.seek(0)
+
+            digest = hashlib.sha256("\n".join(
+                [sink.sha256.hexdigest(), acl] +
+                [f"{name}: {value}" for name, value in sorted(headers.items())
+                 ]).encode('utf-8')).hexdigest()
+
+            if self._is_unchanged(key, digest, sink.md5.hexdigest(),
+                                  content_type):
+                logger.info("Skipping unchanged s3://%s/%s", self.bucket, key)
+                self.report.count('writes_skipped')
+                return False
+
+            self.report.count('bytes_written', size)
+
+            if size < INDEX_MULTIPART_THRESHOLD:
+                self.s3_client.put_object(Bucket=self.bucket,
+                                          Key=key,
+                                          Body=body.read(),
+                                          ACL=acl,
+                                          Metadata={'digest': digest},
+                                          **headers)
+            else:
+                from boto3.s3.transfer import TransferConfig
+
+                extra_args = dict(headers, Metadata={'digest': digest})
+                if acl:
+                    extra_args["ACL"] = acl
+
+                self.s3_client.upload_fileobj(
+                    body,
+                    self.bucket,
+                    key,
+                    ExtraArgs=extra_args,
+                    Config=TransferConfig(
+                        multipart_threshold=INDEX_MULTIPART_THRESHOLD))
+
+        self.report.count('writes')
+        return True
+
+    def _is_unchanged(self, key: str, digest: str, md5: str,
+                      content_type: str) -> bool:
+        """Check if a stored object already has the given content"""
+        try:
+            stored = self.s3_client.head_object(Bucket=self.bucket, Key=key)
+        except self.s3_client.exceptions.ClientError as error:
+            if _is_not_found(error):
+                return False
+            raise
+
+        if 'digest' in stored.get('Metadata', {}):
+            return stored['Metadata']['digest'] == digest
+
+        return (stored['ETag'].strip('"') == md5
+                and stored.get('ContentType') == content_type)
+
+    def load_manifest(self, package_name: str) -> Manifest:
+        """Load the manifest of a project
+
+        Manifests are cached by this instance.  If the project has no manifest yet, one is
+        built from a listing of the project.
+
+        Args:
+            package_name (str): The name of the package
+
+        Returns:
+            Manifest: The manifest of the project
+        """
+        if package_name in self._manifests:
+            return self._manifests[package_name]
+
+        key = f'{self.prefix}/{package_name}/{MANIFEST_NAME}'
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=key)
+            manifest = Manifest.from_json(response['Body'].read())
+
+        except self.s3_client.exceptions.NoSuchKey:
+            logger.info("No manifest found at s3://%s/%s", self.bucket, key)
+            manifest = Manifest.from_objects(
+                package_name, self.list_objects(package_name=package_name))
+
+        self._manifests[package_name] = manifest
+        return manifest
+
+    def upload_manifest(self,
+                        manifest: Manifest,
+                        public: bool = False,
+                        owner_full_control: bool = False):
+        """Upload the manifest of a project
+
+        Args:
+            manifest (Manifest): The manifest to upload
+            public (bool, optional): Set to True to enable Public Read ACL in S3.  Defaults to False
+            owner_full_control (bool, optional): Set to True to provide bucket owner full control.  Defaults to False.
+        """
+        key = f'{self.prefix}/{manifest.project}/{MANIFEST_NAME}'
+        logger.info("Uploading manifest to s3://%s/%s", self.bucket, key)
+
+        self._upload_rendered(
+            key, lambda sink: sink.write(manifest.to_json()),
+            "application/json", _object_acl(public, owner_full_control))
+        self._manifests[manifest.project] = manifest
+
+    def update_manifest(self,
+                        package_name: str,
+                        records: Iterable[dict],
+                        public: bool = False,
+                        owner_full_control: bool = False) -> Manifest:
+        """Merge new file records into the manifest of a project and upload it
+
+        Args:
+            package_name (str): The name of the package
+            records (Iterable[dict]): The records of the files uploaded
+            public (bool, optional): Set to True to enable Public Read ACL in S3.  Defaults to False
+            owner_full_control (bool, optional): Set to True to provide bucket owner full control.  Defaults to False.
+
+        Returns:
+            Manifest: The updated manifest
+        """
+        manifest = self.load_manifest(package_name)
+        for record in records:
+            manifest.add(record)
+
+        self.upload_manifest(manifest, public, owner_full_control)
+        return manifest
+
+    def _conditional_update(self,
+                            key: str,
+                            update: Callable[[Union[bytes, None]], bytes],
+                            content_type: str,
+                            acl: Union[str, None] = None) -> bytes:
+        """Read, modify and write an object, retrying if another writer changed it meanwhile
+
+        The object is written with If-Match on the ETag that was read, or If-None-Match: * if it
+        did not exist, so concurrent updates are never lost.  Nothing is written if the update
+        leaves the body unchanged.
+
+        Args:
+            key (str): The key of the object
+            update (Callable[[Union[bytes, None]], bytes]): Given the current body, or None if
+                the object does not exist, returns the new body.  Called again on every retry.
+            content_type (str): The content type of the object
+            acl (Union[str, None], optional): The canned ACL of the object. Defaults to None.
+
+        Returns:
+            bytes: The body written
+        """
+        while True:
+            try:
+                response = self.s3_client.get_object(Bucket=self.bucket, Key=key)
+                body = response['Body'].read()
+                condition = {'IfMatch': response['ETag']}
+            except self.s3_client.exceptions.NoSuchKey:
+                body = None
+                condition = {'IfNoneMatch': '*'}
+
+            stored, body = body, update(body)
+            if body == stored:
+                self.report.count('writes_skipped')
+                return body
+
+            extra_args = {'ACL': acl} if acl else {}
+
+            try:
+                self.s3_client.put_object(Bucket=self.bucket,
+                                          Key=key,
+                                          Body=body,
+                                          ContentType=content_type,
+                                          **condition,
+                                          **extra_args)
+            except self.s3_client.exceptions.ClientError as error:
+                # Another writer changed or created the object since it was read
+                if not _is_not_found(error) and error.response.get(
+                        'Error', {}).get('Code') not in (
+                            '409', '412', 'PreconditionFailed',
+                            'ConditionalRequestConflict'):
+                    raise
+
+                logger.debug("s3://%s/%s changed while updating, retrying",
+                             self.bucket, key)
+                continue
+
+            self.report.count('writes')
+            return body
+
+    def commit_manifest(self,
+                        package_name: str,
+                        records: Iterable[dict],
+                        public: bool = False,
+                        owner_full_control: bool = False) -> Manifest:
+        """Merge new file records into the stored manifest with a conditional write
+
+        Unlike update_manifest, records added by concurrent publishers are never lost.
+
+        Args:
+            package_name (str): The name of the package
+            records (Iterable[dict]): The records of the files uploaded
+            public (bool, optional): Set to True to enable Public Read ACL in S3.  Defaults to False
+            owner_full_control (bool, optional): Set to True to provide bucket owner full control.  Defaults to False.
+
+        Returns:
+            Manifest: The updated manifest
+        """
+        records = list(records)
+
+        def update(body: Union[bytes, None]) -> bytes:
+            if body is None:
+                manifest = Manifest.from_objects(
+                    package_name, self.list_objects(package_name=package_name))
+            else:
+                manifest = Manifest.from_json(body)
+
+            for record in records:
+                manifest.add(record)
+            return manifest.to_json()
+
+        manifest = Manifest.from_json(
+            self._conditional_update(
+                f'{self.prefix}/{package_name}/{MANIFEST_NAME}', update,
+                "application/json", _object_acl(public, owner_full_control)))
+
+        self._manifests[package_name] = manifest
+        return manifest
+
+    def _generation(self, key: str) -> dict:
+        """Load the generation object of a project, or a new one if it does not exist"""
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=key)
+        except self.s3_client.exceptions.NoSuchKey:
+            return _new_generation()
+
+        return json.loads(response['Body'].read().decode('utf-8'))
+
+    def coalesced_index(self,
+                        package_name: str,
+                        public: bool = False,
+                        owner_full_control: bool = False) -> bool:
+        """Upload the index of a project, coalescing the writes of concurrent publishers
+
+        Call after committing the manifest with commit_manifest.  Every publisher takes a
+        ticket from the generation object of the project.  The first to find no active lease
+        takes it, waits coalesce_window seconds for other publishers to commit, then renders
+        the index from the stored manifest and records the last ticket it covers as rendered.
+        Publishers whose ticket has been rendered skip their write; the others wait for the
+        lease to be released, or to expire if its holder stopped.  The holder renews its lease
+        on a background thread until it has rendered the index, however long that takes.
+
+        Args:
+            package_name (str): The name of the package
+            public (bool, optional): Set to True to enable Public Read ACL in S3.  Defaults to False
+            owner_full_control (bool, optional): Set to True to provide bucket owner full control.  Defaults to False.
+
+        Returns:
+            bool: True if this publisher wrote the index
+        """
+        key = f'{GENERATIONS_PREFIX}/{self.prefix}/{package_name}.json'
+        window = self.coalesce_window or 0.0
+        poll = min(max(window / 4, 0.01), 1.0)
+
+        def update(body: Union[bytes, None], **changes) -> bytes:
+            generation = _new_generation() if body is None else json.loads(
+                body.decode('utf-8'))
+            for name, change in changes.items():
+                generation[name] = change(generation)
+            return json.dumps(generation, sort_keys=True).encode('utf-8')
+
+        def take_ticket(body):
+            return update(body, requested=lambda gen: gen['requested'] + 1)
+
+        ticket = json.loads(
+            self._conditional_update(key, take_ticket,
+                                     "application/json"))['requested']
+
+        def take_lease(body):
+            generation = _new_generation() if body is None else json.loads(
+                body.decode('utf-8'))
+            if generation['rendered'] >= ticket or (
+                    generation['holder'] not in (None, self._writer_id)
+                    and generation['lease_until'] > time.time()):
+                raise _LeaseUnavailable()
+
+            return update(body,
+                          holder=lambda gen: self._writer_id,
+                          lease_until=lambda gen: time.time() + window +
+                          LEASE_SECONDS)
+
+        while True:
+            generation = self._generation(key)
+            if generation['rendered'] >= ticket:
+                logger.info("Index of %s already written by another publisher",
+                            package_name)
+                self.report.count('writes_coalesced')
+                return False
+
+            if (generation['holder'] is not None
+                    and generation['lease_until'] > time.time()):
+                time.sleep(poll)
+                continue
+
+            try:
+                self._conditional_update(key, take_lease, "application/json")
+            except _LeaseUnavailable:
+                continue
+
+            break
+
+        def renew_lease(body):
+            generation = json.loads(body.decode('utf-8'))
+            if generation['holder'] != self._writer_id:
+                raise _LeaseUnavailable()
+
+            return update(body,
+                          lease_until=lambda gen: max(
+                              gen['lease_until'],
+                              time.time() + LEASE_SECONDS))
+
+        rendered = threading.Event()
+
+        def keep_lease():
+            while not rendered.wait(LEASE_RENEW_SECONDS):
+                try:
+                    self._conditional_update(key, renew_lease,
+                                             "application/json")
+                except _LeaseUnavailable:
+                    logger.warning("Lost the index lease of %s", package_name)
+                    return
+                except Exception as error:
+                    logger.warning("Unable to renew the index lease of %s: %s",
+                                   package_name, error)
+
+        renewer = threading.Thread(target=keep_lease, daemon=True)
+        renewer.start()
+
+        try:
+            # Let concurrent publishers commit their manifests before rendering
+            time.sleep(window)
+            covered = self._generation(key)['requested']
+
+            self._manifests.pop(package_name, None)
+            self.upload_index(package_name,
+                              manifest=self.load_manifest(package_name),
+                              public=public,
+                              owner_full_control=owner_full_control)
+        finally:
+            rendered.set()
+            renewer.join()
+
+        def release(body):
+            generation = json.loads(body.decode('utf-8'))
+            changes = {'rendered': lambda gen: max(gen['rendered'], covered)}
+            if generation['holder'] == self._writer_id:
+                changes['holder'] = lambda gen: None
+                changes['lease_until'] = lambda gen: 0.0
+            return update(body, **changes)
+
+        self._conditional_update(key, release, "application/json")
+        return True
+
+    def publish_index(self,
+                      package_name: str,
+                      records: Iterable[dict],
+                      public: bool = False,
+                      owner_full_control: bool = False):
+        """Merge the records of newly published files into the manifest of a project and
+        upload its index
+
+        With coalesce_window, the manifest is merged with commit_manifest and the index is
+        written with coalesced_index, otherwise with update_manifest and upload_index.
+
+        Args:
+            package_name (str): The name of the package
+            records (Iterable[dict]): The records of the files uploaded
+            public (bool, optional): Set to True to enable Public Read ACL in S3.  Defaults to False
+            owner_full_control (bool, optional): Set to True to provide bucket owner full control.  Defaults to False.
+        """
+        if self.coalesce_window is not None:
+            self.commit_manifest(package_name, records, public,
+                                 owner_full_control)
+            self.coalesced_index(package_name, public, owner_full_control)
+            return
+
+        manifest = self.update_manifest(package_name, records, public,
+                                        owner_full_control)
+        self.upload_index(package_name,
+                          manifest=manifest,
+                          public=public,
+                          owner_full_control=owner_full_control)
+
+    def load_projects(self) -> List[str]:
+        """Load the names of the projects in the repository
+
+        The names are read from the project list stored next to the root index and cached by
+        this instance.  If there is no project list yet, the projects are discovered with a
+        delimited listing, which never enumerates the files of the projects.
+
+        Returns:
+            List[str]: The names of the projects
+        """
+        if self._projects is not None:
+            return self._projects
+
+        key = f'{self.prefix}/{PROJECTS_NAME}'
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=key)
+            self._projects = json.loads(
+                response['Body'].read().decode('utf-8'))['projects']
+            self._projects_stored = True
+
+        except self.s3_client.exceptions.NoSuchKey:
+            logger.info("No project list found at s3://%s/%s", self.bucket,
+                        key)
+            self._projects = list(self.list_projects())
+
+        return self._projects
+
+    def upload_root_index(self,
+                          projects: Union[Iterable[str], None] = None,
+                          public: bool = False,
+                          owner_full_control: bool = False):
+        """Upload the root index and the project list
+
+        Args:
+            projects (Union[Iterable[str], None], optional): The names of the projects. Defaults
+                to None, to use the stored project list.
+            public (bool, optional): Set to True to enable Public Read ACL in S3.  Defaults to False
+            owner_full_control (bool, optional): Set to True to provide bucket owner full control.  Defaults to False.
+        """
+        projects = sorted(
+            set(self.load_projects() if projects is None else projects))
+        acl = _object_acl(public, owner_full_control)
+
+        key = f'{self.prefix}/{PROJECTS_NAME}'
+        logger.info("Uploading project list to s3://%s/%s", self.bucket, key)
+        self._upload_rendered(
+            key, lambda sink: sink.write(
+                json.dumps({
+                    'projects': projects
+                }).encode('utf-8')), "application/json", acl)
+        self._projects = projects
+        self._projects_stored = True
+
+        self._upload_root_page(projects, acl)
+
+    def _upload_root_page(self, projects: List[str], acl: str):
+        """Upload the root index page, linking to each project"""
+        key = f'{self.prefix}/{INDEX_NAME}'
+        logger.info("Uploading root index to s3://%s/%s", self.bucket, key)
+        self._upload_rendered(
+            key,
+            lambda sink: write_chunks(
+                iter_html_index(self._root_index_links(projects)), sink),
+            "text/html",
+            acl,
+            index_page=True)
+
+    def add_projects(self,
+                     package_names: Iterable[str],
+                     public: bool = False,
+                     owner_full_control: bool = False) -> bool:
+        """Add projects to the root index, uploading it only if a project is new
+
+        The root index is also uploaded if the repository has no project list yet.
+
+        With conditional_writes, the project list is updated with _conditional_update, so
+        projects added by concurrent publishers are never lost.  The root index is rendered
+        again until the project list is unchanged after it was written, so the last root index
+        written links to every project.
+
+        Args:
+            package_names (Iterable[str]): The names of the projects published
+            public (bool, optional): Set to True to enable Public Read ACL in S3.  Defaults to False
+            owner_full_control (bool, optional): Set to True to provide bucket owner full control.  Defaults to False.
+
+        Returns:
+            bool: True if the root index was updated
+        """
+        projects = self.load_projects()
+        new_projects = set(package_names) - set(projects)
+
+        if not new_projects and self._projects_stored:
+            return False
+
+        if not self.conditional_writes:
+            self.upload_root_index(projects + sorted(new_projects), public,
+                                   owner_full_control)
+            return True
+
+        def update(body: Union[bytes, None]) -> bytes:
+            if body is None:
+                stored = projects
+            else:
+                stored = json.loads(body.decode('utf-8'))['projects']
+
+            return json.dumps({
+                'projects': sorted(set(stored) | new_projects)
+            }).encode('utf-8')
+
+        key = f'{self.prefix}/{PROJECTS_NAME}'
+        acl = _object_acl(public, owner_full_control)
+        logger.info("Updating project list at s3://%s/%s", self.bucket, key)
+        body = self._conditional_update(key, update, "application/json", acl)
+
+        while True:
+            self._projects = json.loads(body.decode('utf-8'))['projects']
+            self._projects_stored = True
+            self._upload_root_page(self._projects, acl)
+
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=key)
+            stored = response['Body'].read()
+            if stored == body:
+                return True
+
+            logger.debug("s3://%s/%s changed while rendering, rendering again",
+                         self.bucket, key)
+            body = stored
+
+    def project_objects(self) -> Iterator[Tuple[str, List[dict]]]:
+        """List every project in the repository in a single pass
+
+        Listings are returned in key order, so the objects of each project are contiguous and
+        are grouped as they stream past; only one project is held in memory at a time.
+        Objects outside a project directory, e.g. the root index, are skipped.
+
+        Yields:
+            Iterator[Tuple[str, List[dict]]]: The name of each project and its object summaries
+        """
+        root = self._listing_prefix()
+        objects = (obj for obj in self.list_objects()
+                   if obj['Key'].count('/', len(root)) == 1)
+
+        for project, group in itertools.groupby(
+                objects, key=lambda obj: obj['Key'][len(root):].split('/', 1)[0]):
+            yield project, list(group)
+
+    def reindex_project(self,
+                        package_name: str,
+                        objects: Iterable[dict],
+                        public: bool = False,
+                        owner_full_control: bool = False) -> Manifest:
+        """Regenerate the manifest and indexes of a project from a listing
+
+        The listing is merged into the stored manifest with _conditional_update, so a manifest
+        committed by a concurrent publisher is never overwritten with an older one.  The
+        records of the stored manifest are kept for files that are still listed with the same
+        size, and a record with hashes is never replaced by one built from the listing.  A
+        stored record of a file that is not listed is dropped only if the file no longer exists,
+        as it may have been published after the listing.  Files missing from the manifest are
+        added without hashes.  The index is rendered from the manifest that was committed, and
+        rendered again if the manifest changed meanwhile.  Unchanged objects are not rewritten.
+
+        Args:
+            package_name (str): The name of the project
+            objects (Iterable[dict]): The object summaries of the project
+            public (bool, optional): Set to True to enable Public Read ACL in S3.  Defaults to False
+            owner_full_control (bool, optional): Set to True to provide bucket owner full control.  Defaults to False.
+
+        Returns:
+            Manifest: The regenerated manifest
+        """
+        listed = Manifest.from_objects(package_name, objects)
+
+        def merge(body: Union[bytes, None]) -> bytes:
+            stored = Manifest(package_name)
+            if body is not None:
+                stored = Manifest.from_json(body)
+
+            manifest = Manifest(package_name)
+            for record in listed:
+                stored_record = stored.files.get(record['filename'])
+                if stored_record is not None and (
+                        stored_record.get('sha256') is not None
+                        or stored_record.get('size') == record['size']):
+                    record = dict(stored_record, filename=record['filename'])
+                manifest.add(record)
+
+            for record in stored:
+                if record['filename'] not in manifest and self._head_exists(
+                        f"{self._listing_prefix(package_name)}{record['filename']}"):
+                    manifest.add(record)
+
+            return manifest.to_json()
+
+        key = f'{self.prefix}/{package_name}/{MANIFEST_NAME}'
+        body = self._conditional_update(key, merge, "application/json",
+                                        _object_acl(public, owner_full_control))
+
+        while True:
+            manifest = Manifest.from_json(body)
+            self.upload_index(package_name,
+                              manifest=manifest,
+                              public=public,
+                              owner_full_control=owner_full_control)
+
+            # A publisher may have committed, and rendered, a newer manifest meanwhile
+            stored = self.s3_client.get_object(Bucket=self.bucket,
+                                               Key=key)['Body'].read()
+            if stored == body:
+                break
+
+            logger.debug("s3://%s/%s changed while rendering, rendering again",
+                         self.bucket, key)
+            body = stored
+
+        # Manifests are not cached, so reindexing a large repository uses constant memory
+        self._manifests.pop(package_name, None)
+        self.report.count('projects')
+
+        return manifest
+
+    def reindex(self,
+                public: bool = False,
+                owner_full_control: bool = False,
+                jobs: int = 1,
+                shard: Union[Tuple[int, int], None] = None) -> List[str]:
+        """Regenerate the manifest and indexes of every project, and the root index
+
+        The repository is listed once, and projects are reindexed on `jobs` threads as their
+        objects stream past.  Projects without package files are left out of the root index.
+
+        When a shard is given, only the projects assigned to it by shard_of are reindexed.  The
+        projects are discovered from a delimited listing and each is listed individually, so
+        the shards of a large repository can run on separate machines.  The root index needs
+        every project, so it is written by complete_reindex once all shards have finished.
+
+        Args:
+            public (bool, optional): Set to True to enable Public Read ACL in S3.  Defaults to False
+            owner_full_control (bool, optional): Set to True to provide bucket owner full control.  Defaults to False.
+            jobs (int, optional): The number of projects reindexed concurrently. Defaults to 1.
+            shard (Union[Tuple[int, int], None], optional): The shard to reindex and the number
+                of shards, e.g. (2, 4) for the second of four shards. Defaults to None, to
+                reindex every project.
+
+        Returns:
+            List[str]: The reindexed projects that have package files
+        """
+        def reindex_project(item: Union[str, Tuple[str, List[dict]]]
+                            ) -> Tuple[str, int]:
+            if shard is None:
+                package_name, objects = item
+            else:
+                package_name = item
+                objects = self.list_objects(package_name=package_name,
+                                            max_workers=1)
+
+            manifest = self.reindex_project(package_name, objects, public,
+                                            owner_full_control)
+            return package_name, len(manifest)
+
+        if shard is None:
+            items = self.project_objects()
+        else:
+            index, count = shard
+            items = (package_name for package_name in self.list_projects()
+                     if shard_of(package_name, count) == index)
+
+        projects = [
+            package_name for package_name, files in _ordered_map(
+                reindex_project, items, max(jobs, 1)) if files
+        ]
+
+        if shard is None:
+            self.upload_root_index(projects, public, owner_full_control)
+
+        return projects
+
+    def _shard_report_key(self, run_id: str, index: int, count: int) -> str:
+        """The key of the completion report of a shard of a reindex"""
+        return f'{REINDEX_REPORTS_PREFIX}/{run_id}/shard-{index}-of-{count}.json'
+
+    def upload_shard_report(self, run_id: str, shard: Tuple[int, int],
+                            projects: List[str]):
+        """Record that a shard of a reindex has completed
+
+        Reports are stored under REINDEX_REPORTS_PREFIX at the root of the bucket, outside the
+        repository prefix, with the default private ACL.
+
+        Args:
+            run_id (str): The identifier shared by every shard of the reindex e.g. a CI pipeline id
+            shard (Tuple[int, int]): The shard and the number of shards
+            projects (List[str]): The reindexed projects that have package files
+        """
+        index, count = shard
+        key = self._shard_report_key(run_id, index, count)
+        logger.info("Uploading shard report to s3://%s/%s", self.bucket, key)
+
+        report = {
+            'run_id': run_id,
+            'shard': index,
+            'shards': count,
+            'prefix': self.prefix,
+            'projects': sorted(projects),
+            'counts': dict(self.report.counts),
+            'completed': format_time(),
+        }
+        self.s3_client.put_object(Bucket=self.bucket,
+                                  Key=key,
+                                  Body=json.dumps(report, indent=1,
+                                                  sort_keys=True).encode('utf-8'),
+                                  ContentType="application/json")
+
+    def shard_reports(self, run_id: str, count: int) -> Dict[int, dict]:
+        """Load the completion reports of the shards of a reindex
+
+        Args:
+            run_id (str): The identifier shared by every shard of the reindex
+            count (int): The number of shards
+
+        Returns:
+            Dict[int, dict]: The reports of the completed shards, keyed by shard
+        """
+        reports = {}
+        for index in range(1, count + 1):
+            key = self._shard_report_key(run_id, index, count)
+            try:
+                response = self.s3_client.get_object(Bucket=self.bucket,
+                                                     Key=key)
+            except self.s3_client.exceptions.NoSuchKey:
+                continue
+
+            reports[index] = json.loads(response['Body'].read().decode('utf-8'))
+        return reports
+
+    def complete_reindex(self,
+                         run_id: str,
+                         count: int,
+                         public: bool = False,
+                         owner_full_control: bool = False) -> List[str]:
+        """Check every shard of a reindex completed, then write the root index
+
+        Args:
+            run_id (str): The identifier shared by every shard of the reindex
+            count (int): The number of shards
+            public (bool, optional): Set to True to enable Public Read ACL in S3.  Defaults to False
+            owner_full_control (bool, optional): Set to True to provide bucket owner full control.  Defaults to False.
+
+        Returns:
+            List[str]: The projects in the root index
+
+        Raises:
+            ReindexIncompleteException: If a shard has not reported completion
+        """
+        reports = self.shard_reports(run_id, count)
+        missing = [index for index in range(1, count + 1) if index not in reports]
+        if missing:
+            raise ReindexIncompleteException(
+                f"Reindex {run_id} is missing shard(s) "
+                f"{', '.join(str(index) for index in missing)} of {count}")
+
+        projects = sorted(
+            {project
+             for report in reports.values()
+             for project in report['projects']})
+        self.upload_root_index(projects, public, owner_full_control)
+        return projects
+
+    def exists(self, package_name: str, filename: str) -> bool:
+        """Check if a file has been published for a project
+
+        The check is made against the cached project manifest, so only the first check for
+        a project makes a request.
+
+        Args:
+            package_name (str): The name of the package
+            filename (str): The name of the package file
+
+        Returns:
+            bool: True if the file exists
+        """
+        return filename in self.load_manifest(package_name)
+
+
+def _object_acl(public: bool, owner_full_control: bool) -> str:
+    """The canned ACL for objects written by pips3"""
+    if public:
+        return 'public-read'
+    return 'bucket-owner-full-control' if owner_full_control else ''
+
+
+def _new_generation() -> dict:
+    """The state of a project without coalesced index writes yet
+
+    requested counts the tickets taken by publishers, rendered is the last ticket covered by
+    a written index, and holder is the writer holding the lease until lease_until.
+    """
+    return {'requested': 0, 'rendered': 0, 'holder': None, 'lease_until': 0.0}
+
+
+class _LeaseUnavailable(Exception):
+    """The coalesced index lease is held by another writer, or no longer needed"""
+
+
+def _is_not_found(error) -> bool:
+    """Check if a botocore ClientError means the object does not exist"""
+    return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey',
+                                                           'NotFound')
+
+
+class _HashingWriter:
+    """A write-only file wrapper that computes the sha256 and md5 of the bytes written
+
+    Args:
+        fileobj (BinaryIO): The file to write to
+    """
+    def __init__(self, fileobj: BinaryIO):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5()
+
+    def write(self, data: bytes) -> int:
+        """Hash and write the bytes, returning the number written"""
+        self.sha256.update(data)
+        self.md5.update(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        """Flush the wrapped file"""
+        self.fileobj.flush()
+
+
+class _HashingReader:
+    """A read-only, non-seekable file wrapper that hashes the bytes as they are read
+
+    Being non-seekable guarantees the transfer manager reads the file exactly once, in order,
+    so the digest is computed in the same pass that feeds the upload.
+
+    Args:
+        fileobj (BinaryIO): The file to read
+    """
+    def __init__(self, fileobj: BinaryIO):
+        self.fileobj = fileobj
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        """Read and hash up to size bytes, or the rest of the file if size is negative"""
+        data = self.fileobj.read(size)
+        self.size += len(data)
+        self.sha256.update(data)
+        return data
+
+    @staticmethod
+    def readable() -> bool:
+        """The file can be read"""
+        return True
+
+    @staticmethod
+    def seekable() -> bool:
+        """The file cannot be seeked, so it is read once in order"""
+        return False
+
+
+def file_sha256(path: str) -> str:
+    """Compute the sha256 of a file, as recorded in manifests
+
+    Args:
+        path (str): The path to the file
+
+    Returns:
+        str: The hex digest of the sha256 of the file
+    """
+    sha256 = hashlib.sha256()
+
+    with open(path, 'rb') as pkg_file:
+        for data in iter(lambda: pkg_file.read(MIN_PART_SIZE), b''):
+            sha256.update(data)
+
+    return sha256.hexdigest()
+
+
+def file_etag(path: str, part_size: Union[int, None] = None) -> str:
+    """Compute the ETag S3 gives a file
+
+    Args:
+        path (str): The path to the file
+        part_size (Union[int, None], optional): The part size of a multipart upload. Defaults
+            to None, for a file uploaded in a single request.
+
+    Returns:
+        str: The MD5 of the file, or for a multipart upload the MD5 of the MD5s of its parts
+            followed by -<number of parts>
+    """
+    md5 = hashlib.md5()
+    part_digests = []
+
+    with open(path, 'rb') as pkg_file:
+        while True:
+            data = pkg_file.read(part_size or MIN_PART_SIZE)
+            if not data:
+                break
+
+            if part_size is None:
+                md5.update(data)
+            else:
+                part_digests.append(hashlib.md5(data).digest())
+
+    if part_size is None:
+        return md5.hexdigest()
+
+    md5.update(b''.join(part_digests))
+    return f'{md5.hexdigest()}-{len(part_digests)}'
+
+
+def shard_of(package_name: str, count: int) -> int:
+    """Assign a project to one of a number of shards
+
+    The shard is derived from a hash of the normalized name, so every machine assigns a project
+    to the same shard without coordination, across runs and Python processes.
+
+    Args:
+        package_name (str): The name of the project
+        count (int): The number of shards
+
+    Returns:
+        int: The shard of the project, from 1 to count
+    """
+    digest = hashlib.sha256(normalize_name(package_name).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count + 1
+
+
+def normalize_name(name: str) -> str:
+    """Normalize a project name as described in PEP 503
+
+    Args:
+        name (str): The name of the project
+
+    Returns:
+        str: The normalized name e.g. Foo.Bar_baz becomes foo-bar-baz
+    """
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def get_package_name(upload_file: str) -> str:
+    """determine the package name from the artifacts to be uploaded. According to pypi,
+    if upload_file is a tar.gz, then the package name is already canonical.
+    if upload_file is a whl, then we need to replace _ with -.
+    See tests for examples.
+
+    Args:
+        upload_file (str): path to the artifacts, tar.gz or whl
+
+    Returns:
+        str: package name
     """
     stem = os.path.basename(upload_file)
     splitted = stem.split("-")
@@ -241,34 +2343,344 @@ def get_package_name(upload_file: str) -> str:
     return splitted[0].replace('_', '-')
 
 
+def get_package_version(upload_file: str) -> str:
+    """determine the version of a package from the name of the artifact.
+    For a whl the version is the second field of the filename, for an sdist
+    it is everything after the last - in the filename without the extension.
+
+    Args:
+        upload_file (str): path to the artifacts, tar.gz, zip or whl
+
+    Returns:
+        str: package version
+    """
+    stem = os.path.basename(upload_file)
+    for ext in (".whl", ".tar.gz", ".zip", ".tar.bz2", ".tgz"):
+        if stem.endswith(ext):
+            stem = stem[:-len(ext)]
+            break
+
+    splitted = stem.split("-")
+    if upload_file.endswith(".whl"):
+        return splitted[1]
+    return splitted[-1]
+
+
+def group_package_files(upload_files: Iterable[str]) -> Dict[str, List[str]]:
+    """Group package files by their normalized project name
+
+    Args:
+        upload_files (Iterable[str]): The paths of the package files
+
+    Returns:
+        Dict[str, List[str]]: The package files of each project, in the order first seen
+    """
+    projects = {}
+    for upload_file in upload_files:
+        package_name = normalize_name(get_package_name(upload_file))
+        projects.setdefault(package_name, []).append(upload_file)
+    return projects
+
+
+def legacy_names(package_name: str, upload_files: Iterable[str]) -> List[str]:
+    """The unnormalized names earlier versions published the files of a project under
+
+    Args:
+        package_name (str): The normalized name of the project
+        upload_files (Iterable[str]): The paths of the package files of the project
+
+    Returns:
+        List[str]: The names given by get_package_name that differ from the normalized name
+    """
+    names = []
+    for upload_file in upload_files:
+        name = get_package_name(upload_file)
+        if name != package_name and name not in names:
+            names.append(name)
+    return names
+
+
+def _sync_package_files(uploader: PipS3, projects: Dict[str, List[str]],
+                        inventories: Dict[str, Dict[str, dict]],
+                        jobs: int) -> Dict[str, List[str]]:
+    """Compare package files to the published files of their projects
+
+    The files that are already published are hashed on `jobs` threads and counted as
+    identical or recorded as conflicts in the report of the uploader.  They are compared by
+    the sha256 in the manifest of their project where it has one, and otherwise by ETag.
+
+    Args:
+        uploader (PipS3): The repository to publish to
+        projects (Dict[str, List[str]]): The package files of each project
+        inventories (Dict[str, Dict[str, dict]]): The published files of each project, from
+            PipS3.inventory
+        jobs (int): The number of files hashed concurrently
+
+    Returns:
+        Dict[str, List[str]]: The package files still to be published, of each project with any
+    """
+    report = uploader.report
+    published = []
+    missing = {}
+
+    with report.timed('check'):
+        for package_name, upload_files in projects.items():
+            existing = inventories[package_name]
+            records = None
+
+            for upload_file in upload_files:
+                filename = os.path.basename(upload_file)
+                obj = existing.get(filename)
+                if obj is None:
+                    missing.setdefault(package_name, []).append(upload_file)
+                    continue
+
+                if records is None:
+                    records = uploader.load_manifest(package_name).files
+                published.append((upload_file, obj, records.get(filename)))
+
+    def compare(item: Tuple[str, dict, Union[dict, None]]) -> bool:
+        upload_file, obj, record = item
+        with report.timed('compare'):
+            return uploader.is_identical(upload_file, obj, record)
+
+    for (upload_file, _, _), identical in zip(
+            published, _ordered_map(compare, published, jobs)):
+        if identical:
+            report.count('identical')
+            continue
+
+        logger.warning("%s differs from the published file",
+                       os.path.basename(upload_file))
+        report.conflict(upload_file)
+
+    return missing
+
+
 def publish_packages(endpoint: str,
                      bucket: str,
                      public: bool = False,
-                     owner_full_control: bool = False):
+                     owner_full_control: bool = False,
+                     jobs: int = 1,
+                     sync: bool = False,
+                     **kwargs) -> PublishReport:
     """Publish current package files
 
+    Package files are grouped by their normalized project name, so a dist directory holding
+    several projects is published in one run, sharing a client and worker pool.
+
+    Publishing is a pipeline of stages: package files are discovered and checked against their
+    projects, metadata is extracted from each file on a background thread while earlier files
+    are uploaded on `jobs` threads, and the indexes of every project are written concurrently
+    as soon as the last upload finishes.  Each stage reads from the one before through a
+    bounded window, so at most a few files are prepared ahead of the uploads.  The time spent
+    in each stage is recorded in the report.
+
+    With sync, files already published are compared to the local files by size and ETag, hashed
+    on `jobs` threads, instead of stopping the publish.  Identical files are skipped, files
+    with different content are recorded as conflicts in the report and not uploaded, and only
+    the missing files are published.
+
     Args:
         endpoint (str): The endpoint for the S3-like service
         bucket (str): The name of the bucket to use
         public (bool): Set to True to enable Public Read ACL in S3
-        transfer_ownership (bool): Set to True to transfer ownership in S3 to bucket owner
+        owner_full_control (bool): Set to True to transfer ownership in S3 to bucket owner
+        jobs (int, optional): The number of package files uploaded, and projects indexed,
+            concurrently. Defaults to 1.
+        sync (bool, optional): Set to True to skip the files already published, and report
+            those that differ, instead of raising. Defaults to False.
+        **kwargs: Additional options passed to PipS3 e.g. gzip_index
+
+    Returns:
+        PublishReport: The counts of the uploads and index writes made, and the stage timings
+
+    Raises:
+        PackageExistsException: If a package file already exists.  With conditional writes,
+            the files uploaded before it was found are indexed first
     """
 
-    uploader = PipS3(endpoint, bucket)
+    jobs = max(jobs, 1)
 
-    package_name = None
+    # Every concurrent upload may use up to max_concurrency connections
+    kwargs.setdefault(
+        'max_pool_connections',
+        jobs * (kwargs.get('max_concurrency') or MAX_CONCURRENCY))
 
-    for upload_file in PipS3.find_package_files():
+    uploader = PipS3(endpoint, bucket, **kwargs)
+    report = uploader.report
 
-        # Get the package name
-        if package_name is None:
+    with report.timed('discover'):
+        projects = group_package_files(PipS3.find_package_files())
 
-            package_name = get_package_name(upload_file)
+    if not projects:
+        logger.warning("No package files found to publish")
+        return report
 
-        uploader.upload_package(upload_file, package_name, public,
-                                owner_full_control)
+    # Check every file against a single listing per project before any upload starts, unless
+    # conditional writes make each upload check for itself.  Projects that may have files
+    # under a legacy prefix are always listed, as conditional writes only check the new keys
+    def check(package_name: str) -> Union[Dict[str, dict], None]:
+        names = legacy_names(package_name, projects[package_name])
+        if uploader.conditional_writes and not sync and not names:
+            return None
+        return uploader.inventory(package_name, names)
 
-    # Update the index
-    uploader.upload_index(package_name,
-                          public=public,
-                          owner_full_control=owner_full_control)
+    with report.timed('check'):
+        inventories = dict(zip(projects, _ordered_map(check, projects, jobs)))
+
+    if sync:
+        projects = _sync_package_files(uploader, projects, inventories, jobs)
+        if not projects:
+            logger.info("Every package file is already published")
+            return report
+
+    for package_name, upload_files in projects.items():
+        existing = inventories[package_name]
+        if existing is None:
+            continue
+
+        for upload_file in upload_files:
+            if os.path.basename(upload_file) in existing:
+                raise PackageExistsException(
+                    "Package %s already exists in the S3 Bucket for the project %s",
+                    os.path.basename(upload_file), package_name)
+
+    def prepare(
+        item: Tuple[str, str]
+    ) -> Tuple[str, str, Union[bytes, None]]:
+        package_name, upload_file = item
+        with report.timed('prepare'):
+            return package_name, upload_file, extract_metadata(upload_file)
+
+    def upload(
+        prepared: Tuple[str, str, Union[bytes, None]]
+    ) -> Union[dict, PackageExistsException]:
+        package_name, upload_file, metadata = prepared
+
+        # The package is hashed in the same pass that uploads it.  With conditional writes a
+        # file can turn out to exist part way through, which is raised once the files already
+        # uploaded are indexed
+        with report.timed('upload'):
+            try:
+                record = uploader.upload_package(upload_file, package_name,
+                                                 public, owner_full_control,
+                                                 inventories[package_name])
+            except PackageExistsException as error:
+                return error
+
+            if metadata is not None:
+                record.update(
+                    uploader.upload_metadata(upload_file, package_name, public,
+                                             owner_full_control, metadata))
+
+        return record
+
+    files = [(package_name, upload_file)
+             for package_name, upload_files in projects.items()
+             for upload_file in upload_files]
+    records = {package_name: [] for package_name in projects}
+    errors = []
+    for (package_name, _), record in zip(
+            files, _ordered_map(upload, _ordered_map(prepare, files, 1),
+                                jobs)):
+        if isinstance(record, PackageExistsException):
+            errors.append(record)
+        else:
+            records[package_name].append(record)
+
+    published = [
+        package_name for package_name in projects if records[package_name]
+    ]
+
+    # Update the manifest of each project and render its index from it
+    def index(package_name: str):
+        with report.timed('index'):
+            uploader.publish_index(package_name, records[package_name],
+                                   public, owner_full_control)
+
+    for _ in _ordered_map(index, published, jobs):
+        pass
+
+    if published:
+        with report.timed('index'):
+            uploader.add_projects(published, public, owner_full_control)
+
+    if errors:
+        raise errors[0]
+
+    return report
+
+
+def reindex_packages(endpoint: str,
+                     bucket: str,
+                     public: bool = False,
+                     owner_full_control: bool = False,
+                     jobs: int = 1,
+                     shard: Union[Tuple[int, int], None] = None,
+                     run_id: Union[str, None] = None,
+                     **kwargs) -> PublishReport:
+    """Regenerate the indexes of every project in the repository from one listing
+
+    Args:
+        endpoint (str): The endpoint for the S3-like service
+        bucket (str): The name of the bucket to use
+        public (bool): Set to True to enable Public Read ACL in S3
+        owner_full_control (bool): Set to True to transfer ownership in S3 to bucket owner
+        jobs (int, optional): The number of projects reindexed concurrently. Defaults to 1.
+        shard (Union[Tuple[int, int], None], optional): The shard to reindex and the number of
+            shards. Defaults to None, to reindex every project.
+        run_id (Union[str, None], optional): The identifier shared by every shard, under which
+            the completion report of the shard is written. Required with shard.
+        **kwargs: Additional options passed to PipS3 e.g. gzip_index
+
+    Returns:
+        PublishReport: The counts of the projects reindexed and the index writes made
+    """
+    if shard is not None and run_id is None:
+        raise ValueError("A run id is required to reindex a shard")
+
+    jobs = max(jobs, 1)
+    kwargs.setdefault('max_pool_connections', jobs)
+
+    indexer = PipS3(endpoint, bucket, **kwargs)
+    report = indexer.report
+
+    with report.timed('reindex'):
+        projects = indexer.reindex(public, owner_full_control, jobs, shard)
+
+    if shard is not None:
+        indexer.upload_shard_report(run_id, shard, projects)
+
+    return report
+
+
+def complete_reindex(endpoint: str,
+                     bucket: str,
+                     run_id: str,
+                     shards: int,
+                     public: bool = False,
+                     owner_full_control: bool = False,
+                     **kwargs) -> PublishReport:
+    """Check every shard of a reindex completed, then write the root index
+
+    Args:
+        endpoint (str): The endpoint for the S3-like service
+        bucket (str): The name of the bucket to use
+        run_id (str): The identifier shared by every shard of the reindex
+        shards (int): The number of shards
+        public (bool): Set to True to enable Public Read ACL in S3
+        owner_full_control (bool): Set to True to transfer ownership in S3 to bucket owner
+        **kwargs: Additional options passed to PipS3 e.g. gzip_index
+
+    Returns:
+        PublishReport: The counts of the root index writes made
+
+    Raises:
+        ReindexIncompleteException: If a shard has not reported completion
+    """
+    indexer = PipS3(endpoint, bucket, **kwargs)
+    projects = indexer.complete_reindex(run_id, shards, public,
+                                        owner_full_control)
+    indexer.report.count('projects', len(projects))
+    return indexer.report
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Listing checkpoints"""
+
+import json
+import os
+from typing import Union
+
+
+class ListingCheckpoint:
+    """ListingCheckpoint
+
+    Persist the continuation token of a long running listing so that an interrupted scan can
+    resume from the last fully consumed page.
+
+    Args:
+        path (str): The path of the checkpoint file
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self, bucket: str, prefix: str) -> Union[str, None]:
+        """Load the continuation token for a listing
+
+        Args:
+            bucket (str): The bucket being listed
+            prefix (str): The prefix being listed
+
+        Returns:
+            Union[str, None]: The saved continuation token, or None if there is no checkpoint
+                for this bucket and prefix
+        """
+        try:
+            with open(self.path) as checkpoint_file:
+                state = json.load(checkpoint_file)
+        except (OSError, ValueError):
+            return None
+
+        if state.get('bucket') != bucket or state.get('prefix') != prefix:
+            return None
+
+        return state.get('continuation_token')
+
+    def save(self, bucket: str, prefix: str, continuation_token: str):
+        """Save the continuation token for a listing
+
+        The file is replaced atomically so that an interruption never leaves a partial checkpoint.
+
+        Args:
+            bucket (str): The bucket being listed
+            prefix (str): The prefix being listed
+            continuation_token (str): The token of the next page to list
+        """
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            json.dump(
+                {
+                    'bucket': bucket,
+                    'prefix': prefix,
+                    'continuation_token': continuation_token,
+                }, checkpoint_file)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        """Remove the checkpoint once a listing has completed"""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -1,17 +1,40 @@
 # -*- coding: utf-8 -*-
 """Console script for pips3."""
+import json
 import os
 import sys
 
 import click
 
-from pips3 import publish_packages
-from pips3.exceptions import InvalidConfig
+from pips3 import complete_reindex, publish_packages, reindex_packages
+from pips3.exceptions import InvalidConfig, ReindexIncompleteException
+from pips3.plan import apply_packages, plan_packages
 
 
-@click.command()
+def parse_shard(ctx, param, value):
+    """Parse a shard given as i/n, e.g. 2/4 for the second of four shards"""
+    if value is None:
+        return None
+
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise click.BadParameter(
+            "shard must be given as i/n, e.g. 2/4") from None
+
+    if not 1 <= index <= count:
+        raise click.BadParameter(f"shard {index} is not between 1 and {count}")
+
+    return index, count
+
+
+@click.group(invoke_without_command=True)
 @click.option('--endpoint', default=None, help='S3 Endpoint')
 @click.option('--bucket', default=None, help='S3 Bucket')
+@click.option(
+    '--region',
+    default=None,
+    help='Region of the S3 Bucket. Defaults to discovering it from the bucket')
 @click.option('--public/--no-public',
               default=False,
               type=bool,
@@ -20,8 +43,49 @@ from pips3.exceptions import InvalidConfig
               default=False,
               type=bool,
               help='Enable S3 Bucket Owner Full Control ACL')
-def main(endpoint, bucket, public, bucket_owner_full_control):
-    """Console script for pips3."""
+@click.option('--gzip-index/--no-gzip-index',
+              default=False,
+              type=bool,
+              help='Store index pages gzip compressed')
+@click.option('--index-cache-control',
+              default=None,
+              help='Cache-Control header of index pages e.g. "max-age=300"')
+@click.option(
+    '--artifact-cache-control',
+    default=None,
+    help='Cache-Control header of package files e.g. "public, max-age=31536000, immutable"')
+@click.option(
+    '--conditional-writes/--no-conditional-writes',
+    default=False,
+    type=bool,
+    help='Upload packages with If-None-Match, for stores that support conditional writes')
+@click.option('--jobs',
+              default=1,
+              type=click.IntRange(min=1),
+              help='Number of package files uploaded, or projects reindexed, concurrently')
+@click.option(
+    '--part-size',
+    default=None,
+    type=click.IntRange(min=5),
+    help='Multipart part size of package uploads in MiB. Defaults to adaptive sizing')
+@click.option(
+    '--max-concurrency',
+    default=None,
+    type=click.IntRange(min=1),
+    help='Concurrent part uploads per package file. Defaults to adaptive concurrency')
+@click.option(
+    '--coalesce-index',
+    default=None,
+    type=click.FloatRange(min=0),
+    help='Coordinate concurrent publishers so one writes the index after waiting this many seconds')
+@click.pass_context
+def main(ctx, endpoint, bucket, region, public, bucket_owner_full_control,
+         gzip_index, index_cache_control, artifact_cache_control,
+         conditional_writes, jobs, part_size, max_concurrency, coalesce_index):
+    """Console script for pips3.
+
+    Publishes the package files in dist unless a command is given.
+    """
 
     if public and bucket_owner_full_control:
         raise ValueError(
@@ -31,6 +95,7 @@ def main(endpoint, bucket, public, bucket_owner_full_control):
     # Try a number of options for determining configuration values
     endpoint = os.getenv('PIPS3_ENDPOINT') if endpoint is None else endpoint
     bucket = os.getenv('PIPS3_BUCKET') if bucket is None else bucket
+    region = os.getenv('PIPS3_REGION') if region is None else region
 
     # TODO: #2 Allow retrieving of values from pip.conf
 
@@ -41,7 +106,204 @@ def main(endpoint, bucket, public, bucket_owner_full_control):
     if bucket is None:
         raise InvalidConfig("Error!!! S3 bucket not specified")
 
-    publish_packages(endpoint, bucket, public, bucket_owner_full_control)
+    # The options shared by every command
+    ctx.obj = {
+        'endpoint': endpoint,
+        'bucket': bucket,
+        'public': public,
+        'owner_full_control': bucket_owner_full_control,
+        'jobs': jobs,
+        'gzip_index': gzip_index,
+        'index_cache_control': index_cache_control,
+        'region_name': region,
+    }
+
+    if part_size is not None:
+        part_size = part_size * 1024 * 1024
+
+    # The options of package uploads, used by the commands that upload
+    ctx.obj['upload'] = {
+        'artifact_cache_control': artifact_cache_control,
+        'conditional_writes': conditional_writes,
+        'part_size': part_size,
+        'max_concurrency': max_concurrency,
+        'coalesce_window': coalesce_index,
+    }
+
+    if ctx.invoked_subcommand is not None:
+        return 0
+
+    report = publish_packages(endpoint,
+                              bucket,
+                              public,
+                              bucket_owner_full_control,
+                              jobs=jobs,
+                              gzip_index=gzip_index,
+                              index_cache_control=index_cache_control,
+                              artifact_cache_control=artifact_cache_control,
+                              conditional_writes=conditional_writes,
+                              part_size=part_size,
+                              max_concurrency=max_concurrency,
+                              region_name=region,
+                              coalesce_window=coalesce_index)
+    click.echo(report.summary())
+    click.echo(report.timing_summary())
+    if report.transfers:
+        click.echo(report.transfer_summary())
+    return 0
+
+
+@main.command()
+@click.option(
+    '--shard',
+    default=None,
+    callback=parse_shard,
+    help='Reindex one shard of the projects, e.g. 2/4 for the second of four shards')
+@click.option('--run-id',
+              default=None,
+              help='Identifier shared by every shard, e.g. the CI pipeline id')
+@click.pass_obj
+def reindex(options, shard, run_id):
+    """Regenerate the index of every project from one listing of the bucket"""
+
+    if shard is not None and run_id is None:
+        raise click.UsageError("--run-id is required with --shard")
+
+    options = dict(options)
+    options.pop('upload')
+    report = reindex_packages(options.pop('endpoint'),
+                              options.pop('bucket'),
+                              options.pop('public'),
+                              options.pop('owner_full_control'),
+                              shard=shard,
+                              run_id=run_id,
+                              **options)
+    click.echo(f"Reindexed {report.counts['projects']} project(s)")
+    click.echo(report.summary())
+    return 0
+
+
+@main.command('reindex-complete')
+@click.option('--run-id',
+              required=True,
+              help='Identifier shared by every shard of the reindex')
+@click.option('--shards',
+              required=True,
+              type=click.IntRange(min=1),
+              help='Number of shards of the reindex')
+@click.pass_obj
+def reindex_complete(options, run_id, shards):
+    """Check every shard of a reindex completed, then write the root index"""
+
+    options = dict(options)
+    options.pop('jobs')
+    options.pop('upload')
+
+    try:
+        report = complete_reindex(options.pop('endpoint'), options.pop('bucket'),
+                                  run_id, shards, options.pop('public'),
+                                  options.pop('owner_full_control'), **options)
+    except ReindexIncompleteException as error:
+        raise click.ClickException(str(error))
+
+    click.echo(f"All {shards} shard(s) of {run_id} completed, "
+               f"{report.counts['projects']} project(s) in the root index")
+    return 0
+
+
+@main.command()
+@click.option('--output',
+              default='pips3-plan.json',
+              type=click.Path(dir_okay=False, writable=True),
+              help='File to write the plan to')
+@click.pass_obj
+def plan(options, output):
+    """Plan the publish of the package files in dist without writing to S3"""
+
+    actions = plan_packages(options['endpoint'],
+                            options['bucket'],
+                            options['public'],
+                            options['owner_full_control'],
+                            region_name=options['region_name'])
+
+    with open(output, 'w') as plan_file:
+        json.dump(actions, plan_file, indent=2)
+
+    counts = {}
+    for action in actions['actions']:
+        counts[action['type']] = counts.get(action['type'], 0) + 1
+
+    click.echo(f"Planned {counts.get('upload', 0)} upload(s), "
+               f"{counts.get('metadata', 0)} metadata file(s) and "
+               f"{counts.get('index', 0)} index(es) in {output}")
+    return 0
+
+
+@main.command()
+@click.argument('plan_path',
+                metavar='PLAN',
+                type=click.Path(exists=True, dir_okay=False))
+@click.option('--journal',
+              default=None,
+              type=click.Path(dir_okay=False, writable=True),
+              help='Journal of completed actions. Defaults to PLAN.journal')
+@click.pass_obj
+def apply(options, plan_path, journal):
+    """Apply a plan, resuming from its journal if an earlier attempt failed"""
+
+    with open(plan_path) as plan_file:
+        plan = json.load(plan_file)
+
+    if plan['bucket'] != options['bucket']:
+        raise click.UsageError(
+            f"{plan_path} is a plan for bucket {plan['bucket']}, not {options['bucket']}")
+
+    try:
+        report = apply_packages(plan,
+                                journal or f'{plan_path}.journal',
+                                jobs=options['jobs'],
+                                gzip_index=options['gzip_index'],
+                                index_cache_control=options['index_cache_control'],
+                                region_name=options['region_name'],
+                                **options['upload'])
+    except InvalidConfig as error:
+        raise click.ClickException(str(error))
+
+    if report.counts['actions_skipped']:
+        click.echo(f"Skipped {report.counts['actions_skipped']} action(s) "
+                   "completed by an earlier attempt")
+    click.echo(report.summary())
+    click.echo(report.timing_summary())
+    return 0
+
+
+@main.command()
+@click.pass_obj
+def sync(options):
+    """Publish the package files in dist that are missing from the bucket
+
+    Files already published with the same content, by the sha256 of the manifest or failing
+    that the size and ETag, are skipped.  Files published with
+    different content are reported as conflicts, and the command fails after publishing the
+    missing files.
+    """
+
+    options = dict(options)
+    report = publish_packages(options.pop('endpoint'),
+                              options.pop('bucket'),
+                              options.pop('public'),
+                              options.pop('owner_full_control'),
+                              sync=True,
+                              **options.pop('upload'),
+                              **options)
+    click.echo(report.sync_summary())
+    click.echo(report.summary())
+    click.echo(report.timing_summary())
+
+    if report.conflicts:
+        raise click.ClickException(
+            "Published with different content: " + ", ".join(
+                os.path.basename(path) for path in report.conflicts))
     return 0
 
 
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Shared S3 clients"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import TYPE_CHECKING, Dict, Tuple, Union
+
+if TYPE_CHECKING:  # pragma: no cover
+    import boto3
+
+# botocore's default connection pool size
+DEFAULT_POOL_CONNECTIONS = 10
+
+# The file in the cache directory recording the region of each bucket
+REGION_CACHE_NAME = 'regions.json'
+
+logger = logging.getLogger("pips3")
+
+# The conditional request parameters of S3 writes, and the headers they are sent as.  botocore
+# only models them from 1.35.69, so for older releases they are added to the request headers
+CONDITIONAL_HEADERS = {'IfNoneMatch': 'If-None-Match', 'IfMatch': 'If-Match'}
+CONDITIONAL_OPERATIONS = ('PutObject', 'CompleteMultipartUpload')
+
+_clients: Dict[Tuple, 'boto3.Session.client'] = {}
+_lock = threading.Lock()
+_regions_lock = threading.Lock()
+
+
+def get_s3_client(region_name: Union[str, None] = None,
+                  endpoint_url: Union[str, None] = None,
+                  aws_access_key_id: Union[str, None] = None,
+                  aws_secret_access_key: Union[str, None] = None,
+                  aws_session_token: Union[str, None] = None,
+                  profile_name: Union[str, None] = None,
+                  max_pool_connections: int = DEFAULT_POOL_CONNECTIONS
+                  ) -> 'boto3.Session.client':
+    """Get an S3 client shared by every caller in the process with the same settings
+
+    Creating a client loads the service model and resolves credentials, so clients are cached
+    by region, endpoint and credentials, and reused along with their warm connection pools.
+    boto3 clients are thread safe once created; creation is serialised, each with its own
+    session, since sessions are not.  If a cached client has a smaller connection pool than
+    requested, it is replaced by a client with the larger pool.
+
+    Args:
+        region_name (Union[str, None], optional): The AWS region. Defaults to None, for the
+            standard configuration.
+        endpoint_url (Union[str, None], optional): The S3 API endpoint, for S3 compatible
+            stores. Defaults to None, for AWS.
+        aws_access_key_id (Union[str, None], optional): The access key. Defaults to None, for
+            the standard credentials configuration.
+        aws_secret_access_key (Union[str, None], optional): The secret key. Defaults to None.
+        aws_session_token (Union[str, None], optional): The session token. Defaults to None.
+        profile_name (Union[str, None], optional): The configuration profile. Defaults to None.
+        max_pool_connections (int, optional): The minimum number of pooled connections,
+            typically the number of concurrent requests made with the client. Defaults to 10.
+
+    Returns:
+        boto3.Session.client: The S3 client
+    """
+    # The secret is only kept as a digest, so it cannot leak through the cache
+    secret_digest = None
+    if aws_secret_access_key is not None:
+        secret_digest = hashlib.sha256(
+            aws_secret_access_key.encode('utf-8')).hexdigest()
+
+    key = (region_name, endpoint_url, aws_access_key_id, secret_digest,
+           aws_session_token, profile_name)
+
+    with _lock:
+        client = _clients.get(key)
+        if (client is not None and client.meta.config.max_pool_connections >=
+                max_pool_connections):
+            return client
+
+        import boto3.session
+        from botocore.config import Config
+
+        session = boto3.session.Session(
+            aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key=aws_secret_access_key,
+            aws_session_token=aws_session_token,
+            region_name=region_name,
+            profile_name=profile_name)
+
+        client = session.client('s3',
+                                endpoint_url=endpoint_url,
+                                config=Config(max_pool_connections=max(
+                                    max_pool_connections,
+                                    DEFAULT_POOL_CONNECTIONS)))
+        _clients[key] = client
+
+    return client
+
+
+def _pop_conditions(params: dict, model, context: dict, **kwargs):
+    """Move the conditional parameters botocore does not model out of the parameters"""
+    members = model.input_shape.members
+    for name, header in CONDITIONAL_HEADERS.items():
+        if name in params and name not in members:
+            context.setdefault('pips3_conditions', {})[header] = params.pop(name)
+
+
+def _add_conditions(params: dict, context: dict, **kwargs):
+    """Send the conditional parameters moved out by _pop_conditions as request headers"""
+    params['headers'].update(context.get('pips3_conditions', {}))
+
+
+def register_conditional_headers(s3_client: 'boto3.Session.client'):
+    """Accept IfNoneMatch and IfMatch on put_object and complete_multipart_upload
+
+    Releases of botocore before 1.35.69 reject the parameters, so they are moved out of the
+    parameters before validation and sent as If-None-Match and If-Match headers.  Later
+    releases model the parameters, and the handlers leave them alone.  Registering the
+    handlers again has no effect, and clients without botocore events, e.g. test doubles,
+    are left as they are.
+
+    Args:
+        s3_client (boto3.Session.client): The client to register the handlers with
+    """
+    events = getattr(getattr(s3_client, 'meta', None), 'events', None)
+    if events is None:
+        return
+
+    for operation in CONDITIONAL_OPERATIONS:
+        events.register(f'provide-client-params.s3.{operation}',
+                        _pop_conditions,
+                        unique_id=f'pips3-pop-conditions-{operation}')
+        events.register(f'before-call.s3.{operation}',
+                        _add_conditions,
+                        unique_id=f'pips3-add-conditions-{operation}')
+
+
+def clear_s3_clients():
+    """Discard the cached clients, e.g. after credentials are rotated"""
+    with _lock:
+        _clients.clear()
+
+
+def cache_dir() -> str:
+    """The directory of pips3's on-disk caches
+
+    Returns:
+        str: $PIPS3_CACHE_DIR if set, otherwise pips3 under $XDG_CACHE_HOME or ~/.cache
+    """
+    path = os.getenv('PIPS3_CACHE_DIR')
+    if path:
+        return path
+
+    return os.path.join(
+        os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'pips3')
+
+
+def _load_regions(path: str) -> Dict[str, str]:
+    """Load the cached bucket regions, or none if the cache is missing or unreadable"""
+    try:
+        with open(path) as regions_file:
+            regions = json.load(regions_file)
+    except (OSError, ValueError):
+        return {}
+
+    return regions if isinstance(regions, dict) else {}
+
+
+def get_bucket_region(bucket: str,
+                      s3_client: 'boto3.Session.client') -> Union[str, None]:
+    """Find the region of a bucket, caching it on disk
+
+    The region is read from the x-amz-bucket-region header of a HEAD bucket request, which S3
+    returns from any region, including with the redirect or access denied errors of a request
+    sent to the wrong one.  Once found, the region is recorded in regions.json in the
+    cache_dir, so later runs make no request.
+
+    Args:
+        bucket (str): The name of the bucket
+        s3_client (boto3.Session.client): The client to send the HEAD bucket request with
+
+    Returns:
+        Union[str, None]: The region of the bucket, or None if the store does not report it
+    """
+    path = os.path.join(cache_dir(), REGION_CACHE_NAME)
+
+    region = _load_regions(path).get(bucket)
+    if region is not None:
+        return region
+
+    try:
+        response = s3_client.head_bucket(Bucket=bucket)
+    except s3_client.exceptions.ClientError as error:
+        response = error.response
+
+    region = response.get('ResponseMetadata',
+                          {}).get('HTTPHeaders', {}).get('x-amz-bucket-region')
+    if region is None:
+        logger.info("The region of bucket %s could not be discovered", bucket)
+        return None
+
+    # The cache is only an optimisation, so failing to write it is not an error
+    with _regions_lock:
+        try:
+            regions = _load_regions(path)
+            regions[bucket] = region
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as regions_file:
+                json.dump(regions, regions_file, indent=1, sort_keys=True)
+            os.replace(tmp_path, path)
+        except OSError as error:
+            logger.warning("Unable to cache the region of bucket %s: %s",
+                           bucket, error)
+
+    return region
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Incremental index updates from S3 event notifications
+
+Deploy handle_event as a Lambda function subscribed to the ObjectCreated and ObjectRemoved
+notifications of the repository prefix, directly or through an SQS queue to batch bursts of
+uploads.  It is configured with the same environment variables as the command line:
+PIPS3_ENDPOINT, plus the optional PIPS3_PREFIX, PIPS3_PUBLIC, PIPS3_BUCKET_OWNER_FULL_CONTROL,
+PIPS3_GZIP_INDEX and PIPS3_INDEX_CACHE_CONTROL.
+"""
+
+import json
+import logging
+import os
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+from urllib.parse import unquote_plus
+
+from pips3.base import PipS3, _ordered_map
+from pips3.exceptions import InvalidConfig
+from pips3.manifest import is_artifact
+
+logger = logging.getLogger("pips3")
+
+
+def iter_s3_records(event: dict) -> Iterator[dict]:
+    """Iterate over the S3 records of an event
+
+    Records delivered directly by S3, or wrapped in SQS messages or SNS notifications, are
+    supported.  S3 test events carry no records and are skipped.
+
+    Args:
+        event (dict): The event e.g. as passed to a Lambda function
+
+    Yields:
+        Iterator[dict]: The S3 event records
+    """
+    for record in event.get('Records', []):
+        if 's3' in record:
+            yield record
+
+        elif 'body' in record:
+            yield from iter_s3_records(json.loads(record['body']))
+
+        elif 'Sns' in record:
+            yield from iter_s3_records(json.loads(record['Sns']['Message']))
+
+
+def affected_projects(
+    records: Iterable[dict],
+    prefix: str = 'simple'
+) -> Dict[str, Tuple[Union[str, None], List[str]]]:
+    """Group the records of package files created or removed by bucket and project
+
+    Only package files trigger an update, so the indexes, manifests and metadata files
+    written by the update do not trigger further updates.
+
+    Args:
+        records (Iterable[dict]): The S3 event records
+        prefix (str, optional): The prefix of the repository. Defaults to 'simple'.
+
+    Returns:
+        Dict[str, Tuple[Union[str, None], List[str]]]: The region, if given by the records,
+            and the affected projects of each bucket, in the order first seen
+    """
+    root = f'{prefix}/' if prefix else ''
+    buckets = {}
+
+    for record in records:
+        if not record.get('eventName', '').startswith(
+                ('ObjectCreated:', 'ObjectRemoved:')):
+            continue
+
+        # Keys are URL encoded in event notifications
+        key = unquote_plus(record['s3']['object']['key'])
+        if not key.startswith(root):
+            continue
+
+        parts = key[len(root):].split('/')
+        if len(parts) != 2 or not is_artifact(parts[1]):
+            continue
+
+        bucket = record['s3']['bucket']['name']
+        _, projects = buckets.setdefault(bucket,
+                                         (record.get('awsRegion'), []))
+        if parts[0] not in projects:
+            projects.append(parts[0])
+
+    return buckets
+
+
+def update_indexes(records: Iterable[dict],
+                   endpoint: str,
+                   prefix: str = 'simple',
+                   public: bool = False,
+                   owner_full_control: bool = False,
+                   jobs: int = 4,
+                   **kwargs) -> Dict[str, List[str]]:
+    """Regenerate the index of every project affected by a batch of S3 event records
+
+    Each affected project is listed and reindexed once, however many of its files the batch
+    created or removed, and no other project is listed.  New projects are added to the root
+    index.
+
+    Args:
+        records (Iterable[dict]): The S3 event records
+        endpoint (str): The endpoint for the S3-like service
+        prefix (str, optional): The prefix of the repository. Defaults to 'simple'.
+        public (bool, optional): Set to True to enable Public Read ACL in S3.  Defaults to False
+        owner_full_control (bool, optional): Set to True to provide bucket owner full control.  Defaults to False.
+        jobs (int, optional): The number of projects reindexed concurrently. Defaults to 4.
+        **kwargs: Additional options passed to PipS3 e.g. s3_client or gzip_index
+
+    Returns:
+        Dict[str, List[str]]: The reindexed projects of each bucket
+    """
+    jobs = max(jobs, 1)
+    kwargs.setdefault('max_pool_connections', jobs)
+
+    updated = {}
+    for bucket, (region, projects) in affected_projects(records,
+                                                        prefix).items():
+        options = dict(kwargs)
+        options.setdefault('region_name', region)
+        indexer = PipS3(endpoint, bucket, prefix, **options)
+
+        def reindex(project: str) -> Tuple[str, int]:
+            objects = indexer.list_objects(package_name=project, max_workers=1)
+            manifest = indexer.reindex_project(project, objects, public,
+                                               owner_full_control)
+            return project, len(manifest)
+
+        results = list(_ordered_map(reindex, projects, jobs))
+        indexer.add_projects(
+            [project for project, files in results if files], public,
+            owner_full_control)
+
+        logger.info("Reindexed %d project(s) in %s. %s", len(results), bucket,
+                    indexer.report.summary())
+        updated[bucket] = projects
+
+    return updated
+
+
+def _env_flag(name: str) -> bool:
+    """Read a boolean option from an environment variable e.g. 1, true or yes"""
+    return os.getenv(name, '').lower() in ('1', 'true', 'yes')
+
+
+def handle_event(event: dict, context=None) -> dict:
+    """Lambda handler regenerating the indexes of the projects in a batch of S3 events
+
+    Args:
+        event (dict): The S3 event, or SQS or SNS event wrapping S3 events
+        context (optional): The Lambda context, unused. Defaults to None.
+
+    Returns:
+        dict: The reindexed projects of each bucket, under 'projects'
+
+    Raises:
+        InvalidConfig: If PIPS3_ENDPOINT is not set
+    """
+    endpoint = os.getenv('PIPS3_ENDPOINT')
+    if endpoint is None:
+        raise InvalidConfig("Error!!! S3 endpoint not specified")
+
+    projects = update_indexes(
+        iter_s3_records(event),
+        endpoint,
+        prefix=os.getenv('PIPS3_PREFIX', 'simple'),
+        public=_env_flag('PIPS3_PUBLIC'),
+        owner_full_control=_env_flag('PIPS3_BUCKET_OWNER_FULL_CONTROL'),
+        gzip_index=_env_flag('PIPS3_GZIP_INDEX'),
+        index_cache_control=os.getenv('PIPS3_INDEX_CACHE_CONTROL'))
+
+    return {'projects': projects}
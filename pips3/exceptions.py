@@ -8,4 +8,8 @@ class PackageExistsException(Exception):
 
 
 class InvalidConfig(Exception):
-    """Invalid configuration"""
\ No newline at end of file
+    """Invalid configuration"""
+
+
+class ReindexIncompleteException(Exception):
+    """Not every shard of a reindex has completed"""
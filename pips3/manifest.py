@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Project manifests"""
+
+import json
+import os
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, Union
+
+MANIFEST_NAME = 'manifest.json'
+INDEX_NAME = 'index.html'
+JSON_INDEX_NAME = 'index.json'
+
+# The list of projects, stored next to the root index
+PROJECTS_NAME = 'projects.json'
+
+# Files maintained by pips3 alongside the artifacts of a project
+RESERVED_NAMES = frozenset([INDEX_NAME, JSON_INDEX_NAME, MANIFEST_NAME])
+
+# The suffix of PEP 658 core metadata files
+METADATA_SUFFIX = '.metadata'
+
+
+def is_artifact(filename: str) -> bool:
+    """Check if a file in a project is a package, rather than a file maintained by pips3
+
+    Args:
+        filename (str): The name of the file
+
+    Returns:
+        bool: True if the file is a package
+    """
+    return filename not in RESERVED_NAMES and not filename.endswith(
+        METADATA_SUFFIX)
+
+
+def format_time(timestamp: Union[datetime, None] = None) -> str:
+    """Format a timestamp as an ISO 8601 UTC string
+
+    Args:
+        timestamp (Union[datetime, None], optional): The timestamp to format. Defaults to None,
+            to use the current time.
+
+    Returns:
+        str: The formatted timestamp e.g. 2021-03-03T01:02:03.000000Z
+    """
+    if timestamp is None:
+        timestamp = datetime.now(timezone.utc)
+    return timestamp.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class Manifest:
+    """Manifest
+
+    The record of the files published for a project, stored next to the project index so that
+    the index can be updated without listing the project.
+
+    Args:
+        project (str): The name of the project
+        files (Dict[str, dict], optional): The file records keyed by filename. Defaults to None,
+            for a project without files.
+    """
+    def __init__(self, project: str, files: Union[Dict[str, dict], None] = None):
+        self.project = project
+        self.files = {} if files is None else files
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self.files
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def __iter__(self) -> Iterator[dict]:
+        """Iterate over the file records in filename order"""
+        for filename in sorted(self.files):
+            yield dict(self.files[filename], filename=filename)
+
+    def add(self, record: dict):
+        """Add or replace a file record
+
+        Args:
+            record (dict): The file record, with the filename, size, sha256 and upload_time
+        """
+        record = dict(record)
+        self.files[record.pop('filename')] = record
+
+    def to_json(self) -> bytes:
+        """Serialise the manifest
+
+        Returns:
+            bytes: The manifest as UTF-8 encoded JSON
+        """
+        content = {'project': self.project, 'files': self.files}
+        return json.dumps(content, indent=1, sort_keys=True).encode('utf-8')
+
+    @classmethod
+    def from_json(cls, data: bytes) -> 'Manifest':
+        """Load a serialised manifest
+
+        Args:
+            data (bytes): The manifest as UTF-8 encoded JSON
+
+        Returns:
+            Manifest: The manifest
+        """
+        content = json.loads(data.decode('utf-8'))
+        return cls(content['project'], content['files'])
+
+    @classmethod
+    def from_objects(cls, project: str, objects: Iterable[dict]) -> 'Manifest':
+        """Build a manifest from a listing of the project
+
+        Hashes cannot be determined from a listing and are left empty.
+
+        Args:
+            project (str): The name of the project
+            objects (Iterable[dict]): The object summaries returned by list_objects_v2
+
+        Returns:
+            Manifest: The manifest
+        """
+        manifest = cls(project)
+        for obj in objects:
+            filename = os.path.basename(obj['Key'])
+            if not is_artifact(filename):
+                continue
+
+            manifest.add({
+                'filename': filename,
+                'size': obj['Size'],
+                'sha256': None,
+                'upload_time': format_time(obj['LastModified']),
+            })
+        return manifest
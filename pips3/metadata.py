@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Core metadata extraction"""
+
+import logging
+import re
+import tarfile
+import zipfile
+from email.parser import BytesParser
+from typing import Union
+
+logger = logging.getLogger("pips3")
+
+# The core metadata file of a wheel, and of an sdist
+WHEEL_METADATA = re.compile(r'^[^/]+\.dist-info/METADATA$')
+SDIST_METADATA = re.compile(r'^[^/]+/PKG-INFO$')
+
+TAR_EXTENSIONS = ('.tar.gz', '.tgz', '.tar.bz2', '.tar.xz', '.tar')
+
+
+def _read_zip_member(pkg_path: str, pattern) -> Union[bytes, None]:
+    """Read the first member matching a pattern, using only the zip central directory"""
+    with zipfile.ZipFile(pkg_path) as archive:
+        for name in archive.namelist():
+            if pattern.match(name):
+                return archive.read(name)
+    return None
+
+
+def _read_tar_member(pkg_path: str, pattern) -> Union[bytes, None]:
+    """Read the first member matching a pattern, streaming the tar only until that member"""
+    with tarfile.open(pkg_path, mode='r|*') as archive:
+        for member in archive:
+            if member.isfile() and pattern.match(member.name):
+                return archive.extractfile(member).read()
+    return None
+
+
+def is_reliable_sdist_metadata(metadata: bytes) -> bool:
+    """Check if the PKG-INFO of an sdist can be relied on for its dependencies
+
+    Before Metadata-Version 2.2 (PEP 643) any field of PKG-INFO may differ from the metadata of
+    the wheel built from the sdist.  From 2.2, only the fields listed as Dynamic may.
+
+    Args:
+        metadata (bytes): The contents of a PKG-INFO file
+
+    Returns:
+        bool: True if the Metadata-Version is at least 2.2 and neither Requires-Dist nor
+            Requires-Python is Dynamic
+    """
+    headers = BytesParser().parsebytes(metadata, headersonly=True)
+    try:
+        version = tuple(
+            int(part)
+            for part in str(headers.get('Metadata-Version', '')).strip().split('.'))
+    except ValueError:
+        return False
+
+    if version < (2, 2):
+        return False
+
+    dynamic = {
+        str(field).strip().lower()
+        for field in headers.get_all('Dynamic', [])
+    }
+    return not dynamic & {'requires-dist', 'requires-python'}
+
+
+def extract_metadata(pkg_path: str) -> Union[bytes, None]:
+    """Extract the core metadata of a package file
+
+    Wheels are read through the zip central directory, so only the METADATA member is
+    decompressed.  Tar sdists are streamed only as far as their PKG-INFO member.  The PKG-INFO
+    of an sdist is only returned if its dependencies are reliable, see
+    is_reliable_sdist_metadata, as installers trust published metadata for sdists too.
+
+    Args:
+        pkg_path (str): The path to the package file
+
+    Returns:
+        Union[bytes, None]: The contents of the METADATA or PKG-INFO file, or None if the
+            package is not a recognised or valid archive, or its PKG-INFO is not reliable
+    """
+    try:
+        if pkg_path.endswith('.whl'):
+            return _read_zip_member(pkg_path, WHEEL_METADATA)
+
+        if pkg_path.endswith('.zip'):
+            metadata = _read_zip_member(pkg_path, SDIST_METADATA)
+        elif pkg_path.endswith(TAR_EXTENSIONS):
+            metadata = _read_tar_member(pkg_path, SDIST_METADATA)
+        else:
+            return None
+
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError) as error:
+        logger.warning("Unable to read the metadata of %s: %s", pkg_path,
+                       error)
+        return None
+
+    if metadata is not None and not is_reliable_sdist_metadata(metadata):
+        logger.info(
+            "Not publishing the metadata of %s, which is before Metadata-Version 2.2 "
+            "or has dynamic dependencies", pkg_path)
+        return None
+
+    return metadata
+
+
+def parse_requires_python(metadata: bytes) -> Union[str, None]:
+    """Read the Requires-Python field of core metadata
+
+    Args:
+        metadata (bytes): The contents of a METADATA or PKG-INFO file
+
+    Returns:
+        Union[str, None]: The Requires-Python specifier, or None if it is not set
+    """
+    headers = BytesParser().parsebytes(metadata, headersonly=True)
+    requires_python = headers.get('Requires-Python')
+    return None if requires_python is None else str(requires_python).strip()
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Publish plans
+
+A plan lists every write a publish will make, computed from one listing of each project.  A
+plan is applied with a journal recording each completed action, so an interrupted publish is
+resumed by applying the same plan again, without repeating completed transfers.  Each plan has
+a unique id, and a journal only applies to the plan it was written for.
+"""
+
+import json
+import logging
+import os
+import threading
+import uuid
+from typing import Dict, Iterable, List, Union
+
+from pips3.base import (PipS3, PublishReport, _ordered_map, file_sha256,
+                        group_package_files, legacy_names)
+from pips3.exceptions import InvalidConfig, PackageExistsException
+from pips3.manifest import format_time
+from pips3.metadata import extract_metadata
+
+PLAN_VERSION = 2
+
+logger = logging.getLogger("pips3")
+
+
+def make_plan(uploader: PipS3,
+              upload_files: Iterable[str],
+              public: bool = False,
+              owner_full_control: bool = False) -> dict:
+    """Plan the publish of package files
+
+    Each project is listed once to check that none of its files exist, along with any legacy
+    prefix its files may have been published under.
+
+    Args:
+        uploader (PipS3): The repository to publish to
+        upload_files (Iterable[str]): The paths of the package files
+        public (bool, optional): Set to True to enable Public Read ACL in S3.  Defaults to False
+        owner_full_control (bool, optional): Set to True to provide bucket owner full control.  Defaults to False.
+
+    Returns:
+        dict: The plan, serialisable as JSON
+
+    Raises:
+        PackageExistsException: If a package file already exists
+    """
+    projects = group_package_files(upload_files)
+    actions = []
+
+    for package_name, upload_files in projects.items():
+        existing = uploader.inventory(package_name,
+                                      legacy_names(package_name, upload_files))
+
+        for upload_file in upload_files:
+            filename = os.path.basename(upload_file)
+            if filename in existing:
+                raise PackageExistsException(
+                    "Package %s already exists in the S3 Bucket for the project %s",
+                    filename, package_name)
+
+            stat = os.stat(upload_file)
+            actions.append({
+                'id': f'upload:{package_name}/{filename}',
+                'type': 'upload',
+                'project': package_name,
+                'path': os.path.abspath(upload_file),
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+            })
+
+            if extract_metadata(upload_file) is not None:
+                actions.append({
+                    'id': f'metadata:{package_name}/{filename}',
+                    'type': 'metadata',
+                    'project': package_name,
+                    'path': os.path.abspath(upload_file),
+                })
+
+    for package_name in projects:
+        actions.append({
+            'id': f'index:{package_name}',
+            'type': 'index',
+            'project': package_name,
+        })
+
+    actions.append({
+        'id': 'root_index',
+        'type': 'root_index',
+        'projects': list(projects),
+    })
+
+    return {
+        'version': PLAN_VERSION,
+        'id': uuid.uuid4().hex,
+        'endpoint': uploader.endpoint,
+        'bucket': uploader.bucket,
+        'prefix': uploader.prefix,
+        'public': public,
+        'owner_full_control': owner_full_control,
+        'actions': actions,
+    }
+
+
+class Journal:
+    """Journal
+
+    An append-only JSON lines file recording the actions of a plan that have completed, with
+    their results.  The first line records the id of the plan, and each entry is flushed to
+    disk as soon as its action completes.
+
+    Args:
+        path (str): The path of the journal file
+        plan_id (str): The id of the plan the journal records
+    """
+    def __init__(self, path: str, plan_id: str):
+        self.path = path
+        self.plan_id = plan_id
+        self._started = False
+        self._lock = threading.Lock()
+
+    def load(self) -> Dict[str, dict]:
+        """Load the completed actions
+
+        A partially written last line, from an interrupted write, is ignored.  A journal
+        written for another plan, e.g. an earlier plan saved to the same path, is ignored and
+        replaced when the first action completes.
+
+        Returns:
+            Dict[str, dict]: The result of each completed action, keyed by action id
+        """
+        completed = {}
+        try:
+            with open(self.path) as journal_file:
+                lines = iter(journal_file)
+                try:
+                    header = json.loads(next(lines, '{}'))
+                except ValueError:
+                    header = {}
+
+                if header.get('plan') != self.plan_id:
+                    logger.warning(
+                        "Ignoring %s, which was written for another plan",
+                        self.path)
+                    return completed
+
+                for line in lines:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    completed[entry['id']] = entry['result']
+        except FileNotFoundError:
+            return completed
+
+        self._started = True
+        return completed
+
+    def record(self, action_id: str, result: dict):
+        """Record that an action has completed
+
+        Args:
+            action_id (str): The id of the action
+            result (dict): The result of the action e.g. the manifest record of an upload
+        """
+        line = json.dumps({'id': action_id, 'result': result}, sort_keys=True)
+        with self._lock:
+            if not self._started:
+                line = json.dumps({'plan': self.plan_id}) + '\n' + line
+
+            with open(self.path, 'a' if self._started else 'w') as journal_file:
+                journal_file.write(line + '\n')
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            self._started = True
+
+    def remove(self):
+        """Remove the journal, once every action of the plan has completed"""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def apply_plan(uploader: PipS3,
+               plan: dict,
+               journal: Journal,
+               jobs: int = 1) -> PublishReport:
+    """Apply a plan, skipping the actions completed by an earlier attempt
+
+    Uploads and metadata writes run on `jobs` threads, followed by the index of each project
+    and the root index.  Each project with files left to upload is listed again before
+    anything is written, so a file published by another run since the plan was made is never
+    overwritten.  A file found identical to the planned file was uploaded by an earlier attempt
+    that stopped before journaling it, and is journaled as completed.  The journal is removed
+    once every action has completed.
+
+    Args:
+        uploader (PipS3): The repository to publish to
+        plan (dict): The plan from make_plan
+        journal (Journal): The journal of completed actions
+        jobs (int, optional): The number of actions applied concurrently. Defaults to 1.
+
+    Returns:
+        PublishReport: The counts of the writes made and actions skipped
+
+    Raises:
+        InvalidConfig: If the plan is for another repository or a package file has changed
+            since it was planned
+        PackageExistsException: If a package file left to upload has been published with
+            different content since the plan was made
+    """
+    if plan.get('version') != PLAN_VERSION:
+        raise InvalidConfig(f"Unsupported plan version {plan.get('version')}")
+
+    if (plan['bucket'], plan['prefix']) != (uploader.bucket, uploader.prefix):
+        raise InvalidConfig(
+            f"The plan is for s3://{plan['bucket']}/{plan['prefix']}, "
+            f"not s3://{uploader.bucket}/{uploader.prefix}")
+
+    completed = journal.load()
+
+    # Check every package file left to upload before writing anything
+    uploads = [
+        action for action in plan['actions']
+        if action['type'] == 'upload' and action['id'] not in completed
+    ]
+    for action in uploads:
+        stat = os.stat(action['path'])
+        if (stat.st_size,
+                stat.st_mtime_ns) != (action['size'], action['mtime_ns']):
+            raise InvalidConfig(
+                f"{action['path']} has changed since it was planned")
+
+    projects: Dict[str, List[str]] = {}
+    for action in uploads:
+        projects.setdefault(action['project'], []).append(action['path'])
+
+    def check(package_name: str) -> Dict[str, dict]:
+        return uploader.inventory(
+            package_name, legacy_names(package_name, projects[package_name]))
+
+    inventories = dict(
+        zip(projects, _ordered_map(check, projects, max(jobs, 1))))
+
+    for action in uploads:
+        filename = os.path.basename(action['path'])
+        obj = inventories[action['project']].get(filename)
+        if obj is None:
+            continue
+
+        key = f"{uploader.prefix}/{action['project']}/{filename}"
+        if obj['Key'] != key or not uploader.is_identical(action['path'], obj):
+            raise PackageExistsException(
+                "Package %s already exists in the S3 Bucket for the project %s",
+                filename, action['project'])
+
+        logger.info("%s was uploaded by an earlier attempt", filename)
+        completed[action['id']] = {
+            'filename': filename,
+            'size': obj['Size'],
+            'sha256': file_sha256(action['path']),
+            'upload_time': format_time(obj['LastModified']),
+        }
+        journal.record(action['id'], completed[action['id']])
+
+    public = plan['public']
+    owner_full_control = plan['owner_full_control']
+    report = uploader.report
+
+    def run(action: dict) -> dict:
+        if action['id'] in completed:
+            report.count('actions_skipped')
+            return completed[action['id']]
+
+        if action['type'] == 'upload':
+            with report.timed('upload'):
+                result = uploader.upload_package(
+                    action['path'], action['project'], public,
+                    owner_full_control, inventories[action['project']])
+
+        elif action['type'] == 'metadata':
+            with report.timed('upload'):
+                result = uploader.upload_metadata(action['path'],
+                                                  action['project'], public,
+                                                  owner_full_control)
+
+        elif action['type'] == 'index':
+            with report.timed('index'):
+                uploader.publish_index(action['project'],
+                                       records.get(action['project'], []),
+                                       public, owner_full_control)
+            result = {}
+
+        else:
+            with report.timed('index'):
+                uploader.add_projects(action['projects'], public,
+                                      owner_full_control)
+            result = {}
+
+        journal.record(action['id'], result)
+        return result
+
+    actions = plan['actions']
+    transfers = [
+        action for action in actions
+        if action['type'] in ('upload', 'metadata')
+    ]
+
+    # Merge the result of each upload and metadata write into the manifest record of the file
+    records: Dict[str, Dict[str, dict]] = {}
+    for action, result in zip(transfers,
+                              _ordered_map(run, transfers, max(jobs, 1))):
+        filename = os.path.basename(action['path'])
+        records.setdefault(action['project'],
+                           {}).setdefault(filename, {}).update(result)
+
+    records = {
+        project: [dict(record, filename=filename)
+                  for filename, record in files.items()]
+        for project, files in records.items()
+    }
+
+    indexes = [action for action in actions if action['type'] == 'index']
+    for _ in _ordered_map(run, indexes, max(jobs, 1)):
+        pass
+
+    for action in actions:
+        if action['type'] == 'root_index':
+            run(action)
+
+    journal.remove()
+    return report
+
+
+def plan_packages(endpoint: str,
+                  bucket: str,
+                  public: bool = False,
+                  owner_full_control: bool = False,
+                  upload_files: Union[List[str], None] = None,
+                  **kwargs) -> dict:
+    """Plan the publish of the current package files
+
+    Args:
+        endpoint (str): The endpoint for the S3-like service
+        bucket (str): The name of the bucket to use
+        public (bool): Set to True to enable Public Read ACL in S3
+        owner_full_control (bool): Set to True to transfer ownership in S3 to bucket owner
+        upload_files (Union[List[str], None], optional): The package files. Defaults to None,
+            for the files found by PipS3.find_package_files.
+        **kwargs: Additional options passed to PipS3
+
+    Returns:
+        dict: The plan
+    """
+    if upload_files is None:
+        upload_files = PipS3.find_package_files()
+
+    uploader = PipS3(endpoint, bucket, **kwargs)
+    return make_plan(uploader, upload_files, public, owner_full_control)
+
+
+def apply_packages(plan: dict,
+                   journal_path: str,
+                   jobs: int = 1,
+                   **kwargs) -> PublishReport:
+    """Apply a plan to the repository it was made for
+
+    Args:
+        plan (dict): The plan from plan_packages
+        journal_path (str): The path of the journal, created if it does not exist and removed
+            once the plan has been applied
+        jobs (int, optional): The number of actions applied concurrently. Defaults to 1.
+        **kwargs: Additional options passed to PipS3 e.g. gzip_index
+
+    Returns:
+        PublishReport: The counts of the writes made and actions skipped
+    """
+    kwargs.setdefault('prefix', plan['prefix'])
+    kwargs.setdefault('max_pool_connections', max(jobs, 1))
+
+    uploader = PipS3(plan['endpoint'], plan['bucket'], **kwargs)
+    return apply_plan(uploader, plan, Journal(journal_path, plan.get('id')),
+                      jobs)
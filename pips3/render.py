@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Streaming index renderers"""
+
+import html
+import json
+from typing import BinaryIO, Dict, Iterable, Iterator, Tuple
+
+INDEX_TEMPLATE_INTO = "<!DOCTYPE html>\n<html>\n  <body>"
+INDEX_TEMPLATE_OUTTRO = "\n  </body>\n</html>"
+
+# PEP 691 JSON simple API, with the size and upload-time of PEP 700
+JSON_API_VERSION = "1.1"
+JSON_CONTENT_TYPE = "application/vnd.pypi.simple.v1+json"
+
+
+def iter_html_index(
+        links: Iterable[Tuple[str, str, Dict[str, str]]]) -> Iterator[str]:
+    """Render an HTML index page in chunks
+
+    Args:
+        links (Iterable[Tuple[str, str, Dict[str, str]]]): The url, text and any additional
+            attributes, such as data-requires-python, of each link
+
+    Yields:
+        Iterator[str]: The chunks of the page
+    """
+    yield INDEX_TEMPLATE_INTO
+
+    for url, text, attributes in links:
+        attrs = ''.join(f" {name}=\"{html.escape(value)}\""
+                        for name, value in sorted(attributes.items()))
+        yield f"\n    <a href=\"{url}\"{attrs}>{text}</a>"
+
+    yield INDEX_TEMPLATE_OUTTRO
+
+
+def iter_json_index(project: str, files: Iterable[dict],
+                    versions: Iterable[str]) -> Iterator[str]:
+    """Render a PEP 691 JSON project page in chunks
+
+    The output is identical to json.dumps(..., sort_keys=True) of the whole page, but only
+    one file entry is held in memory at a time.
+
+    Args:
+        project (str): The name of the project
+        files (Iterable[dict]): The file entries of the page
+        versions (Iterable[str]): The versions of the project.  Only read once the files have
+            been rendered, so it may be filled in while the files are consumed.
+
+    Yields:
+        Iterator[str]: The chunks of the page
+    """
+    yield '{"files": ['
+
+    separator = ''
+    for entry in files:
+        yield separator + json.dumps(entry, sort_keys=True)
+        separator = ', '
+
+    yield '], "meta": ' + json.dumps({'api-version': JSON_API_VERSION})
+    yield ', "name": ' + json.dumps(project)
+    yield ', "versions": ' + json.dumps(sorted(versions)) + '}'
+
+
+def write_chunks(chunks: Iterable[str],
+                 sink: BinaryIO,
+                 batch_size: int = 1024) -> int:
+    """Encode rendered chunks into a binary file-like object
+
+    Chunks are written in batches to limit the number of calls to the sink.
+
+    Args:
+        chunks (Iterable[str]): The rendered chunks
+        sink (BinaryIO): The file-like object to write to
+        batch_size (int, optional): The number of chunks written at once. Defaults to 1024.
+
+    Returns:
+        int: The number of bytes written
+    """
+    written = 0
+    batch = []
+
+    for chunk in chunks:
+        batch.append(chunk)
+
+        if len(batch) >= batch_size:
+            written += sink.write(''.join(batch).encode('utf-8'))
+            batch = []
+
+    if batch:
+        written += sink.write(''.join(batch).encode('utf-8'))
+
+    return written
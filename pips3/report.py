@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Publish reports"""
+
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+class PublishReport:
+    """PublishReport
+
+    Thread-safe counters describing the requests made by a PipS3 instance, e.g. the number of
+    index writes that were skipped because the stored object was already up to date, and the
+    time spent in each stage of a publish.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = Counter()
+        self.timings = {}
+        self.transfers = {}
+        self.conflicts = []
+
+    def count(self, name: str, amount: int = 1):
+        """Increment a counter
+
+        Args:
+            name (str): The name of the counter
+            amount (int, optional): The amount to add. Defaults to 1.
+        """
+        with self._lock:
+            self.counts[name] += amount
+
+    def summary(self) -> str:
+        """Summarise the report for display
+
+        Returns:
+            str: A one line summary of the counters
+        """
+        return (f"Uploaded {self.counts['uploads']} package(s), "
+                f"wrote {self.counts['writes']} index object(s), "
+                f"skipped {self.counts['writes_skipped']} unchanged")
+
+    def transfer(self, filename: str, **settings):
+        """Record the transfer settings chosen for a file
+
+        Args:
+            filename (str): The name of the file
+            **settings: The settings e.g. part_size and concurrency
+        """
+        with self._lock:
+            self.transfers[filename] = settings
+
+    def conflict(self, path: str):
+        """Record a local file with different content to its published file
+
+        Args:
+            path (str): The path of the local file
+        """
+        with self._lock:
+            self.counts['conflicts'] += 1
+            self.conflicts.append(path)
+
+    def sync_summary(self) -> str:
+        """Summarise the comparison of local files to published files for display
+
+        Returns:
+            str: A one line summary of the identical files and conflicts
+        """
+        return (f"Skipped {self.counts['identical']} identical file(s), "
+                f"{self.counts['conflicts']} conflict(s)")
+
+    @contextmanager
+    def timed(self, stage: str):
+        """Add the time spent in a block to the total of a stage
+
+        Stages running on several threads at once accumulate the time spent by each thread.
+
+        Args:
+            stage (str): The name of the stage e.g. 'upload'
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.timings[stage] = self.timings.get(stage, 0.0) + elapsed
+
+    def timing_summary(self) -> str:
+        """Summarise the stage timings for display
+
+        Returns:
+            str: A one line summary of the seconds spent in each stage, in the order the
+                stages started
+        """
+        return "Stage seconds: " + ", ".join(
+            f"{stage} {seconds:.2f}" for stage, seconds in self.timings.items())
+
+    def transfer_summary(self) -> str:
+        """Summarise the transfer settings of each file for display
+
+        Returns:
+            str: One line per file with its size, part size and concurrency
+        """
+        return "\n".join(
+            f"{filename}: {settings['size'] / 2**20:.1f} MiB in "
+            f"{settings['part_size'] // 2**20} MiB parts, "
+            f"concurrency {settings['concurrency']}"
+            for filename, settings in sorted(self.transfers.items()))
@@ -22,7 +22,7 @@ setup_requirements = [
 test_requirements = [
     'pytest>=6.1.1',
     'pytest-cov>=2.10.1',
-    'moto>=1.3.16',
+    'moto[s3]>=4.2.14,<5',
 ]
 
 setup(
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Shared test fixtures"""
+
+import io
+import tarfile
+import zipfile
+
+import pytest
+
+METADATA = b"""Metadata-Version: 2.2
+Name: pips3
+Version: 0.1.0
+Requires-Python: >=3.6
+Requires-Dist: boto3
+
+Long description
+"""
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Keep the on-disk caches, e.g. bucket regions, out of the user's cache directory"""
+    path = tmp_path / 'cache'
+    monkeypatch.setenv('PIPS3_CACHE_DIR', str(path))
+    return path
+
+
+@pytest.fixture
+def core_metadata():
+    """The core metadata of the packages written by make_wheel and make_sdist"""
+    return METADATA
+
+
+@pytest.fixture
+def make_wheel():
+    """Write a minimal wheel"""
+    def make(path, metadata=METADATA):
+        with zipfile.ZipFile(path, 'w') as archive:
+            archive.writestr('pips3/__init__.py', b'')
+            archive.writestr('pips3-0.1.0.dist-info/METADATA', metadata)
+            archive.writestr('pips3-0.1.0.dist-info/RECORD', b'')
+        return str(path)
+
+    return make
+
+
+@pytest.fixture
+def make_sdist():
+    """Write a minimal sdist, with a nested PKG-INFO that must be ignored"""
+    def make(path, metadata=METADATA):
+        with tarfile.open(path, 'w:gz') as archive:
+            for name, content in [
+                ('pips3-0.1.0/pips3.egg-info/PKG-INFO', b'Name: wrong\n'),
+                ('pips3-0.1.0/PKG-INFO', metadata),
+                ('pips3-0.1.0/setup.py', b''),
+            ]:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+        return str(path)
+
+    return make
@@ -2,21 +2,40 @@
 # -*- coding: utf-8 -*-
 """Tests for `pips3` package."""
 
+import bisect
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
 import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import MagicMock, call, patch
 
 import boto3
 import pytest
+from botocore.exceptions import ClientError
 from moto import mock_s3
 
-from pips3 import PipS3, publish_packages
-from pips3.base import get_package_name
-from pips3.exceptions import PackageExistsException
+from pips3 import (PipS3, complete_reindex, publish_packages,
+                   reindex_packages)
+from pips3.base import (PART_SIZE_METADATA, _HashingReader, _split_points,
+                        file_etag, file_sha256, get_package_name,
+                        get_package_version, normalize_name, shard_of)
+from pips3.exceptions import (PackageExistsException,
+                              ReindexIncompleteException)
+from pips3.manifest import Manifest
 
 ENDPOINT_URL = "http://localhost:9000"
 BUCKET = 'pips3'
 PREFIX = 'listing'
 
+# The test package assets are empty files
+EMPTY_SHA256 = 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
+
 
 @mock_s3
 def test_list_bucket():
@@ -87,6 +106,292 @@ def test_list_project():
     assert keys == expected_keys
 
 
+@mock_s3
+def test_list_project_pages_keep_prefix():
+    """Test every page of a project listing stays within the project"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    expected_keys = []
+    for pkg_name in ['proj1', 'proj10', 'proj2']:
+        for i in range(5):
+            key = f'{PREFIX}/{pkg_name}/{i}.bin'
+            s3_client.put_object(Bucket=BUCKET, Body=b'', Key=key)
+
+            if pkg_name == 'proj1':
+                expected_keys.append(key)
+
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client)
+
+    keys = list(obj.list_keys(package_name='proj1', max_keys=2))
+
+    assert keys == expected_keys
+
+
+@mock_s3
+def test_list_keys_resume_from_checkpoint(tmp_path):
+    """Test an interrupted listing resumes from its checkpoint"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    expected_keys = []
+    for i in range(10):
+        key = f'{PREFIX}/pkg1/{i}.bin'
+        s3_client.put_object(Bucket=BUCKET, Body=b'', Key=key)
+        expected_keys.append(key)
+
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client)
+    checkpoint = str(tmp_path / 'listing.json')
+
+    # Consume the first two pages then stop half way through the third
+    first_keys = []
+    for key in obj.list_keys(max_keys=2, checkpoint=checkpoint):
+        first_keys.append(key)
+        if len(first_keys) == 5:
+            break
+
+    resumed_keys = list(obj.list_keys(max_keys=2, checkpoint=checkpoint))
+
+    assert first_keys == expected_keys[:5]
+    assert resumed_keys == expected_keys[4:]
+    assert not (tmp_path / 'listing.json').exists()
+
+
+@mock_s3
+def test_list_projects():
+    """Test discovering projects without listing their files"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    for pkg_name in ['proj2', 'proj1', 'proj10']:
+        for i in range(3):
+            s3_client.put_object(Bucket=BUCKET,
+                                 Body=b'',
+                                 Key=f'{PREFIX}/{pkg_name}/{i}.bin')
+    s3_client.put_object(Bucket=BUCKET, Body=b'', Key=f'{PREFIX}/index.html')
+
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client)
+
+    assert list(obj.list_projects(max_keys=2)) == ['proj1', 'proj10', 'proj2']
+
+
+@mock_s3
+def test_list_keys_parallel():
+    """Test the parallel listing returns the same ordered stream as a sequential listing"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    for pkg_name in ['a', 'b', 'c', 'd', 'e']:
+        for i in range(4):
+            s3_client.put_object(Bucket=BUCKET,
+                                 Body=b'',
+                                 Key=f'{PREFIX}/{pkg_name}/{i}.bin')
+    s3_client.put_object(Bucket=BUCKET, Body=b'', Key=f'{PREFIX}/c.html')
+
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client, max_workers=3)
+
+    sequential = list(obj.list_keys(max_keys=3, max_workers=1))
+    parallel = list(obj.list_keys(max_keys=3))
+
+    assert len(sequential) == 21
+    assert parallel == sequential
+
+
+@mock_s3
+def test_list_project_sharded():
+    """Test a single project listed in concurrent key ranges matches a sequential listing"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    for i in range(1, 120):
+        s3_client.put_object(
+            Bucket=BUCKET,
+            Body=b'',
+            Key=f'{PREFIX}/pips3/pips3-0.1.0.dev{i}-py3-none-any.whl')
+    s3_client.put_object(Bucket=BUCKET,
+                         Body=b'',
+                         Key=f'{PREFIX}/pips3/pips3-0.2.0.tar.gz')
+    s3_client.put_object(Bucket=BUCKET,
+                         Body=b'',
+                         Key=f'{PREFIX}/pips3-extra/pips3-extra-0.1.0.tar.gz')
+
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client, max_workers=4)
+
+    sequential = list(
+        obj.list_keys(package_name='pips3', max_keys=10, max_workers=1))
+    sharded = list(obj.list_keys(package_name='pips3', max_keys=10))
+
+    assert len(sequential) == 120
+    assert sharded == sequential
+
+
+def _probe(keys):
+    """A probe over sorted keys, like a StartAfter listing of one key"""
+    def probe(start_after):
+        index = bisect.bisect_right(keys, start_after)
+        return keys[index] if index < len(keys) else None
+
+    return probe
+
+
+def _range_sizes(keys, after, points):
+    """The number of keys after a key in each range (lower, upper] between split points"""
+    bounds = [after] + points
+    sizes = [0] * len(bounds)
+    for key in keys:
+        if key > after:
+            sizes[bisect.bisect_left(bounds, key) - 1] += 1
+    return sizes
+
+
+def test_split_points():
+    """Test split points follow the version digits after the first key"""
+
+    keys = [f'simple/p/p-0.1.dev1{i:02d}.whl' for i in range(100)]
+
+    points = _split_points(_probe(keys), 'simple/p/', keys[9], 4)
+
+    assert points == sorted(points)
+    assert all(point > keys[9] for point in points)
+    assert len(points) == 4
+    assert all(point.startswith('simple/p/p-0.1.dev1') for point in points)
+
+
+@pytest.mark.parametrize('versions', [
+    [f'0.1.0.dev{i}' for i in range(1, 30001)],
+    [f'1.0.0.dev{20200101 + day * 100 + build}'
+     for day in range(300) for build in range(100)],
+    [f'{major}.{minor}.{patch}'
+     for major in range(3) for minor in range(100) for patch in range(100)],
+])
+def test_split_points_balance(versions):
+    """Test split points spread the keys after the first page across every range"""
+
+    keys = sorted(f'simple/p/p-{version}-py3-none-any.whl'
+                  for version in versions)
+    probes = []
+
+    def probe(start_after):
+        probes.append(start_after)
+        return _probe(keys)(start_after)
+
+    points = _split_points(probe, 'simple/p/', keys[999], 7)
+    sizes = _range_sizes(keys, keys[999], points)
+
+    assert len(points) == 7
+    assert sum(sizes) == len(keys) - 1000
+    assert max(sizes) < 0.4 * sum(sizes)
+    assert len(probes) < 100
+
+
+class SortedListingClient:
+    """A local stand-in for S3 listing a sorted list of keys, with a delay per request"""
+    def __init__(self, keys, delay=0.0):
+        self.keys = sorted(keys)
+        self.delay = delay
+        self.listed = {}
+        self.lock = threading.Lock()
+
+    def list_objects_v2(self,
+                        Bucket,
+                        Prefix,
+                        MaxKeys=1000,
+                        StartAfter='',
+                        ContinuationToken=None):
+        """Return a page of keys after StartAfter or the continuation token"""
+        time.sleep(self.delay)
+        start = bisect.bisect_right(self.keys, ContinuationToken
+                                    or StartAfter)
+        page = [key for key in self.keys[start:start + MaxKeys]
+                if key.startswith(Prefix)]
+
+        # Count the keys listed by each worker, leaving out the first page and probes
+        if StartAfter and MaxKeys > 1:
+            with self.lock:
+                thread = threading.get_ident()
+                self.listed[thread] = self.listed.get(thread, 0) + len(page)
+
+        response = {'Contents': [{'Key': key, 'Size': 1} for key in page]}
+        if len(page) == MaxKeys and start + MaxKeys < len(self.keys):
+            response['NextContinuationToken'] = page[-1]
+        return response
+
+
+def test_list_project_sharded_balance():
+    """Test idle workers split the ranges still being listed"""
+
+    # Most keys fall in the first digit band, which the initial split points do not divide
+    keys = [
+        f'{PREFIX}/pkg/pkg-0.1.0.dev{i}-py3-none-any.whl'
+        for i in range(1, 30001)
+    ]
+    s3_client = SortedListingClient(keys, delay=0.002)
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client, max_workers=4)
+
+    listed = list(obj.list_keys(package_name='pkg', max_keys=100))
+
+    assert listed == sorted(keys)
+    assert len(s3_client.listed) == 4
+    assert max(s3_client.listed.values()) < 0.5 * len(keys)
+
+
+class FakeListingClient:
+    """A local stand-in for S3 that synthesises sorted keys on demand"""
+    def __init__(self, keys_per_project: int, projects=('pkg', )):
+        self.keys_per_project = keys_per_project
+        self.projects = sorted(projects)
+        self.calls = 0
+
+    def _key(self, index: int) -> str:
+        project = self.projects[index // self.keys_per_project]
+        return f'{PREFIX}/{project}/{index % self.keys_per_project:07d}.whl'
+
+    def list_objects_v2(self,
+                        Bucket,
+                        Prefix,
+                        MaxKeys=1000,
+                        ContinuationToken=None):
+        """Return a page of synthetic keys, ignoring the prefix"""
+        self.calls += 1
+        total = self.keys_per_project * len(self.projects)
+        start = 0 if ContinuationToken is None else int(ContinuationToken)
+        stop = min(start + MaxKeys, total)
+
+        response = {
+            'Contents': [{
+                'Key': self._key(i),
+                'Size': 1
+            } for i in range(start, stop)],
+            'IsTruncated': stop < total,
+        }
+        if stop < total:
+            response['NextContinuationToken'] = str(stop)
+        return response
+
+
+def test_list_keys_scale():
+    """Test listing a million keys iterates without recursion"""
+
+    num_keys = 1000000
+    s3_client = FakeListingClient(num_keys)
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client)
+
+    count = 0
+    last_key = ''
+    for key in obj.list_keys():
+        assert key > last_key
+        last_key = key
+        count += 1
+
+    assert count == num_keys
+    assert s3_client.calls == num_keys // 1000
+
+
 def test_find_packages():
     """Test finding packages"""
 
@@ -150,7 +455,7 @@ def test_upload_package():
 
     package_name = "pips3"
 
-    obj.upload_package(fake_pkg, package_name, True, True)
+    obj.upload_package(fake_pkg, package_name, True)
 
     # Check the file exists at the expected path
     metadata = s3_client.get_object_acl(
@@ -158,11 +463,563 @@ def test_upload_package():
 
     _assert_pkg_metadata(metadata)
 
+    # Bucket owner full control takes precedence over the public ACL
+    obj.upload_package(fake_pkg, 'other', True, True)
+    metadata = s3_client.get_object_acl(Bucket=BUCKET,
+                                        Key=f'{PREFIX}/other/{fake_pkg}')
+    assert [grant['Permission'] for grant in metadata['Grants']] == ['FULL_CONTROL']
+
     # Test error when trying to upload twice
     with pytest.raises(PackageExistsException):
         obj.upload_package(fake_pkg, package_name)
 
 
+@mock_s3
+def test_upload_package_hashes_single_pass(tmp_path):
+    """Test the digest is computed from the single read that feeds the upload"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    content = bytes(range(256)) * 4096
+    pkg_path = tmp_path / 'pips3-0.1.0.tar.gz'
+    pkg_path.write_bytes(content)
+
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client)
+
+    reads = []
+    original_read = _HashingReader.read
+
+    def counting_read(self, size=-1):
+        data = original_read(self, size)
+        reads.append(len(data))
+        return data
+
+    with patch.object(_HashingReader, 'read', counting_read):
+        record = obj.upload_package(str(pkg_path), 'pips3')
+
+    assert sum(reads) == len(content)
+    assert record['size'] == len(content)
+    assert record['sha256'] == hashlib.sha256(content).hexdigest()
+
+    uploaded = s3_client.get_object(Bucket=BUCKET,
+                                    Key=f'{PREFIX}/pips3/{pkg_path.name}')
+    assert uploaded['Body'].read() == content
+
+
+@mock_s3
+def test_index_hash_fragments():
+    """Test index links carry the sha256 of files known to the manifest"""
+
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX)
+    manifest = Manifest('pips3')
+    manifest.add({
+        'filename': 'pips3-0.1.0.whl',
+        'size': 0,
+        'sha256': EMPTY_SHA256,
+        'upload_time': '2021-03-03T00:00:00.000000Z'
+    })
+    manifest.add({
+        'filename': 'pips3-0.0.1.whl',
+        'size': 0,
+        'sha256': None,
+        'upload_time': '2021-03-03T00:00:00.000000Z'
+    })
+
+    index = obj.generate_index(manifest=manifest)
+
+    assert f'<a href="{ENDPOINT_URL}/{PREFIX}/pips3/pips3-0.0.1.whl">' in index
+    assert (f'<a href="{ENDPOINT_URL}/{PREFIX}/pips3/pips3-0.1.0.whl'
+            f'#sha256={EMPTY_SHA256}">') in index
+
+
+@mock_s3
+def test_upload_metadata(tmp_path, make_wheel, core_metadata):
+    """Test the core metadata of a wheel is published alongside it"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    pkg_path = make_wheel(tmp_path / 'pips3-0.1.0-py3-none-any.whl')
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client)
+
+    record = obj.upload_package(pkg_path, 'pips3')
+    record.update(obj.upload_metadata(pkg_path, 'pips3'))
+    manifest = obj.update_manifest('pips3', [record])
+
+    metadata = s3_client.get_object(
+        Bucket=BUCKET,
+        Key=f'{PREFIX}/pips3/pips3-0.1.0-py3-none-any.whl.metadata')
+    assert metadata['Body'].read() == core_metadata
+
+    metadata_sha256 = hashlib.sha256(core_metadata).hexdigest()
+    assert record['metadata_sha256'] == metadata_sha256
+    assert record['requires_python'] == '>=3.6'
+
+    index = obj.generate_index(manifest=manifest)
+    assert (f'data-core-metadata="sha256={metadata_sha256}" '
+            f'data-dist-info-metadata="sha256={metadata_sha256}" '
+            f'data-requires-python="&gt;=3.6">') in index
+
+    json_index = json.loads(obj.generate_json_index(manifest=manifest))
+    entry = json_index['files'][0]
+    assert entry['core-metadata'] == {'sha256': metadata_sha256}
+    assert entry['dist-info-metadata'] == {'sha256': metadata_sha256}
+    assert entry['requires-python'] == '>=3.6'
+
+    # The sidecar is not listed as a package
+    listed = obj.generate_index(package_name='pips3')
+    assert '.metadata' not in listed
+
+    # Packages without readable metadata publish without a sidecar
+    assert obj.upload_metadata('tests/assets/pips3-0.1.0.whl', 'pips3') == {}
+
+
+def _client_error(code: str, operation: str) -> ClientError:
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+def test_upload_package_existing_files():
+    """Test existence is checked against the inventory without HEAD requests"""
+
+    s3_client = MagicMock()
+    s3_client.exceptions.ClientError = ClientError
+
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client)
+
+    with pytest.raises(PackageExistsException):
+        obj.upload_package('tests/assets/pips3-0.1.0.whl',
+                           'pips3',
+                           existing={'pips3-0.1.0.whl': {}})
+
+    obj.upload_package('tests/assets/pips3-0.1.0.whl',
+                       'pips3',
+                       existing={'pips3-0.1.0.dev0.whl': {}})
+
+    s3_client.head_object.assert_not_called()
+    s3_client.upload_fileobj.assert_called_once()
+
+
+def test_upload_package_head_errors():
+    """Test only a 404 from the HEAD request means the package does not exist"""
+
+    s3_client = MagicMock()
+    s3_client.exceptions.ClientError = ClientError
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client)
+
+    for code in ['403', 'SlowDown']:
+        s3_client.head_object.side_effect = _client_error(code, 'HeadObject')
+
+        with pytest.raises(ClientError):
+            obj.upload_package('tests/assets/pips3-0.1.0.whl', 'pips3')
+
+    s3_client.upload_fileobj.assert_not_called()
+
+    s3_client.head_object.side_effect = _client_error('404', 'HeadObject')
+    obj.upload_package('tests/assets/pips3-0.1.0.whl', 'pips3')
+
+    s3_client.upload_fileobj.assert_called_once()
+
+
+def test_upload_package_conditional():
+    """Test conditional writes create the package in one request and map 412 to exists"""
+
+    s3_client = MagicMock()
+    s3_client.exceptions.ClientError = ClientError
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client, conditional_writes=True)
+
+    record = obj.upload_package('tests/assets/pips3-0.1.0.whl', 'pips3', public=True)
+
+    s3_client.put_object.assert_called_once_with(Bucket=BUCKET,
+                                                 Key=f'{PREFIX}/pips3/pips3-0.1.0.whl',
+                                                 Body=b'',
+                                                 IfNoneMatch='*',
+                                                 ACL='public-read')
+    assert record['sha256'] == hashlib.sha256(b'').hexdigest()
+
+    s3_client.put_object.side_effect = _client_error('PreconditionFailed', 'PutObject')
+
+    with pytest.raises(PackageExistsException):
+        obj.upload_package('tests/assets/pips3-0.1.0.whl', 'pips3')
+
+    s3_client.put_object.side_effect = _client_error('SlowDown', 'PutObject')
+
+    with pytest.raises(ClientError):
+        obj.upload_package('tests/assets/pips3-0.1.0.whl', 'pips3')
+
+    s3_client.head_object.assert_not_called()
+    s3_client.upload_fileobj.assert_not_called()
+    assert obj.report.counts['uploads'] == 1
+
+
+def test_upload_package_conditional_multipart(tmp_path):
+    """Test large conditional uploads apply the condition on completion and abort on failure"""
+
+    pkg_path = tmp_path / 'pips3-0.1.0-py3-none-any.whl'
+    pkg_path.write_bytes(b'x' * 25)
+
+    s3_client = MagicMock()
+    s3_client.exceptions.ClientError = ClientError
+    s3_client.create_multipart_upload.return_value = {'UploadId': 'upload'}
+
+    # Every part waits until all three are in flight, so they must be uploaded concurrently
+    in_flight = threading.Barrier(3, timeout=5)
+
+    def upload_part(**kwargs):
+        in_flight.wait()
+        return {'ETag': str(kwargs['PartNumber'])}
+
+    s3_client.upload_part.side_effect = upload_part
+
+    obj = PipS3(ENDPOINT_URL,
+                BUCKET,
+                PREFIX,
+                s3_client,
+                conditional_writes=True,
+                part_size=10,
+                max_concurrency=3)
+    record = obj.upload_package(str(pkg_path), 'pips3')
+
+    key = f'{PREFIX}/pips3/pips3-0.1.0-py3-none-any.whl'
+    assert sorted((kwargs['PartNumber'], kwargs['Body'])
+                  for _, kwargs in s3_client.upload_part.call_args_list) == [
+                      (1, b'x' * 10), (2, b'x' * 10), (3, b'x' * 5)
+                  ]
+    s3_client.complete_multipart_upload.assert_called_once_with(
+        Bucket=BUCKET,
+        Key=key,
+        UploadId='upload',
+        MultipartUpload={
+            'Parts': [{
+                'ETag': str(i),
+                'PartNumber': i
+            } for i in range(1, 4)]
+        },
+        IfNoneMatch='*')
+    assert record['sha256'] == hashlib.sha256(b'x' * 25).hexdigest()
+    s3_client.abort_multipart_upload.assert_not_called()
+
+    s3_client.complete_multipart_upload.side_effect = _client_error(
+        '412', 'CompleteMultipartUpload')
+
+    with pytest.raises(PackageExistsException):
+        obj.upload_package(str(pkg_path), 'pips3')
+
+    s3_client.abort_multipart_upload.assert_called_once_with(Bucket=BUCKET,
+                                                             Key=key,
+                                                             UploadId='upload')
+
+
+def test_upload_package_conditional_multipart_memory(tmp_path):
+    """Test conditional multipart uploads hold at most max_concurrency parts in memory"""
+
+    pkg_path = tmp_path / 'pips3-0.1.0-py3-none-any.whl'
+    pkg_path.write_bytes(b'x' * 95)
+
+    lock = threading.Lock()
+    buffered = [0]
+    most_buffered = [0]
+    original_read = _HashingReader.read
+
+    def counting_read(self, size=-1):
+        data = original_read(self, size)
+        if data:
+            with lock:
+                buffered[0] += 1
+                most_buffered[0] = max(most_buffered[0], buffered[0])
+        return data
+
+    def upload_part(**kwargs):
+        time.sleep(0.01)
+        with lock:
+            buffered[0] -= 1
+        return {'ETag': str(kwargs['PartNumber'])}
+
+    s3_client = MagicMock()
+    s3_client.exceptions.ClientError = ClientError
+    s3_client.create_multipart_upload.return_value = {'UploadId': 'upload'}
+    s3_client.upload_part.side_effect = upload_part
+
+    obj = PipS3(ENDPOINT_URL,
+                BUCKET,
+                PREFIX,
+                s3_client,
+                conditional_writes=True,
+                part_size=10,
+                max_concurrency=2)
+
+    with patch.object(_HashingReader, 'read', counting_read):
+        obj.upload_package(str(pkg_path), 'pips3')
+
+    assert s3_client.upload_part.call_count == 10
+    assert most_buffered[0] == 2
+
+
+@mock_s3
+@patch('pips3.base.PipS3.find_package_files',
+       return_value=['tests/assets/pips3-0.1.0.whl'])
+def test_publish_packages_conditional(files_mock):
+    """Test publishing with conditional writes does not list or HEAD the project first"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    with patch('pips3.base.get_s3_client', return_value=s3_client), \
+            patch('pips3.base.PipS3.inventory') as inventory_mock:
+        report = publish_packages(ENDPOINT_URL, BUCKET, conditional_writes=True)
+
+    inventory_mock.assert_not_called()
+    assert report.counts['uploads'] == 1
+    assert s3_client.head_object(Bucket=BUCKET,
+                                 Key='simple/pips3/pips3-0.1.0.whl')['ContentLength'] == 0
+
+
+def test_s3_client_created_on_first_use():
+    """Test no client is created until a request is made, for the region of the bucket"""
+
+    with patch('pips3.base.get_s3_client') as client_mock, \
+            patch('pips3.base.get_bucket_region', return_value='ap-southeast-2') as region_mock:
+        obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, max_workers=32)
+        client_mock.assert_not_called()
+
+        assert obj.s3_client is client_mock.return_value
+        assert obj.s3_client is client_mock.return_value
+        region_mock.assert_called_once_with(BUCKET, client_mock.return_value)
+        client_mock.assert_called_with(region_name='ap-southeast-2',
+                                       max_pool_connections=32)
+
+        obj = PipS3(ENDPOINT_URL,
+                    BUCKET,
+                    PREFIX,
+                    max_concurrency=4,
+                    region_name='us-west-2')
+        obj.s3_client
+        region_mock.assert_called_once()
+        client_mock.assert_called_with(region_name='us-west-2',
+                                       max_pool_connections=4)
+
+
+def test_transfer_config():
+    """Test part size and concurrency are chosen from the file size and measured throughput"""
+
+    mib = 1024 * 1024
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, MagicMock())
+
+    def settings(size):
+        config = obj.transfer_config(size)
+        assert config.multipart_threshold == config.multipart_chunksize
+        return config.multipart_chunksize // mib, config.max_concurrency
+
+    assert settings(1024) == (8, 1)
+    assert settings(100 * mib) == (8, 13)
+    assert settings(2048 * mib) == (32, 16)
+
+    # Parts take about two seconds at the measured throughput per connection
+    obj._measure(2048 * mib, 8.0, obj.transfer_config(2048 * mib))
+    assert settings(2048 * mib) == (32, 16)
+
+    obj._measure(2048 * mib, 2.0, obj.transfer_config(2048 * mib))
+    assert settings(2048 * mib) == (80, 16)
+
+    # Small uploads are not measured
+    obj._measure(mib, 100.0, obj.transfer_config(mib))
+    assert settings(2048 * mib) == (80, 16)
+
+    obj = PipS3(ENDPOINT_URL,
+                BUCKET,
+                PREFIX,
+                MagicMock(),
+                part_size=64 * mib,
+                max_concurrency=4)
+    assert settings(2048 * mib) == (64, 4)
+
+
+def test_upload_package_transfer_settings(tmp_path):
+    """Test package uploads use and report the chosen transfer settings"""
+
+    pkg_path = tmp_path / 'pips3-0.1.0-py3-none-any.whl'
+    pkg_path.write_bytes(b'x' * 1024)
+
+    s3_client = MagicMock()
+    s3_client.exceptions.ClientError = ClientError
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client, max_concurrency=4)
+
+    obj.upload_package(str(pkg_path), 'pips3', existing={})
+
+    config = s3_client.upload_fileobj.call_args.kwargs['Config']
+    assert config.multipart_chunksize == 8 * 1024 * 1024
+    assert config.max_concurrency == 4
+    assert config.max_in_memory_upload_chunks == 4
+    assert obj.report.transfers == {
+        'pips3-0.1.0-py3-none-any.whl': {
+            'size': 1024,
+            'part_size': 8 * 1024 * 1024,
+            'concurrency': 4
+        }
+    }
+    assert obj.report.transfer_summary() == (
+        'pips3-0.1.0-py3-none-any.whl: 0.0 MiB in 8 MiB parts, concurrency 4')
+
+
+def test_inventory_access_denied():
+    """Test the inventory raises when listing is not allowed, since s3:ListBucket is required"""
+
+    s3_client = MagicMock()
+    s3_client.exceptions.ClientError = ClientError
+
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client)
+
+    for code in ['AccessDenied', 'InternalError']:
+        s3_client.list_objects_v2.side_effect = _client_error(
+            code, 'ListObjectsV2')
+
+        with pytest.raises(ClientError):
+            obj.inventory('pips3')
+
+
+@mock_s3
+@patch('pips3.base.PipS3.find_package_files',
+       return_value=[
+           'tests/assets/pips3-0.1.0.dev0.whl',
+           'tests/assets/pips3-0.1.0.whl',
+       ])
+def test_publish_packages_single_listing(files_mock):
+    """Test publishing checks existence with one listing and no HEAD per package"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    package_heads = []
+
+    def count_heads(params, **kwargs):
+        if params['Key'].endswith('.whl'):
+            package_heads.append(params['Key'])
+
+    s3_client.meta.events.register('provide-client-params.s3.HeadObject', count_heads)
+
+    with patch('pips3.base.get_s3_client', return_value=s3_client):
+        report = publish_packages(ENDPOINT_URL, BUCKET)
+
+        assert report.counts['uploads'] == 2
+        assert package_heads == []
+
+        # Nothing is uploaded when any of the files exists
+        with pytest.raises(PackageExistsException):
+            publish_packages(ENDPOINT_URL, BUCKET)
+
+
+@mock_s3
+def test_publish_packages_pipelined(tmp_path, make_wheel):
+    """Test publishing with several jobs uploads every file and reports each stage"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    upload_files = [
+        make_wheel(tmp_path / f'pips3-0.1.{i}-py3-none-any.whl')
+        for i in range(8)
+    ]
+
+    with patch('pips3.base.get_s3_client', return_value=s3_client) as client_mock, \
+            patch('pips3.base.PipS3.find_package_files', return_value=upload_files):
+        report = publish_packages(ENDPOINT_URL, BUCKET, jobs=4, max_concurrency=2)
+
+    # The shared client has a connection for every concurrent part upload
+    client_mock.assert_called_with(region_name='us-east-1', max_pool_connections=8)
+    assert report.counts['uploads'] == 8
+    assert list(report.timings) == ['discover', 'check', 'prepare', 'upload', 'index']
+    assert 'upload' in report.timing_summary()
+
+    manifest = Manifest.from_json(
+        s3_client.get_object(Bucket=BUCKET,
+                             Key='simple/pips3/manifest.json')['Body'].read())
+    assert len(manifest) == 8
+    for record in manifest:
+        assert record['sha256'] == hashlib.sha256(
+            open(tmp_path / record['filename'], 'rb').read()).hexdigest()
+        assert record['requires_python'] == '>=3.6'
+
+
+@mock_s3
+def test_publish_packages_multiple_projects(tmp_path, make_wheel):
+    """Test a dist directory holding several projects publishes each under its own index"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    upload_files = [
+        make_wheel(tmp_path / 'pips3-0.1.0-py3-none-any.whl'),
+        make_wheel(tmp_path / 'Other_Project-1.0-py3-none-any.whl'),
+        make_wheel(tmp_path / 'pips3-0.2.0-py3-none-any.whl'),
+        make_wheel(tmp_path / 'other.project-2.0-py3-none-any.whl'),
+    ]
+
+    with patch('pips3.base.get_s3_client', return_value=s3_client), \
+            patch('pips3.base.PipS3.find_package_files', return_value=upload_files):
+        report = publish_packages(ENDPOINT_URL, BUCKET, jobs=2)
+
+        assert report.counts['uploads'] == 4
+
+        for project, filenames in [
+            ('pips3', ['pips3-0.1.0-py3-none-any.whl', 'pips3-0.2.0-py3-none-any.whl']),
+            ('other-project', [
+                'Other_Project-1.0-py3-none-any.whl',
+                'other.project-2.0-py3-none-any.whl'
+            ]),
+        ]:
+            manifest = Manifest.from_json(
+                s3_client.get_object(
+                    Bucket=BUCKET,
+                    Key=f'simple/{project}/manifest.json')['Body'].read())
+            assert sorted(record['filename'] for record in manifest) == filenames
+
+            index = s3_client.get_object(
+                Bucket=BUCKET, Key=f'simple/{project}/index.html')['Body'].read()
+            for filename in filenames:
+                assert filename.encode() in index
+
+        root_index = s3_client.get_object(Bucket=BUCKET,
+                                          Key='simple/index.html')['Body'].read()
+        assert b'other-project/' in root_index
+        assert b'pips3/' in root_index
+
+        # Nothing is uploaded when a file of any project exists
+        upload_files.insert(0, make_wheel(tmp_path / 'pips3-0.3.0-py3-none-any.whl'))
+
+        with pytest.raises(PackageExistsException):
+            publish_packages(ENDPOINT_URL, BUCKET)
+
+        with pytest.raises(ClientError):
+            s3_client.head_object(Bucket=BUCKET,
+                                  Key='simple/pips3/pips3-0.3.0-py3-none-any.whl')
+
+
+@mock_s3
+@pytest.mark.parametrize('conditional_writes', [False, True])
+def test_publish_packages_legacy_prefix(tmp_path, make_sdist,
+                                        conditional_writes):
+    """Test a file published under the unnormalized name of an sdist is not published again"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+    s3_client.put_object(Bucket=BUCKET,
+                         Key='simple/my_pkg/my_pkg-0.1.0.tar.gz',
+                         Body=b'')
+
+    upload_files = [make_sdist(tmp_path / 'my_pkg-0.1.0.tar.gz')]
+
+    with patch('pips3.base.get_s3_client', return_value=s3_client), \
+            patch('pips3.base.PipS3.find_package_files', return_value=upload_files):
+        with pytest.raises(PackageExistsException):
+            publish_packages(ENDPOINT_URL,
+                             BUCKET,
+                             conditional_writes=conditional_writes)
+
+    assert [
+        obj['Key'] for obj in s3_client.list_objects_v2(Bucket=BUCKET)['Contents']
+    ] == ['simple/my_pkg/my_pkg-0.1.0.tar.gz']
+
+
 @mock_s3
 def test_upload_index():
     """Test uploading an index"""
@@ -205,6 +1062,146 @@ def test_upload_index_acls():
     _assert_pkg_metadata(metadata)
 
 
+@mock_s3
+def test_upload_index_skips_unchanged():
+    """Test rewriting an identical index is skipped"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client)
+    manifest = Manifest('pips3')
+    manifest.add({
+        'filename': 'pips3-0.1.0.whl',
+        'size': 0,
+        'sha256': EMPTY_SHA256,
+        'upload_time': '2021-03-03T00:00:00.000000Z'
+    })
+
+    obj.upload_index('pips3', manifest=manifest)
+    assert obj.report.counts['writes'] == 2
+    assert obj.report.counts['writes_skipped'] == 0
+
+    # Retried job: nothing changed
+    obj.upload_index('pips3', manifest=manifest)
+    assert obj.report.counts['writes'] == 2
+    assert obj.report.counts['writes_skipped'] == 2
+
+    # Changing the ACL is a change
+    obj.upload_index('pips3', manifest=manifest, public=True)
+    assert obj.report.counts['writes'] == 4
+
+    # A new file is a change
+    manifest.add({
+        'filename': 'pips3-0.2.0.whl',
+        'size': 0,
+        'sha256': EMPTY_SHA256,
+        'upload_time': '2021-03-04T00:00:00.000000Z'
+    })
+    obj.upload_index('pips3', manifest=manifest, public=True)
+    assert obj.report.counts['writes'] == 6
+    assert obj.report.counts['writes_skipped'] == 2
+
+    assert obj.report.summary() == (
+        'Uploaded 0 package(s), wrote 6 index object(s), skipped 2 unchanged')
+
+
+@mock_s3
+def test_upload_index_skips_matching_etag():
+    """Test an identical index stored without a digest is compared by ETag"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client)
+    index = obj.generate_index(keys=[f'{PREFIX}/pips3/pips3-0.1.0.whl'])
+
+    s3_client.put_object(Bucket=BUCKET,
+                         Key=f'{PREFIX}/pips3/index.html',
+                         Body=index.encode('utf-8'),
+                         ContentType='text/html')
+
+    obj.upload_index('pips3', index)
+    assert obj.report.counts['writes_skipped'] == 1
+
+    obj.upload_index('pips3', index + '\n')
+    assert obj.report.counts['writes'] == 1
+
+
+@mock_s3
+def test_upload_index_gzip_cache_control(tmp_path, make_wheel):
+    """Test index pages are stored precompressed with caching headers"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    obj = PipS3(ENDPOINT_URL,
+                BUCKET,
+                PREFIX,
+                s3_client,
+                gzip_index=True,
+                index_cache_control='max-age=300',
+                artifact_cache_control='public, max-age=31536000, immutable')
+
+    pkg_path = make_wheel(tmp_path / 'pips3-0.1.0-py3-none-any.whl')
+    record = obj.upload_package(pkg_path, 'pips3')
+    record.update(obj.upload_metadata(pkg_path, 'pips3'))
+    manifest = obj.update_manifest('pips3', [record])
+    obj.upload_index('pips3', manifest=manifest)
+
+    index = s3_client.get_object(Bucket=BUCKET,
+                                 Key=f'{PREFIX}/pips3/index.html')
+    assert index['ContentEncoding'] == 'gzip'
+    assert index['CacheControl'] == 'max-age=300'
+    assert gzip.decompress(index['Body'].read()).decode(
+        'utf-8') == obj.generate_index(manifest=manifest)
+
+    json_index = s3_client.head_object(Bucket=BUCKET,
+                                       Key=f'{PREFIX}/pips3/index.json')
+    assert json_index['ContentEncoding'] == 'gzip'
+
+    # The manifest is read by pips3 itself and is never compressed
+    stored = s3_client.get_object(Bucket=BUCKET,
+                                  Key=f'{PREFIX}/pips3/manifest.json')
+    assert 'ContentEncoding' not in stored
+    assert 'CacheControl' not in stored
+    assert Manifest.from_json(stored['Body'].read()).files == manifest.files
+
+    for key in [pkg_path, pkg_path + '.metadata']:
+        artifact = s3_client.head_object(
+            Bucket=BUCKET, Key=f'{PREFIX}/pips3/{os.path.basename(key)}')
+        assert artifact[
+            'CacheControl'] == 'public, max-age=31536000, immutable'
+
+    # Compression is deterministic, so a retry writes nothing
+    obj.upload_index('pips3', manifest=manifest)
+    assert obj.report.counts['writes_skipped'] == 2
+
+
+@mock_s3
+def test_upload_large_index(monkeypatch):
+    """Test indexes above the multipart threshold are uploaded in parts"""
+
+    monkeypatch.setattr('pips3.base.INDEX_MULTIPART_THRESHOLD', 1024)
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client)
+    keys = [f'{PREFIX}/pips3/pips3-0.1.0.dev{i}.whl' for i in range(100)]
+
+    obj.upload_index('pips3', obj.generate_index(keys=keys), public=True)
+
+    index = s3_client.get_object(Bucket=BUCKET,
+                                 Key=f'{PREFIX}/pips3/index.html')
+
+    # Multipart uploads have an ETag suffixed by the number of parts
+    assert index['ETag'].endswith('-1"')
+    assert index['ContentType'] == 'text/html'
+    assert index['Body'].read().decode('utf-8') == obj.generate_index(
+        keys=keys)
+
+
 @mock_s3
 @patch('pips3.base.PipS3.find_package_files',
        return_value=[
@@ -241,13 +1238,77 @@ def test_publish_packages(files_mock):
     expected_index = f"""<!DOCTYPE html>
 <html>
   <body>
-    <a href="{ ENDPOINT_URL }/simple/pips3/pips3-0.1.0.dev0.whl">pips3-0.1.0.dev0.whl</a>
-    <a href="{ ENDPOINT_URL }/simple/pips3/pips3-0.1.0.whl">pips3-0.1.0.whl</a>
+    <a href="{ ENDPOINT_URL }/simple/pips3/pips3-0.1.0.dev0.whl#sha256={EMPTY_SHA256}">pips3-0.1.0.dev0.whl</a>
+    <a href="{ ENDPOINT_URL }/simple/pips3/pips3-0.1.0.whl#sha256={EMPTY_SHA256}">pips3-0.1.0.whl</a>
   </body>
 </html>"""
 
     assert index == expected_index
 
+    # The JSON index is published from the same data
+    json_index = s3_client.get_object(Bucket=BUCKET,
+                                      Key=f'{prefix}/pips3/index.json')
+    assert json_index['ContentType'] == 'application/vnd.pypi.simple.v1+json'
+    json_index = json.loads(json_index['Body'].read())
+
+    assert json_index['meta'] == {'api-version': '1.1'}
+    assert json_index['name'] == 'pips3'
+    assert json_index['versions'] == ['0.1.0', '0.1.0.dev0']
+    assert [pkg['filename'] for pkg in json_index['files']] == [
+        'pips3-0.1.0.dev0.whl', 'pips3-0.1.0.whl'
+    ]
+    for pkg in json_index['files']:
+        assert pkg['url'] == f"{ENDPOINT_URL}/simple/pips3/{pkg['filename']}"
+        assert pkg['hashes'] == {'sha256': EMPTY_SHA256}
+        assert pkg['size'] == 0
+        assert pkg['upload-time'].endswith('Z')
+
+    # The root index links to every project
+    root_index = s3_client.get_object(Bucket=BUCKET, Key=f'{prefix}/index.html')
+    root_index = root_index['Body'].read().decode('utf-8')
+
+    for project in ['pips3', 'proj1', 'proj2']:
+        assert f'<a href="{ENDPOINT_URL}/simple/{project}/">{project}</a>' in root_index
+
+
+@mock_s3
+def test_publish_from_manifest():
+    """Test publishing merges into the manifest without listing the project"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client)
+    package_name = 'pips3'
+
+    record = obj.upload_package('tests/assets/pips3-0.1.0.dev0.whl',
+                                package_name)
+    manifest = obj.update_manifest(package_name, [record])
+    obj.upload_index(package_name, manifest=manifest)
+
+    # A fresh instance must be able to publish from the stored manifest alone
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client)
+    with patch.object(PipS3, 'list_objects', side_effect=AssertionError):
+        record = obj.upload_package('tests/assets/pips3-0.1.0.whl',
+                                    package_name)
+        manifest = obj.update_manifest(package_name, [record])
+        obj.upload_index(package_name, manifest=manifest)
+
+        assert obj.exists(package_name, 'pips3-0.1.0.whl')
+        assert obj.exists(package_name, 'pips3-0.1.0.dev0.whl')
+        assert not obj.exists(package_name, 'pips3-0.2.0.whl')
+
+    assert manifest.files['pips3-0.1.0.whl']['size'] == record['size']
+    assert manifest.files['pips3-0.1.0.whl']['sha256'] == EMPTY_SHA256
+
+    index = s3_client.get_object(
+        Bucket=BUCKET, Key=f'{PREFIX}/{package_name}/index.html')
+    index = index['Body'].read().decode('utf-8')
+
+    assert 'pips3-0.1.0.dev0.whl</a>' in index
+    assert 'pips3-0.1.0.whl</a>' in index
+    assert 'manifest.json' not in index
+
 
 @pytest.mark.parametrize("upload_file,package_name", [
     ("cdk_remote_stack-0.1.186-py3-none-any.whl", "cdk-remote-stack"),
@@ -258,3 +1319,626 @@ def test_publish_packages(files_mock):
 ])
 def test_get_package_name(upload_file: str, package_name: str):
     assert get_package_name(upload_file) == package_name
+
+
+@pytest.mark.parametrize("upload_file,version", [
+    ("cdk_remote_stack-0.1.186-py3-none-any.whl", "0.1.186"),
+    ("cdk-remote-stack-0.1.186.tar.gz", "0.1.186"),
+    ("ipyxt-0.0.1.zip", "0.0.1"),
+    ("scikit_learn-1.0.1-cp37-cp37m-macosx_10_13_x86_64.whl", "1.0.1"),
+])
+def test_get_package_version(upload_file: str, version: str):
+    assert get_package_version(upload_file) == version
+
+
+@mock_s3
+def test_json_index_from_listing():
+    """Test the JSON index takes sizes and upload times from the listing"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+    s3_client.put_object(Bucket=BUCKET,
+                         Body=b'12345',
+                         Key=f'{PREFIX}/proj1/proj1-0.1.0.tar.gz')
+    s3_client.put_object(Bucket=BUCKET,
+                         Body=b'<html>',
+                         Key=f'{PREFIX}/proj1/index.html')
+
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client)
+
+    json_index = json.loads(obj.generate_json_index('proj1'))
+
+    assert json_index['versions'] == ['0.1.0']
+    assert json_index['files'] == [{
+        'filename': 'proj1-0.1.0.tar.gz',
+        'url': f'{ENDPOINT_URL}/{PREFIX}/proj1/proj1-0.1.0.tar.gz',
+        'hashes': {},
+        'size': 5,
+        'upload-time': json_index['files'][0]['upload-time'],
+    }]
+
+
+@pytest.mark.parametrize("name,normalized", [
+    ("scikit-learn", "scikit-learn"),
+    ("Django", "django"),
+    ("zope.interface", "zope-interface"),
+    ("Foo__Bar-.baz", "foo-bar-baz"),
+])
+def test_normalize_name(name: str, normalized: str):
+    assert normalize_name(name) == normalized
+
+
+@mock_s3
+def test_add_projects():
+    """Test the root index is only written when a new project is published"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+    s3_client.put_object(Bucket=BUCKET,
+                         Body=b'',
+                         Key=f'{PREFIX}/proj1/proj1-0.1.0.tar.gz')
+
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client)
+
+    # Bootstrapped from the listing
+    assert obj.add_projects(['proj1'])
+    assert not obj.add_projects(['proj1'])
+
+    # A fresh instance reads the stored project list
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client)
+    with patch.object(PipS3, 'list_projects', side_effect=AssertionError):
+        assert not obj.add_projects(['proj1'])
+        assert obj.add_projects(['proj2'])
+
+    root_index = s3_client.get_object(Bucket=BUCKET,
+                                      Key=f'{PREFIX}/index.html')
+    root_index = root_index['Body'].read().decode('utf-8')
+
+    assert f'{ENDPOINT_URL}/{PREFIX}/proj1/' in root_index
+    assert f'{ENDPOINT_URL}/{PREFIX}/proj2/' in root_index
+
+
+@mock_s3
+def test_reindex():
+    """Test every project is reindexed from one listing, keeping the stored hashes"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    stored = Manifest('proj1')
+    for filename in ['proj1-0.1.0.tar.gz', 'proj1-0.2.0.tar.gz']:
+        stored.add({
+            'filename': filename,
+            'size': 0,
+            'sha256': EMPTY_SHA256,
+            'upload_time': '2021-03-03T00:00:00.000000Z'
+        })
+
+    for key, body in [
+        (f'{PREFIX}/index.html', b'stale'),
+        (f'{PREFIX}/proj1/manifest.json', stored.to_json()),
+        (f'{PREFIX}/proj1/proj1-0.1.0.tar.gz', b''),
+        (f'{PREFIX}/proj1/proj1-0.3.0.tar.gz', b'new'),
+        (f'{PREFIX}/proj1-extra/proj1_extra-1.0.tar.gz', b''),
+        (f'{PREFIX}/removed/index.html', b'stale'),
+    ]:
+        s3_client.put_object(Bucket=BUCKET, Key=key, Body=body)
+
+    listings = []
+    s3_client.meta.events.register('provide-client-params.s3.ListObjectsV2',
+                                   lambda params, **kwargs: listings.append(params))
+
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client)
+    assert obj.reindex(jobs=2) == ['proj1-extra', 'proj1']
+    assert len(listings) == 1
+    assert obj.report.counts['projects'] == 3
+    assert obj._manifests == {}
+
+    manifest = Manifest.from_json(
+        s3_client.get_object(Bucket=BUCKET,
+                             Key=f'{PREFIX}/proj1/manifest.json')['Body'].read())
+    assert [(record['filename'], record['sha256']) for record in manifest] == [
+        ('proj1-0.1.0.tar.gz', EMPTY_SHA256),
+        ('proj1-0.3.0.tar.gz', None),
+    ]
+
+    index = s3_client.get_object(Bucket=BUCKET,
+                                 Key=f'{PREFIX}/proj1/index.html')['Body'].read()
+    assert f'proj1-0.1.0.tar.gz#sha256={EMPTY_SHA256}'.encode() in index
+    assert b'proj1-0.2.0' not in index
+
+    removed = s3_client.get_object(Bucket=BUCKET,
+                                   Key=f'{PREFIX}/removed/index.html')['Body'].read()
+    assert b'<a ' not in removed
+
+    root_index = s3_client.get_object(Bucket=BUCKET,
+                                      Key=f'{PREFIX}/index.html')['Body'].read()
+    assert b'proj1-extra/' in root_index
+    assert b'removed/' not in root_index
+
+    # Reindexing an up to date repository writes nothing
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client)
+    obj.reindex()
+    assert obj.report.counts['writes'] == 0
+    assert obj.report.counts['writes_skipped'] == 11
+
+    with patch('pips3.base.get_s3_client', return_value=s3_client):
+        report = reindex_packages(ENDPOINT_URL, BUCKET, prefix=PREFIX, jobs=4)
+
+    assert report.counts['projects'] == 3
+    assert report.counts['writes'] == 0
+
+
+def test_shard_of():
+    """Test projects are assigned to stable shards by their normalized name"""
+
+    assert [shard_of(name, 4) for name in ['pips3', 'numpy', 'requests']] == [1, 3, 3]
+    assert shard_of('Foo_Bar', 7) == shard_of('foo-bar', 7)
+    assert {shard_of(f'proj{i}', 3) for i in range(100)} == {1, 2, 3}
+
+
+@mock_s3
+def test_reindex_shards():
+    """Test shards reindex disjoint projects and the root index waits for every shard"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    projects = [f'proj{i}' for i in range(12)]
+    for project in projects:
+        s3_client.put_object(Bucket=BUCKET,
+                             Key=f'{PREFIX}/{project}/{project}-0.1.0.tar.gz',
+                             Body=b'')
+
+    reindexed = []
+    with patch('pips3.base.get_s3_client', return_value=s3_client):
+        for index in [1, 2]:
+            report = reindex_packages(ENDPOINT_URL,
+                                      BUCKET,
+                                      prefix=PREFIX,
+                                      shard=(index, 3),
+                                      run_id='run1')
+            reindexed.append(report.counts['projects'])
+
+        with pytest.raises(ReindexIncompleteException, match='shard.s. 3 of 3'):
+            complete_reindex(ENDPOINT_URL, BUCKET, 'run1', 3, prefix=PREFIX)
+
+        with pytest.raises(ValueError):
+            reindex_packages(ENDPOINT_URL, BUCKET, prefix=PREFIX, shard=(3, 3))
+
+        report = reindex_packages(ENDPOINT_URL,
+                                  BUCKET,
+                                  prefix=PREFIX,
+                                  shard=(3, 3),
+                                  run_id='run1')
+        reindexed.append(report.counts['projects'])
+
+        report = complete_reindex(ENDPOINT_URL, BUCKET, 'run1', 3, prefix=PREFIX)
+
+    assert sum(reindexed) == len(projects)
+    assert report.counts['projects'] == len(projects)
+
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client)
+    shard_report = obj.shard_reports('run1', 3)[1]
+    assert shard_report['projects'] == sorted(
+        project for project in projects if shard_of(project, 3) == 1)
+    assert shard_report['counts']['projects'] == reindexed[0]
+
+    for project in projects:
+        index = s3_client.get_object(Bucket=BUCKET,
+                                     Key=f'{PREFIX}/{project}/index.html')
+        assert f'{project}-0.1.0.tar.gz'.encode() in index['Body'].read()
+
+    # Reports are kept outside the repository prefix
+    assert s3_client.list_objects_v2(
+        Bucket=BUCKET, Prefix='.pips3/reindex/run1/')['KeyCount'] == 3
+
+    root_index = s3_client.get_object(Bucket=BUCKET,
+                                      Key=f'{PREFIX}/index.html')['Body'].read()
+    for project in projects:
+        assert f'{project}/'.encode() in root_index
+
+
+class FakeConditionalClient:
+    """A local, thread safe stand-in for S3 that enforces conditional writes"""
+    class exceptions:
+        ClientError = ClientError
+
+        class NoSuchKey(ClientError):
+            def __init__(self, operation):
+                super().__init__({'Error': {'Code': 'NoSuchKey'}}, operation)
+
+    def __init__(self):
+        self.objects = {}
+        self.writes = []
+        self._lock = threading.Lock()
+
+    def get_object(self, Bucket, Key):
+        with self._lock:
+            if Key not in self.objects:
+                raise self.exceptions.NoSuchKey('GetObject')
+            body, etag, _ = self.objects[Key]
+        return {'Body': io.BytesIO(body), 'ETag': etag}
+
+    def head_object(self, Bucket, Key):
+        with self._lock:
+            if Key not in self.objects:
+                raise _client_error('404', 'HeadObject')
+            _, etag, metadata = self.objects[Key]
+        return {'ETag': etag, 'Metadata': metadata}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None,
+                   Metadata=None, **kwargs):
+        body = Body if isinstance(Body, bytes) else Body.read()
+        with self._lock:
+            current = self.objects.get(Key)
+            if IfNoneMatch == '*' and current is not None:
+                raise _client_error('PreconditionFailed', 'PutObject')
+            if IfMatch is not None and (current is None or current[1] != IfMatch):
+                raise _client_error('PreconditionFailed', 'PutObject')
+
+            etag = f'"{hashlib.md5(body).hexdigest()}"'
+            self.objects[Key] = (body, etag, Metadata or {})
+            self.writes.append(Key)
+        return {'ETag': etag}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Config=None):
+        self.put_object(Bucket=Bucket, Key=Key, Body=Fileobj.read())
+
+    def list_objects_v2(self, Bucket, Prefix, **kwargs):
+        with self._lock:
+            keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        return {
+            'Contents': [{
+                'Key': key,
+                'Size': len(self.objects[key][0]),
+                'LastModified': datetime.datetime(2021, 3, 3)
+            } for key in keys],
+            'IsTruncated': False
+        }
+
+
+def test_add_projects_conditional():
+    """Test concurrent publishers of new projects each add theirs to the root index"""
+
+    s3_client = FakeConditionalClient()
+    publishers = 10
+
+    def publish(i):
+        obj = PipS3(ENDPOINT_URL,
+                    BUCKET,
+                    PREFIX,
+                    s3_client,
+                    conditional_writes=True)
+        return obj.add_projects([f'proj{i}'])
+
+    with ThreadPoolExecutor(max_workers=publishers) as executor:
+        assert all(executor.map(publish, range(publishers)))
+
+    projects = json.loads(
+        s3_client.objects[f'{PREFIX}/projects.json'][0])['projects']
+    root_index = s3_client.objects[f'{PREFIX}/index.html'][0].decode('utf-8')
+
+    assert projects == sorted(f'proj{i}' for i in range(publishers))
+    for project in projects:
+        assert f'{ENDPOINT_URL}/{PREFIX}/{project}/' in root_index
+
+
+def test_coalesced_index():
+    """Test concurrent publishers of a project keep every file and write the index once"""
+
+    s3_client = FakeConditionalClient()
+    publishers = 20
+
+    def publish(i):
+        obj = PipS3(ENDPOINT_URL,
+                    BUCKET,
+                    PREFIX,
+                    s3_client,
+                    coalesce_window=0.2)
+        obj.commit_manifest('pips3', [{
+            'filename': f'pips3-0.1.{i}-py3-none-any.whl',
+            'size': 0,
+            'sha256': EMPTY_SHA256,
+            'upload_time': '2021-03-03T00:00:00.000000Z'
+        }])
+        return obj.coalesced_index('pips3')
+
+    with ThreadPoolExecutor(max_workers=publishers) as executor:
+        written = list(executor.map(publish, range(publishers)))
+
+    manifest = Manifest.from_json(
+        s3_client.objects[f'{PREFIX}/pips3/manifest.json'][0])
+    assert len(manifest) == publishers
+
+    index = s3_client.objects[f'{PREFIX}/pips3/index.html'][0].decode('utf-8')
+    for i in range(publishers):
+        assert f'pips3-0.1.{i}-py3-none-any.whl' in index
+
+    index_writes = s3_client.writes.count(f'{PREFIX}/pips3/index.html')
+    assert sum(written) == 1
+    assert index_writes <= sum(written)
+
+    generation = json.loads(
+        s3_client.objects[f'.pips3/generations/{PREFIX}/pips3.json'][0])
+    assert generation['requested'] == generation['rendered'] == publishers
+    assert generation['holder'] is None
+
+
+def test_coalesced_index_expired_lease(monkeypatch):
+    """Test a lease abandoned by a stopped writer is taken over once it expires"""
+
+    monkeypatch.setattr('pips3.base.LEASE_SECONDS', 0.1)
+
+    s3_client = FakeConditionalClient()
+    s3_client.put_object(Bucket=BUCKET,
+                         Key=f'.pips3/generations/{PREFIX}/pips3.json',
+                         Body=json.dumps({
+                             'requested': 3,
+                             'rendered': 2,
+                             'holder': 'stopped',
+                             'lease_until': time.time() + 0.1
+                         }).encode('utf-8'))
+
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client, coalesce_window=0)
+    obj.commit_manifest('pips3', [])
+
+    assert obj.coalesced_index('pips3')
+    assert f'{PREFIX}/pips3/index.html' in s3_client.objects
+
+
+def test_coalesced_index_renews_lease(monkeypatch):
+    """Test the lease is renewed while a slow render runs, so it is never taken over"""
+
+    monkeypatch.setattr('pips3.base.LEASE_SECONDS', 0.1)
+    monkeypatch.setattr('pips3.base.LEASE_RENEW_SECONDS', 0.02)
+
+    s3_client = FakeConditionalClient()
+    key = f'.pips3/generations/{PREFIX}/pips3.json'
+
+    obj = PipS3(ENDPOINT_URL, BUCKET, PREFIX, s3_client, coalesce_window=0)
+    obj.commit_manifest('pips3', [])
+
+    upload_index = obj.upload_index
+    leases = []
+
+    def slow_upload_index(*args, **kwargs):
+        for _ in range(15):
+            time.sleep(0.02)
+            generation = json.loads(s3_client.objects[key][0])
+            leases.append(generation['lease_until'] - time.time())
+        return upload_index(*args, **kwargs)
+
+    with patch.object(obj, 'upload_index', slow_upload_index):
+        assert obj.coalesced_index('pips3')
+
+    assert min(leases) > 0
+    generation = json.loads(s3_client.objects[key][0])
+    assert generation['holder'] is None
+    assert generation['rendered'] == 1
+
+
+@patch('pips3.base.PipS3.find_package_files',
+       return_value=['tests/assets/pips3-0.1.0.whl'])
+def test_publish_packages_coalesced(files_mock):
+    """Test publishing with coalesced index writes commits the manifest conditionally"""
+
+    s3_client = FakeConditionalClient()
+
+    with patch('pips3.base.get_s3_client', return_value=s3_client):
+        report = publish_packages(ENDPOINT_URL,
+                                  BUCKET,
+                                  coalesce_window=0,
+                                  region_name='us-east-1')
+
+    assert report.counts['uploads'] == 1
+    assert 'pips3-0.1.0.whl' in Manifest.from_json(
+        s3_client.objects['simple/pips3/manifest.json'][0])
+    assert b'pips3-0.1.0.whl' in s3_client.objects['simple/pips3/index.html'][0]
+
+
+def test_publish_packages_conditional_exists(tmp_path, make_wheel):
+    """Test files uploaded before a conditional write finds an existing file are indexed"""
+
+    s3_client = FakeConditionalClient()
+    s3_client.put_object(Bucket=BUCKET,
+                         Key='simple/pips3/pips3-0.2.0-py3-none-any.whl',
+                         Body=b'published')
+
+    upload_files = [
+        make_wheel(tmp_path / 'pips3-0.1.0-py3-none-any.whl'),
+        make_wheel(tmp_path / 'pips3-0.2.0-py3-none-any.whl'),
+        make_wheel(tmp_path / 'pips3-0.3.0-py3-none-any.whl'),
+    ]
+
+    with patch('pips3.base.get_s3_client', return_value=s3_client), \
+            patch('pips3.base.PipS3.find_package_files', return_value=upload_files):
+        with pytest.raises(PackageExistsException):
+            publish_packages(ENDPOINT_URL,
+                             BUCKET,
+                             jobs=2,
+                             conditional_writes=True,
+                             region_name='us-east-1')
+
+    assert s3_client.objects['simple/pips3/pips3-0.2.0-py3-none-any.whl'][0] == b'published'
+
+    manifest = Manifest.from_json(s3_client.objects['simple/pips3/manifest.json'][0])
+    for filename in ['pips3-0.1.0-py3-none-any.whl', 'pips3-0.3.0-py3-none-any.whl']:
+        assert manifest.files[filename]['sha256']
+        assert filename.encode() in s3_client.objects['simple/pips3/index.html'][0]
+    assert b'pips3/' in s3_client.objects['simple/index.html'][0]
+
+
+def test_reindex_project_concurrent_publish(tmp_path, make_wheel):
+    """Test reindexing from a listing never loses the records of a concurrent publish"""
+
+    s3_client = FakeConditionalClient()
+    publisher = PipS3(ENDPOINT_URL, BUCKET, s3_client=s3_client)
+    indexer = PipS3(ENDPOINT_URL, BUCKET, s3_client=s3_client)
+
+    first = make_wheel(tmp_path / 'pips3-0.1.0-py3-none-any.whl')
+    second = make_wheel(tmp_path / 'pips3-0.2.0-py3-none-any.whl')
+    manifest_key = 'simple/pips3/manifest.json'
+
+    # The publisher commits its manifest just after the indexer reads the stored one
+    record = publisher.upload_package(first, 'pips3')
+    record.update(publisher.upload_metadata(first, 'pips3'))
+    objects = list(indexer.list_objects(package_name='pips3'))
+
+    get_object = s3_client.get_object
+    racing = [True]
+
+    def racing_get_object(Bucket, Key):
+        try:
+            return get_object(Bucket=Bucket, Key=Key)
+        finally:
+            if Key == manifest_key and racing[0]:
+                racing[0] = False
+                publisher.publish_index('pips3', [record])
+
+    with patch.object(s3_client, 'get_object', racing_get_object):
+        manifest = indexer.reindex_project('pips3', objects)
+
+    assert not racing[0]
+    assert manifest.files['pips3-0.1.0-py3-none-any.whl']['sha256'] == record['sha256']
+    stored = Manifest.from_json(s3_client.objects[manifest_key][0])
+    assert stored.files == manifest.files
+    index = s3_client.objects['simple/pips3/index.html'][0]
+    assert f"#sha256={record['sha256']}".encode() in index
+    assert b'data-dist-info-metadata' in index
+
+    # A file published after the listing is kept, and a deleted file is dropped
+    publisher.publish_index('pips3', [publisher.upload_package(second, 'pips3')])
+    del s3_client.objects['simple/pips3/pips3-0.1.0-py3-none-any.whl']
+
+    manifest = indexer.reindex_project('pips3', objects[:0])
+    assert list(manifest.files) == ['pips3-0.2.0-py3-none-any.whl']
+    assert manifest.files['pips3-0.2.0-py3-none-any.whl']['sha256']
+
+
+@mock_s3
+def test_file_etag(tmp_path):
+    """Test local ETags match the ETags S3 gives single and multipart uploads"""
+
+    from boto3.s3.transfer import TransferConfig
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    path = tmp_path / 'pips3-0.1.0.tar.gz'
+    path.write_bytes(os.urandom(17 * 2**20))
+
+    s3_client.upload_file(str(path), BUCKET, 'single',
+                          Config=TransferConfig(multipart_threshold=32 * 2**20))
+    s3_client.upload_file(str(path), BUCKET, 'parts',
+                          Config=TransferConfig(multipart_threshold=6 * 2**20,
+                                                multipart_chunksize=6 * 2**20))
+
+    objects = {
+        obj['Key']: obj
+        for obj in s3_client.list_objects_v2(Bucket=BUCKET)['Contents']
+    }
+    assert objects['single']['ETag'].strip('"') == file_etag(str(path))
+    assert objects['parts']['ETag'].strip('"') == file_etag(str(path), 6 * 2**20)
+    assert objects['parts']['ETag'].endswith('-3"')
+
+    # The part size is found from the number of parts in the ETag
+    obj = PipS3(ENDPOINT_URL, BUCKET, s3_client=s3_client)
+    assert obj.is_identical(str(path), objects['single'])
+    assert obj.is_identical(str(path), objects['parts'])
+    assert not obj.is_identical(str(path), dict(objects['parts'], Size=1))
+    assert not obj.is_identical(str(path), dict(objects['parts'], ETag='"kms"'))
+
+    # An ETag that is not an MD5, as of SSE-KMS, matches by the sha256 of the manifest record
+    record = {'sha256': file_sha256(str(path))}
+    assert obj.is_identical(str(path), dict(objects['parts'], ETag='"kms"'),
+                            record)
+    assert not obj.is_identical(str(path), objects['parts'],
+                                {'sha256': '0' * 64})
+
+
+@mock_s3
+def test_is_identical_part_size(tmp_path):
+    """Test a multipart upload with a non-standard part size matches by its recorded part size"""
+
+    from boto3.s3.transfer import TransferConfig
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    path = tmp_path / 'pips3-0.1.0.tar.gz'
+    path.write_bytes(os.urandom(17 * 2**20))
+
+    # 7 MiB parts give 3 parts, as do the 6 and 8 MiB standard part sizes
+    config = TransferConfig(multipart_threshold=6 * 2**20,
+                            multipart_chunksize=7 * 2**20)
+    s3_client.upload_file(str(path), BUCKET, 'recorded', Config=config,
+                          ExtraArgs={'Metadata': {
+                              PART_SIZE_METADATA: str(7 * 2**20)
+                          }})
+    s3_client.upload_file(str(path), BUCKET, 'unrecorded', Config=config)
+
+    objects = {
+        obj['Key']: obj
+        for obj in s3_client.list_objects_v2(Bucket=BUCKET)['Contents']
+    }
+    obj = PipS3(ENDPOINT_URL, BUCKET, s3_client=s3_client)
+    assert obj.is_identical(str(path), objects['recorded'])
+    assert not obj.is_identical(str(path), objects['unrecorded'])
+
+    # Multipart package uploads record their part size
+    obj = PipS3(ENDPOINT_URL, BUCKET, s3_client=s3_client, part_size=7 * 2**20)
+    obj.upload_package(str(path), 'pips3')
+    metadata = s3_client.head_object(
+        Bucket=BUCKET, Key='simple/pips3/pips3-0.1.0.tar.gz')['Metadata']
+    assert metadata == {PART_SIZE_METADATA: str(7 * 2**20)}
+
+
+@mock_s3
+def test_publish_packages_sync(tmp_path, make_wheel):
+    """Test sync uploads missing files, skips identical files and reports conflicts"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    upload_files = [
+        make_wheel(tmp_path / 'pips3-0.1.0-py3-none-any.whl'),
+        make_wheel(tmp_path / 'pips3-0.2.0-py3-none-any.whl'),
+        make_wheel(tmp_path / 'pips3-0.3.0-py3-none-any.whl'),
+    ]
+
+    with patch('pips3.base.get_s3_client', return_value=s3_client):
+        with patch('pips3.base.PipS3.find_package_files',
+                   return_value=upload_files[:1]):
+            publish_packages(ENDPOINT_URL, BUCKET)
+
+        s3_client.put_object(Bucket=BUCKET,
+                             Key='simple/pips3/pips3-0.2.0-py3-none-any.whl',
+                             Body=b'rebuilt')
+
+        with patch('pips3.base.PipS3.find_package_files',
+                   return_value=upload_files):
+            with pytest.raises(PackageExistsException):
+                publish_packages(ENDPOINT_URL, BUCKET)
+
+            report = publish_packages(ENDPOINT_URL, BUCKET, jobs=2, sync=True)
+
+            assert report.counts['uploads'] == 1
+            assert report.counts['identical'] == 1
+            assert report.conflicts == [upload_files[1]]
+            assert 'conflict' in report.sync_summary()
+
+            # Nothing is written once every file is published
+            s3_client.delete_object(
+                Bucket=BUCKET, Key='simple/pips3/pips3-0.2.0-py3-none-any.whl')
+            s3_client.upload_file(upload_files[1], BUCKET,
+                                  'simple/pips3/pips3-0.2.0-py3-none-any.whl')
+            report = publish_packages(ENDPOINT_URL, BUCKET, sync=True)
+
+            assert report.counts['identical'] == 3
+            assert report.counts['writes'] == 0
+
+    manifest = Manifest.from_json(
+        s3_client.get_object(Bucket=BUCKET,
+                             Key='simple/pips3/manifest.json')['Body'].read())
+    assert 'pips3-0.3.0-py3-none-any.whl' in manifest
@@ -2,28 +2,45 @@
 # -*- coding: utf-8 -*-
 """Tests for `pips3` cli."""
 
+import json
+import subprocess
+import sys
 from unittest.mock import patch
 
 import pytest
 from click.testing import CliRunner
 
 from pips3 import cli
-from pips3.exceptions import InvalidConfig
+from pips3.exceptions import InvalidConfig, ReindexIncompleteException
 
 URL = 'http://localhost:9000'
 BUCKET = 'somebucket'
 PACKAGE = 'pips3'
 
+OPTIONS = {
+    'jobs': 1,
+    'gzip_index': False,
+    'index_cache_control': None,
+    'artifact_cache_control': None,
+    'conditional_writes': False,
+    'part_size': None,
+    'max_concurrency': None,
+    'region_name': None,
+    'coalesce_window': None,
+}
+
 
 @patch('pips3.cli.publish_packages')
 def test_command_line_interface(publish_mock):
     """Test the CLI."""
+    publish_mock.return_value.summary.return_value = 'Uploaded 2 package(s)'
     runner = CliRunner()
 
     result = runner.invoke(cli.main, ['--endpoint', URL, '--bucket', BUCKET])
 
     assert result.exit_code == 0
-    publish_mock.assert_called_with(URL, BUCKET, False, False)
+    assert 'Uploaded 2 package(s)' in result.output
+    publish_mock.assert_called_with(URL, BUCKET, False, False, **OPTIONS)
 
 
 @patch('pips3.cli.publish_packages')
@@ -35,7 +52,7 @@ def test_command_line_interface_public(publish_mock):
                            ['--endpoint', URL, '--bucket', BUCKET, '--public'])
 
     assert result.exit_code == 0
-    publish_mock.assert_called_with(URL, BUCKET, True, False)
+    publish_mock.assert_called_with(URL, BUCKET, True, False, **OPTIONS)
 
 
 @patch('pips3.cli.publish_packages')
@@ -48,7 +65,61 @@ def test_command_line_interface_owner_control(publish_mock):
         ['--endpoint', URL, '--bucket', BUCKET, '--bucket-owner-full-control'])
 
     assert result.exit_code == 0
-    publish_mock.assert_called_with(URL, BUCKET, False, True)
+    publish_mock.assert_called_with(URL, BUCKET, False, True, **OPTIONS)
+
+
+@patch('pips3.cli.publish_packages')
+def test_command_line_interface_caching(publish_mock):
+    """Test the CLI compression and caching options"""
+    runner = CliRunner()
+
+    result = runner.invoke(cli.main, [
+        '--endpoint', URL, '--bucket', BUCKET, '--gzip-index',
+        '--index-cache-control', 'max-age=300', '--artifact-cache-control',
+        'max-age=31536000, immutable', '--jobs', '4'
+    ])
+
+    assert result.exit_code == 0
+    publish_mock.assert_called_with(
+        URL,
+        BUCKET,
+        False,
+        False,
+        jobs=4,
+        gzip_index=True,
+        index_cache_control='max-age=300',
+        artifact_cache_control='max-age=31536000, immutable',
+        conditional_writes=False,
+        part_size=None,
+        max_concurrency=None,
+        region_name=None,
+        coalesce_window=None)
+
+
+@patch('pips3.cli.publish_packages')
+def test_command_line_interface_transfer(publish_mock):
+    """Test the CLI transfer settings and report"""
+    publish_mock.return_value.transfers = {'pips3-0.1.0.whl': {}}
+    publish_mock.return_value.transfer_summary.return_value = 'pips3-0.1.0.whl: 64 MiB parts'
+    runner = CliRunner()
+
+    result = runner.invoke(cli.main, [
+        '--endpoint', URL, '--bucket', BUCKET, '--part-size', '64',
+        '--max-concurrency', '8', '--coalesce-index', '2.5'
+    ])
+
+    assert result.exit_code == 0
+    assert 'pips3-0.1.0.whl: 64 MiB parts' in result.output
+    options = dict(OPTIONS,
+                   part_size=64 * 1024 * 1024,
+                   max_concurrency=8,
+                   coalesce_window=2.5)
+    publish_mock.assert_called_with(URL, BUCKET, False, False, **options)
+
+    result = runner.invoke(
+        cli.main, ['--endpoint', URL, '--bucket', BUCKET, '--part-size', '1'])
+
+    assert result.exit_code != 0
 
 
 @patch('pips3.cli.publish_packages')
@@ -63,7 +134,21 @@ def test_command_line_interface_envars(publish_mock, monkeypatch):
     result = runner.invoke(cli.main)
 
     assert result.exit_code == 0
-    publish_mock.assert_called_with(URL, BUCKET, False, False)
+    publish_mock.assert_called_with(URL, BUCKET, False, False, **OPTIONS)
+
+    monkeypatch.setenv('PIPS3_REGION', 'ap-southeast-2')
+
+    result = runner.invoke(cli.main)
+
+    assert result.exit_code == 0
+    publish_mock.assert_called_with(URL, BUCKET, False, False,
+                                    **dict(OPTIONS, region_name='ap-southeast-2'))
+
+    result = runner.invoke(cli.main, ['--region', 'us-west-2'])
+
+    assert result.exit_code == 0
+    publish_mock.assert_called_with(URL, BUCKET, False, False,
+                                    **dict(OPTIONS, region_name='us-west-2'))
 
 
 def test_cli_errors(monkeypatch):
@@ -86,3 +171,197 @@ def test_cli_errors(monkeypatch):
 
     monkeypatch.setenv('PIPS3_BUCKET', URL)
     result = runner.invoke(cli.main)
+
+
+@patch('pips3.cli.publish_packages')
+@patch('pips3.cli.reindex_packages')
+def test_command_line_interface_reindex(reindex_mock, publish_mock):
+    """Test the reindex command uses the shared options and does not publish"""
+    reindex_mock.return_value.counts = {'projects': 3}
+    reindex_mock.return_value.summary.return_value = 'Uploaded 0 package(s)'
+    runner = CliRunner()
+
+    result = runner.invoke(cli.main, [
+        '--endpoint', URL, '--bucket', BUCKET, '--public', '--jobs', '8',
+        '--gzip-index', 'reindex'
+    ])
+
+    assert result.exit_code == 0
+    assert 'Reindexed 3 project(s)' in result.output
+    publish_mock.assert_not_called()
+    reindex_mock.assert_called_with(URL,
+                                    BUCKET,
+                                    True,
+                                    False,
+                                    shard=None,
+                                    run_id=None,
+                                    jobs=8,
+                                    gzip_index=True,
+                                    index_cache_control=None,
+                                    region_name=None)
+
+
+@patch('pips3.cli.reindex_packages')
+def test_command_line_interface_reindex_shard(reindex_mock):
+    """Test reindexing a shard requires a run id"""
+    reindex_mock.return_value.counts = {'projects': 1}
+    runner = CliRunner()
+    options = ['--endpoint', URL, '--bucket', BUCKET, 'reindex']
+
+    result = runner.invoke(cli.main, options + ['--shard', '2/4', '--run-id', '123'])
+
+    assert result.exit_code == 0
+    assert reindex_mock.call_args.kwargs['shard'] == (2, 4)
+    assert reindex_mock.call_args.kwargs['run_id'] == '123'
+
+    for arguments in [['--shard', '2/4'], ['--shard', '5/4', '--run-id', '1'],
+                      ['--shard', 'two', '--run-id', '1']]:
+        result = runner.invoke(cli.main, options + arguments)
+        assert result.exit_code == 2
+
+
+@patch('pips3.cli.complete_reindex')
+def test_command_line_interface_reindex_complete(complete_mock):
+    """Test the reindex completion check fails while a shard is missing"""
+    complete_mock.return_value.counts = {'projects': 12}
+    runner = CliRunner()
+    options = [
+        '--endpoint', URL, '--bucket', BUCKET, 'reindex-complete', '--run-id',
+        '123', '--shards', '4'
+    ]
+
+    result = runner.invoke(cli.main, options)
+
+    assert result.exit_code == 0
+    assert '12 project(s)' in result.output
+    complete_mock.assert_called_with(URL,
+                                     BUCKET,
+                                     '123',
+                                     4,
+                                     False,
+                                     False,
+                                     gzip_index=False,
+                                     index_cache_control=None,
+                                     region_name=None)
+
+    complete_mock.side_effect = ReindexIncompleteException(
+        'Reindex 123 is missing shard(s) 3 of 4')
+    result = runner.invoke(cli.main, options)
+
+    assert result.exit_code == 1
+    assert 'missing shard(s) 3 of 4' in result.output
+
+
+@patch('pips3.cli.apply_packages')
+@patch('pips3.cli.plan_packages')
+def test_command_line_interface_plan_apply(plan_mock, apply_mock, tmp_path):
+    """Test the plan is written to a file and applied with a journal beside it"""
+    plan = {'bucket': BUCKET, 'actions': [{'type': 'upload'}, {'type': 'index'}]}
+    plan_mock.return_value = plan
+    apply_mock.return_value.counts = {'actions_skipped': 2}
+    apply_mock.return_value.summary.return_value = 'Uploaded 0 package(s)'
+    apply_mock.return_value.timing_summary.return_value = 'Stage seconds:'
+    runner = CliRunner()
+    plan_path = str(tmp_path / 'plan.json')
+    options = ['--endpoint', URL, '--bucket', BUCKET]
+
+    result = runner.invoke(cli.main, options + ['plan', '--output', plan_path])
+
+    assert result.exit_code == 0
+    assert 'Planned 1 upload(s)' in result.output
+    plan_mock.assert_called_with(URL, BUCKET, False, False, region_name=None)
+    with open(plan_path) as plan_file:
+        assert json.load(plan_file) == plan
+
+    result = runner.invoke(cli.main, options + ['--jobs', '4', 'apply', plan_path])
+
+    assert result.exit_code == 0
+    assert 'Skipped 2 action(s)' in result.output
+    apply_mock.assert_called_with(plan,
+                                  f'{plan_path}.journal',
+                                  jobs=4,
+                                  gzip_index=False,
+                                  index_cache_control=None,
+                                  region_name=None,
+                                  artifact_cache_control=None,
+                                  conditional_writes=False,
+                                  part_size=None,
+                                  max_concurrency=None,
+                                  coalesce_window=None)
+
+    result = runner.invoke(cli.main,
+                           options + ['--coalesce-index', '2.5', 'apply', plan_path])
+
+    assert result.exit_code == 0
+    assert apply_mock.call_args.kwargs['coalesce_window'] == 2.5
+
+    # A plan is only applied to the bucket it was made for
+    result = runner.invoke(cli.main,
+                           ['--endpoint', URL, '--bucket', 'other', 'apply', plan_path])
+    assert result.exit_code == 2
+
+
+@patch('pips3.cli.publish_packages')
+def test_command_line_interface_sync(publish_mock):
+    """Test sync publishes with the shared options and fails on conflicts"""
+    publish_mock.return_value.conflicts = []
+    publish_mock.return_value.sync_summary.return_value = 'Skipped 2 identical file(s)'
+    runner = CliRunner()
+    options = ['--endpoint', URL, '--bucket', BUCKET, '--jobs', '4', 'sync']
+
+    result = runner.invoke(cli.main, options)
+
+    assert result.exit_code == 0
+    assert 'Skipped 2 identical file(s)' in result.output
+    publish_mock.assert_called_once_with(URL,
+                                         BUCKET,
+                                         False,
+                                         False,
+                                         sync=True,
+                                         jobs=4,
+                                         gzip_index=False,
+                                         index_cache_control=None,
+                                         region_name=None,
+                                         artifact_cache_control=None,
+                                         conditional_writes=False,
+                                         part_size=None,
+                                         max_concurrency=None,
+                                         coalesce_window=None)
+
+    # Index writes of sync are coalesced like those of the default publish
+    result = runner.invoke(cli.main, ['--coalesce-index', '2.5'] + options)
+
+    assert result.exit_code == 0
+    assert publish_mock.call_args.kwargs['coalesce_window'] == 2.5
+
+    publish_mock.return_value.conflicts = ['dist/pips3-0.1.0.whl']
+    result = runner.invoke(cli.main, options)
+
+    assert result.exit_code == 1
+    assert 'pips3-0.1.0.whl' in result.output
+
+
+def test_startup_is_lazy():
+    """Test importing the CLI neither imports boto3 nor runs versioneer"""
+    modules = subprocess.run(
+        [
+            sys.executable, '-c',
+            'import sys, pips3.cli; print(" ".join(sys.modules))'
+        ],
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True).stdout.split()
+
+    assert 'pips3.cli' in modules
+    assert 'boto3' not in modules
+    assert 'pips3._version' not in modules
+
+
+def test_version():
+    """Test the version is resolved on first use"""
+    import pips3
+
+    assert isinstance(pips3.__version__, str)
+
+    with pytest.raises(AttributeError):
+        pips3.__missing__
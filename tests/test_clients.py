@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for `pips3.clients`"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from moto import mock_s3
+
+from pips3.clients import (clear_s3_clients, get_bucket_region,
+                           get_s3_client, register_conditional_headers)
+
+
+@pytest.fixture(autouse=True)
+def clear_clients():
+    clear_s3_clients()
+    yield
+    clear_s3_clients()
+
+
+def test_get_s3_client_cached():
+    """Test clients are shared by region, endpoint and credentials"""
+
+    client = get_s3_client(region_name='us-east-1')
+
+    assert get_s3_client(region_name='us-east-1') is client
+    assert get_s3_client(region_name='ap-southeast-2') is not client
+    assert get_s3_client(region_name='us-east-1',
+                         endpoint_url='http://localhost:9000') is not client
+    assert get_s3_client(region_name='us-east-1',
+                         aws_access_key_id='key',
+                         aws_secret_access_key='secret') is not client
+    assert get_s3_client(region_name='us-east-1',
+                         aws_access_key_id='key',
+                         aws_secret_access_key='other') is not get_s3_client(
+                             region_name='us-east-1',
+                             aws_access_key_id='key',
+                             aws_secret_access_key='secret')
+
+    clear_s3_clients()
+    assert get_s3_client(region_name='us-east-1') is not client
+
+
+def test_get_s3_client_pool_size():
+    """Test the connection pool grows to the largest concurrency requested"""
+
+    client = get_s3_client(region_name='us-east-1')
+    assert client.meta.config.max_pool_connections == 10
+
+    assert get_s3_client(region_name='us-east-1',
+                         max_pool_connections=4) is client
+
+    larger = get_s3_client(region_name='us-east-1', max_pool_connections=64)
+    assert larger is not client
+    assert larger.meta.config.max_pool_connections == 64
+    assert get_s3_client(region_name='us-east-1') is larger
+
+
+def test_register_conditional_headers():
+    """Test conditional writes are sent as headers, whether or not botocore models them"""
+
+    s3_client = boto3.client('s3',
+                             region_name='us-east-1',
+                             aws_access_key_id='key',
+                             aws_secret_access_key='secret')
+    register_conditional_headers(s3_client)
+    register_conditional_headers(s3_client)
+    register_conditional_headers(object())
+
+    sent = []
+
+    def capture(request, **kwargs):
+        sent.append(request.headers)
+        raise ConnectionAbortedError
+
+    s3_client.meta.events.register('before-send.s3', capture)
+
+    with pytest.raises(ConnectionAbortedError):
+        s3_client.put_object(Bucket='bucket', Key='key', Body=b'', IfNoneMatch='*')
+
+    with pytest.raises(ConnectionAbortedError):
+        s3_client.complete_multipart_upload(
+            Bucket='bucket',
+            Key='key',
+            UploadId='upload',
+            MultipartUpload={'Parts': [{'ETag': 'etag', 'PartNumber': 1}]},
+            IfMatch='"etag"')
+
+    assert sent[0]['If-None-Match'] in ('*', b'*')
+    assert sent[1]['If-Match'] in ('"etag"', b'"etag"')
+    assert 'If-Match' not in sent[0]
+
+
+def test_get_s3_client_threads():
+    """Test threads requesting a client at once share a single client"""
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        clients = list(
+            executor.map(lambda _: get_s3_client(region_name='us-east-1'),
+                         range(32)))
+
+    assert all(client is clients[0] for client in clients)
+
+
+@mock_s3
+def test_get_bucket_region(cache_dir):
+    """Test the bucket region is discovered once and cached on disk"""
+
+    s3_client = boto3.client('s3', region_name='ap-southeast-2')
+    s3_client.create_bucket(
+        Bucket='somebucket',
+        CreateBucketConfiguration={'LocationConstraint': 'ap-southeast-2'})
+
+    assert get_bucket_region('somebucket',
+                             boto3.client('s3',
+                                          region_name='us-east-1')) == 'ap-southeast-2'
+    assert json.loads((cache_dir / 'regions.json').read_text()) == {
+        'somebucket': 'ap-southeast-2'
+    }
+
+    # Later lookups are answered from the cache
+    cached_client = MagicMock()
+    assert get_bucket_region('somebucket', cached_client) == 'ap-southeast-2'
+    cached_client.head_bucket.assert_not_called()
+
+
+def test_get_bucket_region_errors(cache_dir):
+    """Test the region is read from errors, and stores without one are not cached"""
+
+    s3_client = MagicMock()
+    s3_client.exceptions.ClientError = ClientError
+    s3_client.head_bucket.side_effect = ClientError(
+        {
+            'Error': {
+                'Code': '301'
+            },
+            'ResponseMetadata': {
+                'HTTPHeaders': {
+                    'x-amz-bucket-region': 'eu-west-1'
+                }
+            }
+        }, 'HeadBucket')
+
+    assert get_bucket_region('redirected', s3_client) == 'eu-west-1'
+
+    s3_client.head_bucket.side_effect = None
+    s3_client.head_bucket.return_value = {
+        'ResponseMetadata': {
+            'HTTPHeaders': {}
+        }
+    }
+
+    assert get_bucket_region('minio', s3_client) is None
+    assert json.loads((cache_dir / 'regions.json').read_text()) == {
+        'redirected': 'eu-west-1'
+    }
+
+
+def test_get_bucket_region_unwritable_cache(cache_dir):
+    """Test a cache that cannot be written does not prevent discovery"""
+
+    cache_dir.write_text('not a directory')
+
+    s3_client = MagicMock()
+    s3_client.head_bucket.return_value = {
+        'ResponseMetadata': {
+            'HTTPHeaders': {
+                'x-amz-bucket-region': 'eu-west-1'
+            }
+        }
+    }
+
+    assert get_bucket_region('somebucket', s3_client) == 'eu-west-1'
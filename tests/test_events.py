@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for `pips3.events`"""
+
+import json
+from unittest.mock import patch
+from urllib.parse import quote_plus
+
+import boto3
+import pytest
+from moto import mock_s3
+
+from pips3.events import affected_projects, handle_event, update_indexes
+from pips3.exceptions import InvalidConfig
+from pips3.manifest import Manifest
+
+ENDPOINT_URL = 'https://some-bucket.s3-website-ap-southeast-2.amazonaws.com'
+BUCKET = 'somebucket'
+
+
+def s3_record(key: str,
+              event_name: str = 'ObjectCreated:Put',
+              bucket: str = BUCKET) -> dict:
+    """A synthetic S3 event notification record"""
+    return {
+        'eventVersion': '2.1',
+        'eventSource': 'aws:s3',
+        'awsRegion': 'us-east-1',
+        'eventName': event_name,
+        's3': {
+            'bucket': {
+                'name': bucket
+            },
+            'object': {
+                'key': quote_plus(key, safe='/'),
+                'size': 0
+            },
+        },
+    }
+
+
+def test_affected_projects():
+    """Test records are grouped by bucket and project, ignoring written indexes"""
+
+    records = [
+        s3_record('simple/proj1/proj1-0.1.0.tar.gz'),
+        s3_record('simple/proj1/proj1-0.2.0.tar.gz',
+                  'ObjectRemoved:Delete'),
+        s3_record('simple/proj2/proj 2-0.1.0.tar.gz'),
+        s3_record('simple/proj1/index.html'),
+        s3_record('simple/proj3/manifest.json'),
+        s3_record('simple/proj3/proj3-0.1.0.tar.gz.metadata'),
+        s3_record('simple/index.html'),
+        s3_record('other/proj4/proj4-0.1.0.tar.gz'),
+        s3_record('simple/proj5/proj5-0.1.0.tar.gz', 'ObjectRestore:Post'),
+        s3_record('simple/proj1/proj1-0.1.0.tar.gz', bucket='otherbucket'),
+    ]
+
+    assert affected_projects(records) == {
+        BUCKET: ('us-east-1', ['proj1', 'proj2']),
+        'otherbucket': ('us-east-1', ['proj1']),
+    }
+
+
+@mock_s3
+def test_update_indexes_burst():
+    """Test a burst of 500 uploads writes each affected index once"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    # An unrelated project that must not be listed
+    s3_client.put_object(Bucket=BUCKET,
+                         Key='simple/unrelated/unrelated-0.1.0.tar.gz',
+                         Body=b'')
+
+    records = []
+    for i in range(500):
+        key = f'simple/proj{i % 5}/proj{i % 5}-0.{i}.0.tar.gz'
+        s3_client.put_object(Bucket=BUCKET, Key=key, Body=b'')
+        records.append(s3_record(key))
+
+    writes = []
+    listings = []
+    s3_client.meta.events.register(
+        'provide-client-params.s3.PutObject',
+        lambda params, **kwargs: writes.append(params['Key']))
+    s3_client.meta.events.register(
+        'provide-client-params.s3.ListObjectsV2',
+        lambda params, **kwargs: listings.append(params['Prefix']))
+
+    updated = update_indexes(records, ENDPOINT_URL, s3_client=s3_client)
+
+    projects = [f'proj{i}' for i in range(5)]
+    assert updated == {BUCKET: projects}
+
+    index_writes = [key for key in writes if key.endswith('/index.html')]
+    assert sorted(index_writes) == sorted(
+        [f'simple/{project}/index.html'
+         for project in projects] + ['simple/index.html'])
+    assert 'simple/unrelated/' not in listings
+
+    for project in projects:
+        manifest = Manifest.from_json(
+            s3_client.get_object(
+                Bucket=BUCKET,
+                Key=f'simple/{project}/manifest.json')['Body'].read())
+        assert len(manifest) == 100
+
+    # A removal regenerates the index without the file
+    s3_client.delete_object(Bucket=BUCKET, Key='simple/proj0/proj0-0.0.0.tar.gz')
+    update_indexes([
+        s3_record('simple/proj0/proj0-0.0.0.tar.gz', 'ObjectRemoved:Delete')
+    ],
+                   ENDPOINT_URL,
+                   s3_client=s3_client)
+
+    index = s3_client.get_object(Bucket=BUCKET,
+                                 Key='simple/proj0/index.html')['Body'].read()
+    assert b'proj0-0.0.0.tar.gz' not in index
+    assert b'proj0-0.5.0.tar.gz' in index
+
+
+@mock_s3
+def test_handle_event_sqs(monkeypatch):
+    """Test the Lambda handler unwraps S3 records delivered through SQS"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+    s3_client.put_object(Bucket=BUCKET,
+                         Key='simple/pips3/pips3-0.1.0.tar.gz',
+                         Body=b'')
+
+    event = {
+        'Records': [{
+            'messageId': '1',
+            'eventSource': 'aws:sqs',
+            'body': json.dumps(
+                {'Records': [s3_record('simple/pips3/pips3-0.1.0.tar.gz')]}),
+        }, {
+            'messageId': '2',
+            'eventSource': 'aws:sqs',
+            'body': json.dumps({'Event': 's3:TestEvent'}),
+        }]
+    }
+
+    with pytest.raises(InvalidConfig):
+        handle_event(event)
+
+    monkeypatch.setenv('PIPS3_ENDPOINT', ENDPOINT_URL)
+    monkeypatch.setenv('PIPS3_PUBLIC', 'true')
+
+    with patch('pips3.base.get_s3_client', return_value=s3_client):
+        assert handle_event(event) == {'projects': {BUCKET: ['pips3']}}
+
+    grants = s3_client.get_object_acl(Bucket=BUCKET,
+                                      Key='simple/pips3/index.html')['Grants']
+    assert any(
+        grant['Grantee'].get('URI', '').endswith('AllUsers') for grant in grants)
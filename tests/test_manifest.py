@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for `pips3.manifest`."""
+
+from datetime import datetime, timezone
+
+from pips3.manifest import Manifest, format_time
+
+
+def test_manifest_round_trip():
+    """Test serialising and loading a manifest"""
+
+    manifest = Manifest('pips3')
+    manifest.add({
+        'filename': 'pips3-0.1.0.whl',
+        'size': 10,
+        'sha256': 'abc',
+        'upload_time': '2021-03-03T00:00:00.000000Z'
+    })
+    manifest.add({
+        'filename': 'pips3-0.1.0.dev0.whl',
+        'size': 5,
+        'sha256': 'def',
+        'upload_time': '2021-03-02T00:00:00.000000Z'
+    })
+
+    loaded = Manifest.from_json(manifest.to_json())
+
+    assert loaded.project == 'pips3'
+    assert 'pips3-0.1.0.whl' in loaded
+    assert 'pips3-0.2.0.whl' not in loaded
+    assert [record['filename'] for record in loaded] == [
+        'pips3-0.1.0.dev0.whl', 'pips3-0.1.0.whl'
+    ]
+    assert manifest.to_json() == loaded.to_json()
+
+
+def test_manifest_from_objects():
+    """Test bootstrapping a manifest from a listing"""
+
+    modified = datetime(2021, 3, 3, 1, 2, 3, tzinfo=timezone.utc)
+    objects = [
+        {
+            'Key': 'simple/pips3/index.html',
+            'Size': 100,
+            'LastModified': modified
+        },
+        {
+            'Key': 'simple/pips3/pips3-0.1.0.whl',
+            'Size': 10,
+            'LastModified': modified
+        },
+    ]
+
+    manifest = Manifest.from_objects('pips3', objects)
+
+    assert list(manifest) == [{
+        'filename': 'pips3-0.1.0.whl',
+        'size': 10,
+        'sha256': None,
+        'upload_time': '2021-03-03T01:02:03.000000Z',
+    }]
+    assert format_time(modified) == '2021-03-03T01:02:03.000000Z'
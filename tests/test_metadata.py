@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for `pips3.metadata`."""
+
+import pytest
+
+from pips3.metadata import (extract_metadata, is_reliable_sdist_metadata,
+                            parse_requires_python)
+
+
+def test_extract_wheel_metadata(tmp_path, make_wheel, core_metadata):
+    """Test reading METADATA from a wheel"""
+
+    pkg_path = make_wheel(tmp_path / 'pips3-0.1.0-py3-none-any.whl')
+
+    assert extract_metadata(pkg_path) == core_metadata
+
+
+def test_extract_sdist_metadata(tmp_path, make_sdist, core_metadata):
+    """Test reading the top level PKG-INFO from an sdist"""
+
+    pkg_path = make_sdist(tmp_path / 'pips3-0.1.0.tar.gz')
+
+    assert extract_metadata(pkg_path) == core_metadata
+
+
+@pytest.mark.parametrize('headers, reliable', [
+    (b'Metadata-Version: 2.2\n', True),
+    (b'Metadata-Version: 2.10\nDynamic: Description\n', True),
+    (b'Metadata-Version: 2.1\n', False),
+    (b'Metadata-Version: 2.2\nDynamic: Requires-Dist\n', False),
+    (b'Metadata-Version: 2.3\nDynamic: requires-python\n', False),
+    (b'Name: pips3\n', False),
+])
+def test_sdist_metadata_reliable(tmp_path, make_sdist, make_wheel, headers,
+                                 reliable):
+    """Test the PKG-INFO of an sdist is only extracted if its dependencies are static"""
+
+    metadata = headers + b'Name: pips3\nVersion: 0.1.0\n'
+    assert is_reliable_sdist_metadata(metadata) == reliable
+
+    pkg_path = make_sdist(tmp_path / 'pips3-0.1.0.tar.gz', metadata)
+    assert extract_metadata(pkg_path) == (metadata if reliable else None)
+
+    # The METADATA of a wheel is always reliable
+    pkg_path = make_wheel(tmp_path / 'pips3-0.1.0-py3-none-any.whl', metadata)
+    assert extract_metadata(pkg_path) == metadata
+
+
+def test_extract_invalid_metadata(tmp_path):
+    """Test packages that are not valid archives have no metadata"""
+
+    for name in ['pips3-0.1.0-py3-none-any.whl', 'pips3-0.1.0.tar.gz']:
+        pkg_path = tmp_path / name
+        pkg_path.write_bytes(b'')
+
+        assert extract_metadata(str(pkg_path)) is None
+
+    assert extract_metadata('README.md') is None
+
+
+def test_parse_requires_python(core_metadata):
+    """Test reading Requires-Python from core metadata"""
+
+    assert parse_requires_python(core_metadata) == '>=3.6'
+    assert parse_requires_python(b'Name: pips3\n') is None
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for `pips3.plan`."""
+
+import hashlib
+import json
+import os
+from unittest.mock import patch
+
+import boto3
+import pytest
+from moto import mock_s3
+
+from pips3.exceptions import InvalidConfig, PackageExistsException
+from pips3.manifest import Manifest
+from pips3.plan import Journal, apply_packages, plan_packages
+
+ENDPOINT_URL = "http://localhost:9000"
+BUCKET = 'pips3'
+
+
+@pytest.fixture
+def upload_files(tmp_path, make_wheel):
+    return [
+        make_wheel(tmp_path / 'pips3-0.1.0-py3-none-any.whl'),
+        make_wheel(tmp_path / 'pips3-0.2.0-py3-none-any.whl'),
+        make_wheel(tmp_path / 'other_project-1.0-py3-none-any.whl'),
+    ]
+
+
+def make_plan(s3_client, upload_files):
+    with patch('pips3.base.get_s3_client', return_value=s3_client):
+        return plan_packages(ENDPOINT_URL, BUCKET, upload_files=upload_files)
+
+
+@mock_s3
+def test_plan_packages(upload_files):
+    """Test a plan lists every write from one listing of each project, without HEADs"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+
+    requests = []
+    s3_client.meta.events.register(
+        'before-call.s3', lambda model, **kwargs: requests.append(model.name))
+
+    plan = make_plan(s3_client, upload_files)
+
+    assert requests.count('ListObjectsV2') == 2
+    assert 'HeadObject' not in requests
+    assert 'PutObject' not in requests
+
+    assert [action['id'] for action in plan['actions']] == [
+        'upload:pips3/pips3-0.1.0-py3-none-any.whl',
+        'metadata:pips3/pips3-0.1.0-py3-none-any.whl',
+        'upload:pips3/pips3-0.2.0-py3-none-any.whl',
+        'metadata:pips3/pips3-0.2.0-py3-none-any.whl',
+        'upload:other-project/other_project-1.0-py3-none-any.whl',
+        'metadata:other-project/other_project-1.0-py3-none-any.whl',
+        'index:pips3',
+        'index:other-project',
+        'root_index',
+    ]
+    assert json.loads(json.dumps(plan)) == plan
+
+    # A plan including a published file is refused
+    s3_client.put_object(Bucket=BUCKET,
+                         Key='simple/pips3/pips3-0.2.0-py3-none-any.whl',
+                         Body=b'')
+    with pytest.raises(PackageExistsException):
+        make_plan(s3_client, upload_files)
+
+
+@mock_s3
+def test_apply_plan(upload_files, tmp_path):
+    """Test applying a plan publishes the files, manifests and indexes"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+    plan = make_plan(s3_client, upload_files)
+
+    with patch('pips3.base.get_s3_client', return_value=s3_client):
+        report = apply_packages(plan, str(tmp_path / 'journal'), jobs=3)
+
+    assert report.counts['uploads'] == 3
+
+    manifest = Manifest.from_json(
+        s3_client.get_object(Bucket=BUCKET, Key='simple/pips3/manifest.json')
+        ['Body'].read())
+    assert sorted(manifest.files) == [
+        'pips3-0.1.0-py3-none-any.whl', 'pips3-0.2.0-py3-none-any.whl'
+    ]
+    assert all(record['metadata_sha256'] for record in manifest.files.values())
+
+    root_index = s3_client.get_object(Bucket=BUCKET,
+                                      Key='simple/index.html')['Body'].read()
+    assert b'other-project' in root_index
+
+    # The journal is removed once the whole plan has been applied
+    assert not os.path.exists(tmp_path / 'journal')
+
+
+@mock_s3
+def test_apply_plan_coalesced(upload_files, tmp_path):
+    """Test applying a plan with coalesced index writes commits each manifest conditionally"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+    plan = make_plan(s3_client, upload_files)
+
+    with patch('pips3.base.get_s3_client', return_value=s3_client), \
+            patch('pips3.base.PipS3.update_manifest', side_effect=AssertionError), \
+            patch('pips3.base.PipS3.coalesced_index',
+                  return_value=True) as coalesced_mock:
+        apply_packages(plan, str(tmp_path / 'journal'), coalesce_window=0)
+
+    assert sorted(call.args[0] for call in coalesced_mock.call_args_list) == [
+        'other-project', 'pips3'
+    ]
+    manifest = Manifest.from_json(
+        s3_client.get_object(Bucket=BUCKET, Key='simple/pips3/manifest.json')
+        ['Body'].read())
+    assert len(manifest) == 2
+
+
+@mock_s3
+def test_apply_plan_resumes(upload_files, tmp_path):
+    """Test an interrupted apply resumes without repeating completed uploads"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+    plan = make_plan(s3_client, upload_files)
+    journal = str(tmp_path / 'journal')
+
+    uploaded = []
+
+    def count_uploads(params, **kwargs):
+        if params['Key'].endswith('.whl'):
+            uploaded.append(params['Key'])
+
+    s3_client.meta.events.register('provide-client-params.s3.PutObject',
+                                   count_uploads)
+
+    # Fail the index write, after every package has been uploaded
+    with patch('pips3.base.get_s3_client', return_value=s3_client), \
+            patch('pips3.base.PipS3.update_manifest', side_effect=OSError):
+        with pytest.raises(OSError):
+            apply_packages(plan, journal)
+
+    assert len(uploaded) == 3
+
+    # A truncated last entry, as from a crash mid-write, is ignored
+    with open(journal, 'a') as journal_file:
+        journal_file.write('{"id": "index:pi')
+
+    with patch('pips3.base.get_s3_client', return_value=s3_client):
+        report = apply_packages(plan, journal)
+
+    assert len(uploaded) == 3
+    assert report.counts['uploads'] == 0
+    assert report.counts['actions_skipped'] == 6
+
+    # The manifest is built from the records of the journal
+    manifest = Manifest.from_json(
+        s3_client.get_object(Bucket=BUCKET, Key='simple/pips3/manifest.json')
+        ['Body'].read())
+    assert manifest.files['pips3-0.1.0-py3-none-any.whl']['sha256']
+    assert not os.path.exists(journal)
+
+
+@mock_s3
+def test_apply_plan_other_journal(upload_files, make_wheel, tmp_path):
+    """Test the journal of an earlier plan saved to the same path is not resumed"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+    journal = str(tmp_path / 'journal')
+
+    # Leave a journal behind, with every upload and index action completed but the root index
+    with patch('pips3.base.get_s3_client', return_value=s3_client), \
+            patch('pips3.base.PipS3.add_projects', side_effect=OSError):
+        with pytest.raises(OSError):
+            apply_packages(make_plan(s3_client, upload_files[:1]), journal)
+
+    # The next release is planned with the same journal path
+    next_release = make_wheel(tmp_path / 'pips3-0.3.0-py3-none-any.whl')
+    plan = make_plan(s3_client, [next_release])
+    assert Journal(journal, plan['id']).load() == {}
+
+    with patch('pips3.base.get_s3_client', return_value=s3_client):
+        report = apply_packages(plan, journal)
+
+    assert report.counts['uploads'] == 1
+    assert report.counts['actions_skipped'] == 0
+
+    index = s3_client.get_object(Bucket=BUCKET,
+                                 Key='simple/pips3/index.html')['Body'].read()
+    assert b'pips3-0.1.0-py3-none-any.whl' in index
+    assert b'pips3-0.3.0-py3-none-any.whl' in index
+
+
+@mock_s3
+def test_apply_plan_published_since(upload_files, tmp_path):
+    """Test a file published by another run since planning is never overwritten"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+    plan = make_plan(s3_client, upload_files)
+
+    key = 'simple/pips3/pips3-0.2.0-py3-none-any.whl'
+    s3_client.put_object(Bucket=BUCKET, Key=key, Body=b'published')
+
+    with patch('pips3.base.get_s3_client', return_value=s3_client):
+        with pytest.raises(PackageExistsException):
+            apply_packages(plan, str(tmp_path / 'journal'))
+
+    assert s3_client.get_object(Bucket=BUCKET,
+                                Key=key)['Body'].read() == b'published'
+    assert s3_client.list_objects_v2(Bucket=BUCKET)['KeyCount'] == 1
+
+
+@mock_s3
+def test_apply_plan_uploaded_not_journaled(upload_files, tmp_path):
+    """Test a file uploaded by an attempt that stopped before journaling it is resumed"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+    plan = make_plan(s3_client, upload_files)
+
+    s3_client.upload_file(upload_files[1], BUCKET,
+                          'simple/pips3/pips3-0.2.0-py3-none-any.whl')
+
+    with patch('pips3.base.get_s3_client', return_value=s3_client):
+        report = apply_packages(plan, str(tmp_path / 'journal'))
+
+    assert report.counts['uploads'] == 2
+    assert report.counts['actions_skipped'] == 1
+
+    manifest = Manifest.from_json(
+        s3_client.get_object(Bucket=BUCKET, Key='simple/pips3/manifest.json')
+        ['Body'].read())
+    record = manifest.files['pips3-0.2.0-py3-none-any.whl']
+    assert record['sha256'] == hashlib.sha256(
+        open(upload_files[1], 'rb').read()).hexdigest()
+    assert record['metadata_sha256']
+
+
+@mock_s3
+def test_apply_plan_changed_file(upload_files, tmp_path):
+    """Test a package file changed since planning is not uploaded"""
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=BUCKET)
+    plan = make_plan(s3_client, upload_files)
+
+    with open(upload_files[0], 'ab') as upload_file:
+        upload_file.write(b'changed')
+
+    with patch('pips3.base.get_s3_client', return_value=s3_client):
+        with pytest.raises(InvalidConfig):
+            apply_packages(plan, str(tmp_path / 'journal'))
+
+        with pytest.raises(InvalidConfig):
+            apply_packages(plan, str(tmp_path / 'journal'), prefix='other')
+
+    assert not os.path.exists(tmp_path / 'journal')
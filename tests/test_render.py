@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for `pips3.render`."""
+
+import io
+import json
+
+from pips3.render import iter_html_index, iter_json_index, write_chunks
+
+
+def test_json_index_matches_json_dumps():
+    """Test the streamed JSON page is identical to dumping the whole page"""
+
+    files = [{
+        'filename': f'pips3-0.{i}.0.tar.gz',
+        'url': f'http://localhost/pips3-0.{i}.0.tar.gz',
+        'hashes': {},
+        'size': i,
+        'upload-time': '2021-03-03T00:00:00.000000Z'
+    } for i in range(3)]
+
+    expected = json.dumps(
+        {
+            'meta': {
+                'api-version': '1.1'
+            },
+            'name': 'pips3',
+            'versions': ['0.0.0', '0.1.0', '0.2.0'],
+            'files': files,
+        },
+        sort_keys=True)
+
+    versions = set()
+
+    def entries():
+        for entry in files:
+            versions.add(entry['filename'][6:-7])
+            yield entry
+
+    assert ''.join(iter_json_index('pips3', entries(), versions)) == expected
+    assert json.loads(''.join(iter_json_index('pips3', [], []))) == {
+        'files': [],
+        'meta': {
+            'api-version': '1.1'
+        },
+        'name': 'pips3',
+        'versions': []
+    }
+
+
+def test_html_index_attributes():
+    """Test link attributes are escaped and rendered in a stable order"""
+
+    links = [('http://localhost/a.whl#sha256=abc', 'a.whl', {
+        'data-requires-python': '>=3.6,<4',
+        'data-core-metadata': 'sha256=def',
+    })]
+
+    assert list(iter_html_index(links))[1] == (
+        '\n    <a href="http://localhost/a.whl#sha256=abc" '
+        'data-core-metadata="sha256=def" '
+        'data-requires-python="&gt;=3.6,&lt;4">a.whl</a>')
+
+
+def test_write_chunks():
+    """Test chunks are encoded into the sink in batches"""
+
+    links = [(f'http://localhost/{i}.whl', f'{i}.whl', {})
+             for i in range(10)]
+    expected = ''.join(iter_html_index(links)).encode('utf-8')
+
+    sink = io.BytesIO()
+    written = write_chunks(iter_html_index(links), sink, batch_size=3)
+
+    assert written == len(expected)
+    assert sink.getvalue() == expected